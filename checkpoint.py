@@ -0,0 +1,188 @@
+# file name:	checkpoint.py
+# description:	Append-only on-disk checkpoint of the Pre-process Environmental Parameters tool.  The cell sums and
+#               counts of each parameter are appended in batches, keyed by LineOID, as soon as they are calculated,
+#               so a run interrupted by a crash can be resumed without summarizing the same catchments again.  The
+#               checkpoint starts with a signature of the inputs, and a checkpoint written for different catchments,
+#               rasters, parameters or settings is never reused.
+# dependencies: built-in Python modules
+
+import os
+import json
+import hashlib
+
+# constants
+CHECKPOINT_EXT = ".ckpt" # file extension of the checkpoint written next to the output table
+CHECKPOINT_VERSION = 1 # version of the checkpoint file layout
+
+
+def pathStamp(path):
+    """Returns the size and modification time of a file, or of all files in a directory (e.g. an ESRI GRID).
+
+    A raster dataset in a file geodatabase has no files of its own, so it is
+    stamped with all files of the geodatabase: any change to the geodatabase
+    changes the stamps of all of its rasters. Lock files, which ArcGIS writes
+    while a dataset is being read, are left out.
+    """
+    if os.path.isfile(path):
+        return [os.path.getsize(path), os.path.getmtime(path)]
+    if not os.path.isdir(path):
+        path = geodatabasePath(path) or path
+    stamp = [0, 0.0]
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            if f.lower().endswith(".lock"):
+                continue
+            p = os.path.join(root, f)
+            stamp[0] += os.path.getsize(p)
+            stamp[1] = max(stamp[1], os.path.getmtime(p))
+    return stamp
+
+
+def geodatabasePath(path):
+    """Returns the file geodatabase folder a dataset path belongs to, or None."""
+    path = os.path.abspath(path)
+    while True:
+        if path.lower().endswith(".gdb") and os.path.isdir(path):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def runSignature(fingerprints, env_dir, hashes, settings):
+    """Returns a signature of the inputs of a run.
+
+    Only the rasters of the parameters are part of the signature, so other files
+    written to the parameter directory (e.g. the output table) do not prevent a
+    resume.
+
+    Args:
+        fingerprints: ordered dictionary of LineOID: geometry digest of the catchments
+        (see incremental.geometryFingerprints)
+        env_dir: directory containing the environmental parameter rasters, or a stack directory
+        hashes: dictionary of parameter name: stamp and hash of its raster (see incremental.rasterHashes)
+        settings: list of other settings that change the results (e.g. engine, nested mode)
+
+    Returns:
+        Hexadecimal sha1 digest.
+    """
+    rasters = sorted([name, h.get("stamp"), h.get("sha1")] for name, h in hashes.items())
+    catchments = hashlib.sha1(json.dumps(list(fingerprints.items())).encode("utf-8")).hexdigest()
+    content = [CHECKPOINT_VERSION, catchments, os.path.abspath(env_dir), rasters, [str(s) for s in settings]]
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class Checkpoint(object):
+    """Append-only checkpoint of per-catchment parameter sums.
+
+    The file holds one JSON record per line. The first record holds the run
+    signature, and every other record holds the LineOID values, cell sums and
+    cell counts (and optionally the running zonal.ZoneStats values) of a batch
+    of catchments for one parameter. Each record is
+    flushed to disk before the next batch is summarized, and an incomplete last
+    record (left by a crash while writing) is ignored.
+
+    Args:
+        path: path of the checkpoint file
+        signature: signature of the run inputs (see runSignature)
+        resume: reuse the results of an existing checkpoint file; otherwise the
+        file is started over
+
+    Raises:
+        ValueError: resume is requested and the existing checkpoint was written
+        for different inputs
+    """
+
+    def __init__(self, path, signature, resume=False):
+        self.path = path
+        self.signature = signature
+        self.results = {}
+        if resume and os.path.isfile(path):
+            end = self.load()
+            self.file = open(path, "r+b")
+            self.file.seek(end)
+            self.file.truncate()
+        else:
+            self.file = open(path, "wb")
+            self.write({"version": CHECKPOINT_VERSION, "signature": signature})
+
+    def load(self):
+        """Reads the records of the checkpoint file.
+
+        Returns:
+            Length of the file up to the end of its last complete record.
+        """
+        with open(self.path, "rb") as f:
+            content = f.read()
+        lines = content.split(b"\n")
+        try:
+            header = json.loads(lines[0].decode("utf-8"))
+        except ValueError:
+            header = {}
+        if header.get("signature") != self.signature:
+            raise ValueError("The checkpoint " + self.path + " was written for different catchments, rasters, "
+                             "parameters or settings, and cannot be resumed.")
+        for line in lines[1:-1]: # the text after the last newline is an incomplete record
+            record = json.loads(line.decode("utf-8"))
+            self.store(record["param"], record["line_oids"], record["sums"], record["counts"], record.get("stats"))
+        return content.rfind(b"\n") + 1
+
+    def write(self, record, sync=True):
+        """Appends a record and, unless sync is False, flushes it to disk."""
+        self.file.write((json.dumps(record) + "\n").encode("utf-8"))
+        if sync:
+            self.sync()
+
+    def sync(self):
+        """Flushes the appended records to disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def store(self, param, line_oids, sums, counts, stats=None):
+        """Keeps the results of a batch of catchments in memory."""
+        done = self.results.setdefault(param, {})
+        fields = sorted(stats) if stats else []
+        for i, line_oid in enumerate(line_oids):
+            row = tuple(stats[f][i] for f in fields) if stats else None
+            done[int(line_oid)] = (float(sums[i]), float(counts[i]), row)
+
+    def done(self, param):
+        """Returns a dictionary of the catchments already summarized for a parameter.
+
+        Returns:
+            Dictionary of LineOID: (sum, count, stats) tuples, where stats is a tuple
+            of statistics values in the sorted order of their names, or None.
+        """
+        return self.results.get(param, {})
+
+    def append(self, param, line_oids, sums, counts, stats=None, sync=True):
+        """Appends the cell sums and counts of a batch of catchments for a parameter.
+
+        Args:
+            param: parameter name
+            line_oids: list of LineOID values
+            sums: array of cell sums
+            counts: array of cell counts
+            stats: optional dictionary of statistic name: array of running values
+            sync: flush the record to disk; records appended with sync False are
+            flushed by the next call of sync
+        """
+        record = {"param": param,
+                  "line_oids": [int(l) for l in line_oids],
+                  "sums": [float(s) for s in sums],
+                  "counts": [float(c) for c in counts]}
+        if stats:
+            record["stats"] = dict((f, [float(v) for v in values]) for f, values in stats.items())
+        self.write(record, sync)
+        self.store(param, record["line_oids"], record["sums"], record["counts"], record.get("stats"))
+
+    def close(self):
+        """Closes the checkpoint file."""
+        self.file.close()
+
+    def remove(self):
+        """Closes and deletes the checkpoint file, once the run has completed."""
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
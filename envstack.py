@@ -0,0 +1,393 @@
+# file name:	envstack.py
+# description:	Builds and reads a pre-aligned environmental parameter stack.  The 19 rasters used by the
+#               Conductivity model are resampled (nearest neighbour, cell centers) to a common cell grid and written
+#               into a single chunked, memory-mapped file, with a manifest describing the band names, NoData value,
+#               transform and a checksum per band.  The zonal statistics step can then read catchment windows
+#               straight from the memory-mapped chunks, touching only the chunks that its zones intersect.  The
+#               size and time of the data file are recorded in the manifest, and the band checksums are verified
+#               when a stack is opened after its data file changed.
+# dependencies: numpy, ESRI arcpy module (building a stack and its spatial reference, imported where used)
+
+import os
+import json
+import math
+import hashlib
+import numpy as np
+import zonal
+import checkpoint
+
+# constants
+MANIFEST_NAME = "manifest.json" # manifest file written in the stack directory
+DATA_NAME = "stack.dat" # memory-mapped band data file written in the stack directory
+STACK_VERSION = 1 # version of the stack file layout
+CHUNK_SIZE = 512 # number of rows and columns of a chunk
+OPEN_STACKS = {} # stacks opened by openStackBand in this process, by directory
+
+
+def isStack(env_dir):
+    """Returns True if a directory holds an environmental parameter stack."""
+    return os.path.isfile(os.path.join(env_dir, MANIFEST_NAME))
+
+
+class EnvStack(object):
+    """Environmental parameter stack opened for reading.
+
+    The band data is memory-mapped with shape (bands, chunk rows, chunk columns,
+    chunk size, chunk size), so a chunk is a contiguous block of the file.
+
+    The data file is checked against the manifest when the stack is opened: its
+    size must match the band layout, and if its size or modification time differ
+    from the stamp in the manifest, the band checksums are recomputed. If they
+    still match, the new stamp is written to the manifest.
+
+    Args:
+        stack_dir: directory holding the stack manifest and data file
+        verify: check the data file against the manifest
+
+    Raises:
+        ValueError: the stack version is not supported, or the data file does not match the manifest
+    """
+
+    def __init__(self, stack_dir, verify=True):
+        self.stack_dir = stack_dir
+        with open(os.path.join(stack_dir, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        if self.manifest["version"] != STACK_VERSION:
+            raise ValueError("Unsupported environmental parameter stack version: " + str(self.manifest["version"]))
+        x_min, cell_w, _, y_max, _, neg_cell_h = self.manifest["transform"]
+        self.grid = zonal.RasterGrid(x_min, y_max, cell_w, -neg_cell_h, self.manifest["nrows"],
+                                     self.manifest["ncols"])
+        self.chunk = self.manifest["chunk"]
+        self.bands = [b["name"] for b in self.manifest["bands"]]
+        shape = (len(self.bands), chunkCount(self.grid.nrows, self.chunk), chunkCount(self.grid.ncols, self.chunk),
+                 self.chunk, self.chunk)
+        data_path = os.path.join(stack_dir, DATA_NAME)
+        if os.path.getsize(data_path) != int(np.prod(shape)) * np.dtype(self.manifest["dtype"]).itemsize:
+            raise ValueError("The data file of the environmental parameter stack in " + stack_dir +
+                             " does not match its manifest. Build the stack again.")
+        self.data = np.memmap(data_path, dtype=self.manifest["dtype"], mode="r", shape=shape)
+        self.sr = loadSpatialReference(self.manifest["spatial_reference"])
+        self.grid.sr = self.sr
+        if verify and self.manifest.get("data_stamp") != checkpoint.pathStamp(data_path):
+            bad = self.badBands()
+            if bad:
+                raise ValueError("The environmental parameter stack in " + stack_dir + " changed since it was "
+                                 "built (bands " + ", ".join(bad) + "). Build the stack again.")
+            self.manifest["data_stamp"] = checkpoint.pathStamp(data_path)
+            try:
+                writeManifest(stack_dir, self.manifest)
+            except (IOError, OSError):
+                pass # read-only stack; the checksums are verified again next time
+
+    def badBands(self):
+        """Recomputes the band checksums and returns the names of the bands that do not match the manifest."""
+        bad = []
+        for b, band in enumerate(self.manifest["bands"]):
+            checksum = hashlib.sha1()
+            for tr in range(self.data.shape[1]):
+                checksum.update(np.ascontiguousarray(self.data[b, tr]).tobytes())
+            if checksum.hexdigest() != band["checksum"]:
+                bad.append(band["name"])
+        return bad
+
+    def band(self, name):
+        """Returns a StackBand for a model parameter name."""
+        return StackBand(self, self.bands.index(name))
+
+    def window(self, bounds, cell_size=None):
+        """Snaps a bounding box to the stack grid.
+
+        Args:
+            bounds: (x_min, y_min, x_max, y_max) tuple in the stack's coordinate system
+            cell_size: cell size of the returned grid. Defaults to the stack's own cell
+            size; other cell sizes keep the stack's grid origin, and are only used to
+            burn zones (see zonal.zoneWeights), not to read the stack.
+
+        Returns:
+            zonal.RasterGrid of the cells intersecting the bounding box, with row_off
+            and col_off attributes giving its position in the stack (in cells of the
+            returned grid).
+        """
+        g = self.grid
+        cw = cell_size or g.cell_w
+        ch = cell_size or g.cell_h
+        c0 = max(int(math.floor((bounds[0] - g.x_min) / cw)), 0)
+        c1 = min(int(math.ceil((bounds[2] - g.x_min) / cw)), int(math.ceil(g.ncols * g.cell_w / cw - 1e-6)))
+        r0 = max(int(math.floor((g.y_max - bounds[3]) / ch)), 0)
+        r1 = min(int(math.ceil((g.y_max - bounds[1]) / ch)), int(math.ceil(g.nrows * g.cell_h / ch - 1e-6)))
+        return zonal.RasterGrid(g.x_min + c0 * cw, g.y_max - r0 * ch, cw, ch, max(r1 - r0, 0), max(c1 - c0, 0),
+                                self.sr, r0, c0)
+
+    def chunks(self, band, grid, touched=None):
+        """Iterates over the chunks of a band intersecting a window, without copying.
+
+        Args:
+            band: band index
+            grid: window returned by EnvStack.window
+            touched: optional set of (chunk row, chunk column) tuples to restrict the iteration to
+
+        Yields:
+            (row, col, view) tuples, where view is the part of the memory-mapped chunk inside
+            the window and (row, col) is the window position of its first cell.
+        """
+        t = self.chunk
+        r0 = grid.row_off
+        c0 = grid.col_off
+        for tr in range(r0 // t, (r0 + grid.nrows - 1) // t + 1):
+            for tc in range(c0 // t, (c0 + grid.ncols - 1) // t + 1):
+                if touched is not None and (tr, tc) not in touched:
+                    continue
+                rs = max(r0, tr * t)
+                re = min(r0 + grid.nrows, (tr + 1) * t)
+                cs = max(c0, tc * t)
+                ce = min(c0 + grid.ncols, (tc + 1) * t)
+                view = self.data[band, tr, tc, rs - tr * t:re - tr * t, cs - tc * t:ce - tc * t]
+                yield rs - r0, cs - c0, view
+
+    def read(self, band, grid, zones=None):
+        """Reads a window of a band.
+
+        A window inside a single chunk of a float64 stack is returned as a read-only
+        view of the memory-mapped file, without copying. Other windows are assembled
+        into a new array from the chunks they intersect.
+
+        Args:
+            band: band index
+            grid: window returned by EnvStack.window
+            zones: optional zonal.ZoneSpans or zonal.ZoneWeights on the window; if given,
+            only the chunks intersected by the zones are read, other cells are NaN
+
+        Returns:
+            2D float64 numpy array, with NoData cells set to NaN.
+        """
+        t = self.chunk
+        if grid.nrows > 0 and grid.ncols > 0 and grid.row_off // t == (grid.row_off + grid.nrows - 1) // t and \
+                grid.col_off // t == (grid.col_off + grid.ncols - 1) // t:
+            row, col, view = next(self.chunks(band, grid))
+            return view if view.dtype == np.float64 else view.astype(np.float64)
+        touched = None if zones is None else touchedChunks(zones, grid, self.chunk)
+        arr = np.empty((grid.nrows, grid.ncols))
+        arr.fill(np.nan)
+        for row, col, view in self.chunks(band, grid, touched):
+            arr[row:row + view.shape[0], col:col + view.shape[1]] = view
+        return arr
+
+    def readCells(self, band, grid, rows, cols):
+        """Reads the values of individual cells of a band straight from the memory-mapped chunks.
+
+        Args:
+            band: band index
+            grid: window returned by EnvStack.window
+            rows, cols: arrays of row and column indices in the window
+
+        Returns:
+            float64 array of cell values, with NoData cells set to NaN.
+        """
+        t = self.chunk
+        r = np.asarray(rows, dtype=np.int64) + grid.row_off
+        c = np.asarray(cols, dtype=np.int64) + grid.col_off
+        return self.data[band, r // t, c // t, r % t, c % t].astype(np.float64)
+
+
+class StackBand(object):
+    """One band of an EnvStack, read like a zonal.RasterSource.
+
+    Args:
+        stack: EnvStack instance
+        band: band index
+    """
+
+    def __init__(self, stack, band):
+        self.stack = stack
+        self.band = band
+
+    def spatialReference(self):
+        """Returns the spatial reference of the stack."""
+        return self.stack.sr
+
+    def window(self, bounds, cell_size=None):
+        """Returns the window of the stack grid covering a bounding box (see EnvStack.window)."""
+        return self.stack.window(bounds, cell_size)
+
+    def read(self, grid, zones=None):
+        """Reads a window of the band (see EnvStack.read)."""
+        return self.stack.read(self.band, grid, zones)
+
+    def readCells(self, grid, rows, cols):
+        """Reads individual cells of the band (see EnvStack.readCells)."""
+        return self.stack.readCells(self.band, grid, rows, cols)
+
+    def __reduce__(self):
+        # worker processes reopen the memory-mapped stack instead of receiving a copy of its data
+        return openStackBand, (self.stack.stack_dir, self.band)
+
+
+def loadSpatialReference(sr_string):
+    """Returns the arcpy SpatialReference of a manifest, or None where arcpy is not installed (numpy reads only)."""
+    try:
+        import arcpy
+    except ImportError:
+        return None
+    sr = arcpy.SpatialReference()
+    sr.loadFromString(sr_string)
+    return sr
+
+
+def openStackBand(stack_dir, band):
+    """Returns a StackBand, opening each stack only once per process.
+
+    Args:
+        stack_dir: directory holding the stack manifest and data file
+        band: band index
+    """
+    if stack_dir not in OPEN_STACKS:
+        OPEN_STACKS[stack_dir] = EnvStack(stack_dir)
+    return StackBand(OPEN_STACKS[stack_dir], band)
+
+
+def chunkCount(n, chunk):
+    """Returns the number of chunks needed to cover n cells."""
+    return max(int(math.ceil(float(n) / chunk)), 1)
+
+
+def touchedChunks(zones, grid, chunk):
+    """Returns the set of stack chunks intersected by zones on a window.
+
+    Args:
+        zones: zonal.ZoneSpans or zonal.ZoneWeights on the window
+        grid: window returned by EnvStack.window
+        chunk: chunk size of the stack
+
+    Returns:
+        Set of (chunk row, chunk column) tuples.
+    """
+    if hasattr(zones, "starts"):
+        rows = zones.rows
+        first = zones.starts
+        last = zones.ends - 1
+    else:
+        rows = zones.cells // grid.ncols
+        first = last = zones.cells % grid.ncols
+    chunk_rows = (rows + grid.row_off) // chunk
+    chunk_first = (first + grid.col_off) // chunk
+    n = (last + grid.col_off) // chunk - chunk_first + 1
+    idx = np.repeat(np.arange(len(n)), n)
+    chunk_cols = chunk_first[idx] + np.arange(len(idx)) - np.repeat(np.cumsum(n) - n, n)
+    ncc = chunkCount(grid.col_off + grid.ncols, chunk)
+    pairs = np.unique(chunk_rows[idx] * ncc + chunk_cols)
+    return set(zip((pairs // ncc).tolist(), (pairs % ncc).tolist()))
+
+
+def buildStack(env_dir, stack_dir, inParam, cell_size=None, chunk=CHUNK_SIZE):
+    """Aligns the environmental parameter rasters to a common grid and writes them as a stack.
+
+    The common grid has the origin of the raster with the smallest cells (or the
+    requested cell size) and covers the union of all raster extents. Each band is
+    resampled with the nearest neighbour (cell center) rule, one row of chunks at a
+    time, so memory use is bounded by the chunk size and the grid width.
+
+    Args:
+        env_dir: directory containing the environmental parameter rasters
+        stack_dir: output directory for the stack
+        inParam: 2D list of model parameter names and associated raster
+        dataset names
+        cell_size: optional cell size of the common grid
+        chunk: number of rows and columns of a chunk
+
+    Returns:
+        Path of the stack manifest file.
+    """
+    import arcpy
+    rasters = [arcpy.Raster(env_dir + "\\" + p[1]) for p in inParam]
+    ref = min(rasters, key=lambda ras: ras.meanCellWidth)
+    sr = ref.spatialReference
+    for p, ras in zip(inParam, rasters):
+        if ras.spatialReference.name != sr.name:
+            raise ValueError("Raster " + p[1] + " is not in the " + sr.name + " coordinate system.")
+    cw = cell_size or ref.meanCellWidth
+    ch = cell_size or ref.meanCellHeight
+    x0 = ref.extent.XMin + math.floor((min(r.extent.XMin for r in rasters) - ref.extent.XMin) / cw) * cw
+    y1 = ref.extent.YMax + math.ceil((max(r.extent.YMax for r in rasters) - ref.extent.YMax) / ch) * ch
+    ncols = int(math.ceil((max(r.extent.XMax for r in rasters) - x0) / cw))
+    nrows = int(math.ceil((y1 - min(r.extent.YMin for r in rasters)) / ch))
+    dtype = "float64" if any(r.pixelType in ("F64", "S32", "U32") for r in rasters) else "float32"
+
+    if not os.path.isdir(stack_dir):
+        os.makedirs(stack_dir)
+    n_tr = chunkCount(nrows, chunk)
+    n_tc = chunkCount(ncols, chunk)
+    data = np.memmap(os.path.join(stack_dir, DATA_NAME), dtype=dtype, mode="w+",
+                     shape=(len(inParam), n_tr, n_tc, chunk, chunk))
+    bands = []
+    for b, (p, ras) in enumerate(zip(inParam, rasters)):
+        arcpy.AddMessage("Adding " + p[1] + " to the environmental parameter stack...")
+        checksum = hashlib.sha1()
+        src = zonal.RasterSource(env_dir + "\\" + p[1])
+        for tr in range(n_tr):
+            block = np.empty((chunk, n_tc * chunk), dtype=dtype)
+            block.fill(np.nan)
+            rows = min(chunk, nrows - tr * chunk)
+            # source cells containing the centers of the common grid cells
+            yc = y1 - (tr * chunk + np.arange(rows) + 0.5) * ch
+            xc = x0 + (np.arange(ncols) + 0.5) * cw
+            bounds = (x0, y1 - (tr * chunk + rows) * ch, x0 + ncols * cw, y1 - tr * chunk * ch)
+            win = src.window(bounds)
+            if win.nrows > 0 and win.ncols > 0:
+                values = src.read(win)
+                src_r = np.floor((win.y_max - yc) / win.cell_h).astype(np.int64)
+                src_c = np.floor((xc - win.x_min) / win.cell_w).astype(np.int64)
+                ok_r = (src_r >= 0) & (src_r < win.nrows)
+                ok_c = (src_c >= 0) & (src_c < win.ncols)
+                sub = values[np.ix_(src_r[ok_r], src_c[ok_c])]
+                block[np.ix_(np.nonzero(ok_r)[0], np.nonzero(ok_c)[0])] = sub
+            data[b, tr] = block.reshape(chunk, n_tc, chunk).transpose(1, 0, 2)
+            checksum.update(np.ascontiguousarray(data[b, tr]).tobytes())
+        bands.append({"name": p[0], "source": p[1], "checksum": checksum.hexdigest()})
+    data.flush()
+    del data
+
+    manifest = {"version": STACK_VERSION,
+                "bands": bands,
+                "dtype": dtype,
+                "nodata": "NaN",
+                "transform": [x0, cw, 0.0, y1, 0.0, -ch],
+                "nrows": nrows,
+                "ncols": ncols,
+                "chunk": chunk,
+                "spatial_reference": sr.exportToString(),
+                "data_stamp": checkpoint.pathStamp(os.path.join(stack_dir, DATA_NAME))}
+    return writeManifest(stack_dir, manifest)
+
+
+def writeManifest(stack_dir, manifest):
+    """Writes the manifest of a stack and returns its path."""
+    manifest_path = os.path.join(stack_dir, MANIFEST_NAME)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_path
+
+
+def verifyStack(stack_dir):
+    """Recomputes the band checksums of a stack and compares them with its manifest.
+
+    Returns:
+        List of the names of the bands whose data does not match the manifest.
+    """
+    return EnvStack(stack_dir, verify=False).badBands()
+
+
+def main(env_dir, stack_dir, inParam, cell_size=''):
+    """Main processing function for the Build Environmental Parameter Stack tool.
+
+    Args:
+        env_dir: directory containing the environmental parameter rasters
+        stack_dir: output directory for the stack
+        inParam: 2D list of model parameter names and associated raster
+        dataset names
+        cell_size: optional cell size of the common grid
+    """
+    import arcpy
+    cell_size = float(cell_size) if cell_size else None
+    arcpy.AddMessage("Building environmental parameter stack in " + stack_dir + "...")
+    manifest_path = buildStack(env_dir, stack_dir, inParam, cell_size)
+    arcpy.AddMessage("Stack manifest written to " + manifest_path)
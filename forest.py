@@ -0,0 +1,385 @@
+# file name:	forest.py
+# description:	In-process prediction of conductivity with the Random Forest model.  The trees of the model are
+#               exported once from R (export_forest.R) as flat node arrays in a columnar table folder, and evaluated
+#               here with numpy for batches of parameter table rows, so no R session, CSV or DBF conversion is
+#               needed per prediction.  The evaluator follows the randomForest package: a row goes to the left
+#               child of a split when its value is <= the split point, and the prediction is the mean of the leaf
+#               values of all trees.  For fast cold starts the exported trees are compiled into a single file of
+#               contiguous node arrays (compileForest), which is memory-mapped by CompiledForest, so processes
+#               opening the model share one copy of it in the file cache.
+# dependencies: numpy, ESRI arcpy module (dBASE and geodatabase parameter tables, imported where they are read)
+
+import os
+import sys
+import struct
+import hashlib
+import subprocess
+import numpy as np
+import incremental
+import tablewriter
+
+# constants
+FOREST_EXT = ".forest" # folder extension of an exported forest
+FEATURES_NAME = "features.txt" # predictor names of an exported forest, one per line in feature index order
+SOURCE_NAME = "source_md5.txt" # md5 digest of the .rdata file an exported forest was written from
+PARITY_NAME = "parity" + tablewriter.COLUMNAR_EXT # R predictions of a parameter table written by the export
+EXPORT_SCRIPT = "export_forest.R" # R script exporting the trees of a model
+NODE_COLUMNS = ["left", "right", "feature", "threshold", "value"] # node arrays of an exported forest
+CHUNK_ROWS = 4096 # number of rows sent down all trees at once
+TABLE_CHUNK_ROWS = 50000 # number of parameter table rows read at once
+COMPILED_EXT = ".rfbin" # file extension of a compiled forest
+COMPILED_MAGIC = b"CONDRFB\x00" # first bytes of a compiled forest file
+COMPILED_VERSION = 1 # version of the compiled forest file layout
+HEADER_FORMAT = "<8sIIIq40s40sqdI" # magic, version, trees, features, nodes, checksum, source sha1, size, mtime, names
+HEADER_SIZE = 4096 # bytes reserved for the header and predictor names, so the node arrays start page-aligned
+COMPILED_ARRAYS = [("tree_start", "<i8"), # node arrays of a compiled forest, in file order (8-byte types first)
+                   ("threshold", "<f8"),
+                   ("value", "<f8"),
+                   ("left", "<i4"),
+                   ("right", "<i4"),
+                   ("feature", "<i4")]
+
+
+class Forest(object):
+    """Regression Random Forest exported as flat node arrays, opened from its folder.
+
+    Args:
+        path: folder of the exported forest
+    """
+
+    def __init__(self, path):
+        self.path = path
+        columns = tablewriter.readColumnar(path, ["tree_start"] + NODE_COLUMNS)
+        self.tree_start = np.asarray(columns["tree_start"], dtype=np.int64)
+        self.left = columns["left"]
+        self.right = columns["right"]
+        self.feature = columns["feature"]
+        self.threshold = columns["threshold"]
+        self.value = columns["value"]
+        self.ntree = len(self.tree_start) - 1
+        with open(os.path.join(path, FEATURES_NAME)) as f:
+            self.features = [line.strip() for line in f if line.strip()]
+
+    def leafValues(self, x):
+        """Returns an array of shape (trees, rows) with the leaf value of every row in every tree."""
+        n = len(x)
+        node = np.repeat(self.tree_start[:-1], n)
+        row = np.tile(np.arange(n), self.ntree)
+        # positions of the (tree, row) pairs still at a split node
+        pos = np.nonzero(self.feature[node] >= 0)[0]
+        while len(pos):
+            current = node[pos]
+            go_left = x[row[pos], self.feature[current]] <= self.threshold[current]
+            node[pos] = np.where(go_left, self.left[current], self.right[current])
+            pos = pos[self.feature[node[pos]] >= 0]
+        return self.value[node].reshape(self.ntree, n)
+
+    def predict(self, x, chunk_rows=CHUNK_ROWS):
+        """Predicts a batch of rows.
+
+        Args:
+            x: array of shape (rows, features), columns in the order of self.features
+            chunk_rows: number of rows sent down all trees at once
+
+        Returns:
+            Array with the prediction of each row, NaN for rows with a missing value.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim != 2 or x.shape[1] != len(self.features):
+            raise ValueError("Expected a parameter array with {0} columns.".format(len(self.features)))
+        y = np.empty(len(x))
+        for r0 in range(0, len(x), chunk_rows):
+            chunk = x[r0:r0 + chunk_rows]
+            y[r0:r0 + len(chunk)] = self.leafValues(chunk).sum(axis=0) / self.ntree
+        # randomForest predicts NA for rows with a missing predictor
+        y[np.isnan(x).any(axis=1)] = np.nan
+        return y
+
+
+class CompiledForest(Forest):
+    """Regression Random Forest opened by memory-mapping a compiled forest file.
+
+    Only the header is read when the forest is opened; the node arrays are paged
+    in from the file cache as the trees are evaluated.
+
+    Args:
+        path: compiled forest file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        header = readCompiledHeader(path)
+        if header is None:
+            raise ValueError("Not a compiled forest of version {0}: {1}".format(COMPILED_VERSION, path))
+        self.ntree = header["ntree"]
+        self.features = header["features"]
+        self.source_hash = header["source_hash"]
+        offset = HEADER_SIZE
+        for name, dtype, count in compiledLayout(self.ntree, header["nodes"]):
+            setattr(self, name, np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,)))
+            offset += count * np.dtype(dtype).itemsize
+
+    def __reduce__(self):
+        # worker processes map the file again instead of receiving a copy of the node arrays
+        return CompiledForest, (self.path,)
+
+
+def compiledLayout(ntree, nodes):
+    """Returns the name, type and length of the node arrays of a compiled forest, in file order."""
+    return [(name, dtype, ntree + 1 if name == "tree_start" else nodes) for name, dtype in COMPILED_ARRAYS]
+
+
+def sourceStamp(model_path):
+    """Returns the size and modification time of the .rdata file of a model."""
+    info = os.stat(model_path)
+    return info.st_size, info.st_mtime
+
+
+def compileForest(forest_dir, out_path, model_path, features):
+    """Compiles an exported forest into a single memory-mappable file.
+
+    The predictor indices of the nodes are renumbered to the given feature
+    order, and the header records a checksum of the node arrays and the sha1
+    digest, size and modification time of the source model.
+
+    Args:
+        forest_dir: folder of the exported forest
+        out_path: compiled forest file to write
+        model_path: path of the .rdata file the forest was exported from
+        features: list of predictor names, in the column order of the parameter arrays to predict
+
+    Returns:
+        Path of the compiled forest file.
+    """
+    forest = Forest(forest_dir)
+    missing = [f for f in forest.features if f not in features]
+    if missing:
+        raise ValueError("The model uses predictors missing from the parameter list: " + ", ".join(missing))
+    remap = np.array([features.index(f) for f in forest.features], dtype=np.int32)
+    forest.feature = np.where(forest.feature >= 0, remap[np.maximum(forest.feature, 0)], -1)
+    names = "\n".join(features).encode("utf-8")
+    if struct.calcsize(HEADER_FORMAT) + len(names) > HEADER_SIZE:
+        raise ValueError("The predictor names do not fit in the compiled forest header.")
+
+    checksum = hashlib.sha1()
+    blocks = []
+    for name, dtype, count in compiledLayout(forest.ntree, len(forest.value)):
+        block = np.ascontiguousarray(getattr(forest, name), dtype=dtype).tobytes()
+        checksum.update(block)
+        blocks.append(block)
+    size, mtime = sourceStamp(model_path)
+    header = struct.pack(HEADER_FORMAT, COMPILED_MAGIC, COMPILED_VERSION, forest.ntree, len(features),
+                         len(forest.value), checksum.hexdigest().encode("ascii"),
+                         incremental.contentHash(model_path).encode("ascii"), size, mtime, len(names))
+    with open(out_path + ".tmp", "wb") as f:
+        f.write((header + names).ljust(HEADER_SIZE, b"\x00"))
+        for block in blocks:
+            f.write(block)
+    if os.path.isfile(out_path):
+        os.remove(out_path)
+    os.rename(out_path + ".tmp", out_path)
+    return out_path
+
+
+def readCompiledHeader(path):
+    """Reads the header of a compiled forest file.
+
+    Returns:
+        Dictionary of the header values, or None if the file is missing or not a compiled forest of this version.
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        data = f.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE:
+        return None
+    values = struct.unpack_from(HEADER_FORMAT, data)
+    if values[0] != COMPILED_MAGIC or values[1] != COMPILED_VERSION:
+        return None
+    start = struct.calcsize(HEADER_FORMAT)
+    return {"ntree": values[2],
+            "features": data[start:start + values[9]].decode("utf-8").split("\n"),
+            "nodes": values[4],
+            "checksum": values[5].decode("ascii"),
+            "source_hash": values[6].decode("ascii"),
+            "source_size": values[7],
+            "source_mtime": values[8]}
+
+
+def isCompiledCurrent(path, model_path, features):
+    """Checks if a compiled forest was built from the current .rdata file of a model.
+
+    The source model is only hashed again when its size or modification time
+    changed since the forest was compiled.
+
+    Args:
+        path: compiled forest file
+        model_path: path of the .rdata file of the model
+        features: list of predictor names, in the expected column order
+    """
+    header = readCompiledHeader(path)
+    if header is None or header["features"] != list(features) or not os.path.isfile(model_path):
+        return False
+    if sourceStamp(model_path) == (header["source_size"], header["source_mtime"]):
+        return True
+    return incremental.contentHash(model_path) == header["source_hash"]
+
+
+def verifyCompiled(path):
+    """Recomputes the checksum of the node arrays of a compiled forest and compares it with its header."""
+    header = readCompiledHeader(path)
+    if header is None:
+        return False
+    checksum = hashlib.sha1()
+    with open(path, "rb") as f:
+        f.seek(HEADER_SIZE)
+        for name, dtype, count in compiledLayout(header["ntree"], header["nodes"]):
+            checksum.update(f.read(count * np.dtype(dtype).itemsize))
+    return checksum.hexdigest() == header["checksum"]
+
+
+def isForest(path):
+    """Checks if a folder holds a complete exported forest."""
+    return os.path.isfile(os.path.join(path, tablewriter.MANIFEST_NAME)) and \
+        os.path.isfile(os.path.join(path, FEATURES_NAME))
+
+
+def isExportedFrom(forest_dir, model_path):
+    """Checks if an exported forest was written from the current .rdata file of a model.
+
+    Folders without a recorded md5 digest (exported by an earlier version of
+    export_forest.R) are of unknown provenance and never match.
+    """
+    source = os.path.join(forest_dir, SOURCE_NAME)
+    if not os.path.isfile(source) or not os.path.isfile(model_path):
+        return False
+    with open(source) as f:
+        recorded = f.read().strip().lower()
+    md5 = hashlib.md5()
+    with open(model_path, "rb") as f:
+        block = f.read(incremental.HASH_BLOCK)
+        while block:
+            md5.update(block)
+            block = f.read(incremental.HASH_BLOCK)
+    return md5.hexdigest() == recorded
+
+
+def exportForest(model_path, forest_dir, in_params=None):
+    """Exports the trees of an R Random Forest model with export_forest.R.
+
+    Args:
+        model_path: path of the .rdata file of the model
+        forest_dir: folder of the exported forest to write
+        in_params: optional parameter table, whose R predictions are written for parityCheck
+
+    Returns:
+        True if the forest was exported.
+    """
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), EXPORT_SCRIPT)
+    cmd = ["Rscript", script, model_path, forest_dir] + ([in_params] if in_params else [])
+    try:
+        if subprocess.call(cmd) != 0:
+            return False
+    except OSError:
+        return False
+    return isForest(forest_dir)
+
+
+def iterParamChunks(in_params, features, chunk_rows=TABLE_CHUNK_ROWS):
+    """Reads the LineOID values and the predictor columns of a parameter table in chunks of rows.
+
+    Args:
+        in_params: parameter table (dBASE, geodatabase or columnar table), or a dictionary of LineOID and
+        parameter name: sequence of values (in-memory columnar data)
+        features: list of predictor field names, in column order
+        chunk_rows: number of table rows per chunk
+
+    Yields:
+        line_oids: array of LineOID values of the chunk
+        x: array of shape (rows, features), NaN for null values
+    """
+    if isinstance(in_params, dict) or tablewriter.isColumnar(in_params):
+        if isinstance(in_params, dict):
+            columns = in_params
+        else:
+            columns = tablewriter.readColumnar(in_params, ["LineOID"] + features)
+        nrows = len(columns["LineOID"])
+        for r0 in range(0, nrows, chunk_rows):
+            r1 = min(r0 + chunk_rows, nrows)
+            x = np.empty((r1 - r0, len(features)))
+            for i, f in enumerate(features):
+                # null values of in-memory columns become NaN
+                x[:, i] = np.asarray(columns[f][r0:r1], dtype=np.float64)
+            yield np.asarray(columns["LineOID"][r0:r1], dtype=np.int64), x
+        return
+    import arcpy
+    line_oids = []
+    rows = []
+    with arcpy.da.SearchCursor(in_params, ["LineOID"] + features) as cursor:
+        for row in cursor:
+            line_oids.append(row[0])
+            rows.append([np.nan if v is None else v for v in row[1:]])
+            if len(rows) >= chunk_rows:
+                yield np.array(line_oids, dtype=np.int64), np.array(rows, dtype=np.float64)
+                line_oids = []
+                rows = []
+    if rows:
+        yield np.array(line_oids, dtype=np.int64), np.array(rows, dtype=np.float64)
+
+
+def readParamMatrix(in_params, features):
+    """Reads the LineOID values and the predictor columns of a whole parameter table.
+
+    Returns:
+        line_oids: array of LineOID values
+        x: array of shape (rows, features), NaN for null values
+    """
+    chunks = list(iterParamChunks(in_params, features))
+    if not chunks:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, len(features)))
+    return np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks])
+
+
+def parityCheck(forest, in_params, parity_tbl):
+    """Compares the predictions of a parameter table with those of R's predict().
+
+    Args:
+        forest: Forest
+        in_params: parameter table
+        parity_tbl: columnar table with LineOID and prdCond columns of R's predictions of in_params,
+        written by export_forest.R
+
+    Returns:
+        rows: number of rows compared
+        max_abs: largest absolute difference (infinite if only one of two predictions is missing)
+        max_rel: largest difference relative to the R prediction
+    """
+    line_oids, x = readParamMatrix(in_params, forest.features)
+    predicted = dict(zip(line_oids.tolist(), forest.predict(x).tolist()))
+    expected = tablewriter.readColumnar(parity_tbl, ["LineOID", "prdCond"])
+    rows = 0
+    max_abs = 0.0
+    max_rel = 0.0
+    for line_oid, r_value in zip(expected["LineOID"].tolist(), expected["prdCond"].tolist()):
+        value = predicted.get(line_oid, np.nan)
+        rows += 1
+        if np.isnan(value) and np.isnan(r_value):
+            continue
+        if np.isnan(value) or np.isnan(r_value):
+            max_abs = max_rel = np.inf
+            continue
+        diff = abs(value - r_value)
+        max_abs = max(max_abs, diff)
+        max_rel = max(max_rel, diff / abs(r_value) if r_value else diff)
+    return rows, max_abs, max_rel
+
+
+if __name__ == "__main__":
+    # python forest.py <compiled forest file>: verifies the checksum of the node arrays
+    if sys.argv[1].endswith(COMPILED_EXT):
+        print("Checksum verified" if verifyCompiled(sys.argv[1]) else "Checksum mismatch or not a compiled forest")
+        sys.exit(0)
+    # python forest.py <forest folder> <parameter table>: compares with the R predictions of the export
+    in_forest = Forest(sys.argv[1])
+    result = parityCheck(in_forest, sys.argv[2], os.path.join(sys.argv[1], PARITY_NAME))
+    print("{0} rows compared, max absolute difference {1}, max relative difference {2}".format(*result))
@@ -0,0 +1,261 @@
+# file name:	incremental.py
+# description:	Incremental recompute support for the Pre-process Environmental Parameters tool.  A sidecar JSON
+#               file written next to each output parameter table records a geometry fingerprint per catchment (by
+#               LineOID) and a stamp and content hash per parameter raster.  A later run given the previous table only
+#               summarizes the catchments that were added or whose geometry changed, and the parameter columns whose
+#               raster changed, and merges them with the unchanged values of the previous table.
+# dependencies: ESRI arcpy module (feature classes, tables and geodatabase rasters, imported where they are read)
+
+import os
+import json
+import collections
+import hashlib
+import checkpoint
+import envstack
+import tablewriter
+
+# constants
+SIDECAR_EXT = ".sidecar.json" # file extension of the sidecar written next to the output table
+SIDECAR_VERSION = 2 # version of the sidecar file layout
+SELECT_CHUNK = 1000 # number of LineOID values per selection query
+HASH_BLOCK = 1048576 # number of bytes read at once when hashing raster files
+
+
+def sidecarPath(out_tbl, ext=SIDECAR_EXT):
+    """Returns the path of a sidecar file of an output table.
+
+    The sidecar of a table in a file geodatabase is written next to the
+    geodatabase, because the geodatabase folder must only hold its own files.
+
+    Args:
+        out_tbl: path of the output table
+        ext: file extension of the sidecar
+    """
+    out_dir = os.path.dirname(out_tbl)
+    if out_dir.lower().endswith(".gdb"):
+        return os.path.join(os.path.dirname(out_dir), "{0}_{1}{2}".format(
+            os.path.splitext(os.path.basename(out_dir))[0], os.path.basename(out_tbl), ext))
+    return os.path.splitext(out_tbl)[0] + ext
+
+
+def geometryFingerprints(in_fc):
+    """Returns an ordered dictionary of LineOID: sha1 digest of the geometry of each catchment polygon.
+
+    The LineOID values are kept in the order of the feature class, which is the
+    row order of the output parameter table.
+    """
+    import arcpy
+    fingerprints = collections.OrderedDict()
+    with arcpy.da.SearchCursor(in_fc, ["LineOID", "SHAPE@WKB"]) as cursor:
+        for row in cursor:
+            fingerprints[row[0]] = hashlib.sha1(bytes(row[1] or b"")).hexdigest()
+    return fingerprints
+
+
+def contentHash(path):
+    """Returns a sha1 digest of a raster file, or of all files of a raster directory (e.g. an ESRI GRID).
+
+    A raster dataset in a file geodatabase has no files of its own, so its cell
+    values are hashed instead (see datasetHash).
+    """
+    if not os.path.exists(path) and checkpoint.geodatabasePath(path) is not None:
+        return datasetHash(path)
+    sha = hashlib.sha1()
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, n) for n in sorted(names))
+    for f in files:
+        sha.update(os.path.relpath(f, path).encode("utf-8"))
+        with open(f, "rb") as data:
+            block = data.read(HASH_BLOCK)
+            while block:
+                sha.update(block)
+                block = data.read(HASH_BLOCK)
+    return sha.hexdigest()
+
+
+def datasetHash(ras_path):
+    """Returns a sha1 digest of the grid and cell values of a raster dataset, read with arcpy in blocks of rows."""
+    import arcpy
+    ras = arcpy.Raster(ras_path)
+    grid = [ras.extent.XMin, ras.extent.YMax, ras.meanCellWidth, ras.meanCellHeight, ras.width, ras.height,
+            ras.noDataValue, ras.pixelType]
+    sha = hashlib.sha1(json.dumps(grid).encode("utf-8"))
+    rows = max(HASH_BLOCK // (8 * max(ras.width, 1)), 1)
+    for r0 in range(0, ras.height, rows):
+        n = min(rows, ras.height - r0)
+        lower_left = arcpy.Point(ras.extent.XMin, ras.extent.YMax - (r0 + n) * ras.meanCellHeight)
+        sha.update(arcpy.RasterToNumPyArray(ras, lower_left, ras.width, n).tobytes())
+    return sha.hexdigest()
+
+
+def rasterHashes(env_dir, inParam, previous=None):
+    """Returns the stamp and content hash of the raster of every parameter.
+
+    The bands of an environmental parameter stack use the checksums of the stack
+    manifest. Other rasters are stamped with the size and modification time of
+    their files (the files of the whole geodatabase for a raster in a file
+    geodatabase), and are only read (hashed) when they are compared with a
+    previous run and their stamp differs from it; without a previous run the
+    hash is left out.
+
+    Args:
+        env_dir: directory containing the environmental parameter rasters, or a stack directory
+        inParam: 2D list of model parameter names and associated raster dataset names
+        previous: optional rasters item of the sidecar of the previous table
+
+    Returns:
+        Dictionary of parameter name: {"stamp": file size and time, "sha1": content hash or None}.
+    """
+    hashes = {}
+    if envstack.isStack(env_dir):
+        stack = envstack.EnvStack(env_dir)
+        for band in stack.manifest["bands"]:
+            hashes[band["name"]] = {"stamp": None, "sha1": band["checksum"]}
+        return hashes
+    for p in inParam:
+        path = os.path.join(env_dir, p[1])
+        stamp = checkpoint.pathStamp(path)
+        prev = previous.get(p[0]) if previous is not None else None
+        if prev is not None and prev.get("stamp") == stamp:
+            hashes[p[0]] = prev
+        elif previous is None:
+            hashes[p[0]] = {"stamp": stamp, "sha1": None}
+        else:
+            hashes[p[0]] = {"stamp": stamp, "sha1": contentHash(path)}
+    return hashes
+
+
+def changedParams(hashes, previous, inParam):
+    """Returns the parameters whose raster content differs from a previous run.
+
+    A raster is unchanged if its stamp and hash are those of the previous run, or
+    if its content hash equals the previous one.
+
+    Args:
+        hashes: dictionary of parameter raster hashes of the current run (see rasterHashes)
+        previous: rasters item of the sidecar of the previous table
+        inParam: 2D list of model parameter names and associated raster dataset names
+
+    Returns:
+        changed: 2D list of the parameters to summarize again
+        unchanged: 2D list of the parameters whose values can be copied
+    """
+    changed = []
+    unchanged = []
+    for p in inParam:
+        prev = previous.get(p[0])
+        current = hashes[p[0]]
+        if prev == current or (prev is not None and prev.get("sha1") is not None and prev["sha1"] == current["sha1"]):
+            unchanged.append(p)
+        else:
+            changed.append(p)
+    return changed, unchanged
+
+
+def readSidecar(out_tbl):
+    """Reads the sidecar of an output table.
+
+    Returns:
+        Dictionary with the catchments and rasters items of the sidecar, or None
+        if the table has no sidecar.
+
+    Raises:
+        ValueError: the sidecar cannot be read, or was written with another sidecar version
+    """
+    path = sidecarPath(out_tbl)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            sidecar = json.load(f)
+    except ValueError:
+        raise ValueError("The sidecar file " + path + " of the previous parameter table cannot be read.")
+    if sidecar.get("version") != SIDECAR_VERSION:
+        raise ValueError("The sidecar file " + path + " of the previous parameter table has sidecar version " +
+                         str(sidecar.get("version")) + ", and this version of the tool reads version " +
+                         str(SIDECAR_VERSION) + ".")
+    return sidecar
+
+
+def writeSidecar(out_tbl, inParam, fingerprints, hashes):
+    """Writes the sidecar of an output table.
+
+    Args:
+        out_tbl: path of the output parameter table
+        inParam: 2D list of model parameter names and associated raster dataset names
+        fingerprints: dictionary of LineOID: geometry fingerprint (see geometryFingerprints)
+        hashes: dictionary of parameter raster hashes (see rasterHashes)
+    """
+    sidecar = {"version": SIDECAR_VERSION,
+               "table": os.path.basename(out_tbl),
+               "params": inParam,
+               "catchments": dict((str(k), v) for k, v in fingerprints.items()),
+               "rasters": dict((p[0], hashes[p[0]]) for p in inParam)}
+    with open(sidecarPath(out_tbl), "w") as f:
+        json.dump(sidecar, f, sort_keys=True)
+
+
+def removeSidecar(out_tbl):
+    """Deletes the sidecar of an output table, if any."""
+    path = sidecarPath(out_tbl)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def changedCatchments(fingerprints, previous):
+    """Compares the catchment geometries of a run with those of a previous run.
+
+    Args:
+        fingerprints: dictionary of LineOID: geometry fingerprint of the current catchments
+        previous: catchments item of the sidecar of the previous table
+
+    Returns:
+        added: list of LineOID values missing from the previous run
+        removed: list of LineOID values (as strings) missing from the current run
+        modified: list of LineOID values whose geometry changed
+    """
+    added = [k for k in fingerprints if str(k) not in previous]
+    modified = [k for k in fingerprints if str(k) in previous and previous[str(k)] != fingerprints[k]]
+    current = set(str(k) for k in fingerprints)
+    removed = [k for k in previous if k not in current]
+    return added, removed, modified
+
+
+def readValues(in_tbl, field_names):
+    """Returns a dictionary of LineOID: list of field values of a table, feature class or columnar table."""
+    if tablewriter.isColumnar(in_tbl):
+        columns = tablewriter.readColumnar(in_tbl, ["LineOID"] + field_names)
+        values = [columns[f].tolist() for f in field_names]
+        return dict((line_oid, [v[i] for v in values]) for i, line_oid in enumerate(columns["LineOID"].tolist()))
+    import arcpy
+    with arcpy.da.SearchCursor(in_tbl, ["LineOID"] + field_names) as cursor:
+        return dict((row[0], list(row[1:])) for row in cursor)
+
+
+def selectCatchments(in_fc, line_oids, out_fc):
+    """Copies the catchment polygons with the given LineOID values to a new feature class.
+
+    Args:
+        in_fc: catchment area polygon feature class
+        line_oids: list of LineOID values
+        out_fc: path of the feature class to write
+
+    Returns:
+        The path of the new feature class.
+    """
+    import arcpy
+    arcpy.MakeFeatureLayer_management(in_fc, "changed_lyr")
+    selection = "NEW_SELECTION"
+    for i in range(0, len(line_oids), SELECT_CHUNK):
+        chunk = line_oids[i:i + SELECT_CHUNK]
+        expr = """ "LineOID" IN ({0}) """.format(",".join(str(l) for l in chunk))
+        arcpy.SelectLayerByAttribute_management("changed_lyr", selection, expr)
+        selection = "ADD_TO_SELECTION"
+    arcpy.CopyFeatures_management("changed_lyr", out_fc)
+    arcpy.Delete_management("changed_lyr")
+    return out_fc
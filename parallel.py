@@ -0,0 +1,200 @@
+# file name:	parallel.py
+# description:	Process-pool execution of the array-based zonal statistics.  Catchment zones are partitioned into
+#               spatially coherent batches of similar size, and every batch is summarized by a worker process that
+#               reads the parameter raster (through arcpy) or memory-mapped stack band on its own.  Each zone
+#               belongs to exactly one batch, raster tiles are anchored to the window and their content does not
+#               depend on the zones read along with them, so the merged results are identical to a serial run.
+# dependencies: ESRI arcpy module, numpy
+
+import os
+import sys
+import math
+import multiprocessing
+import numpy as np
+import zonal
+
+# constants
+BATCHES_PER_WORKER = 4 # number of zone batches queued per worker process, to balance uneven batches
+
+
+def createPool(workers):
+    """Starts a pool of worker processes.
+
+    Inside ArcMap or ArcGIS Pro, sys.executable is the desktop application rather
+    than the Python interpreter, so the pool is pointed at the interpreter of the
+    running Python installation.
+
+    Args:
+        workers: number of worker processes
+
+    Returns:
+        multiprocessing.Pool instance.
+    """
+    if os.path.basename(sys.executable).lower() not in ("python.exe", "pythonw.exe", "python"):
+        interpreter = os.path.join(sys.exec_prefix, "python.exe")
+        if os.path.isfile(interpreter):
+            multiprocessing.set_executable(interpreter)
+    return multiprocessing.Pool(workers)
+
+
+def zoneBounds(zones, ncols):
+    """Returns the bounding box of the cells of every zone.
+
+    Args:
+        zones: zonal.ZoneSpans, or zonal.ZoneWeights for the SPARSE engine
+        ncols: number of columns of the grid of the zones
+
+    Returns:
+        r0, c0, r1, c1: arrays with the first and end (exclusive) rows and columns
+        of each zone (zero for empty zones)
+        cells: array with the number of cells of each zone
+    """
+    if isinstance(zones, zonal.ZoneWeights):
+        rows = zones.cells // ncols
+        starts = zones.cells % ncols
+        ends = starts + 1
+    else:
+        rows, starts, ends = zones.rows, zones.starts, zones.ends
+    bounds = [np.zeros(zones.nzones, dtype=np.int64) for _ in range(4)]
+    cells = np.bincount(zones.zones, ends - starts, minlength=zones.nzones)
+    if len(zones) == 0:
+        return bounds + [cells]
+    order = np.argsort(zones.zones, kind="mergesort")
+    sorted_zones = zones.zones[order]
+    first = np.nonzero(np.r_[True, sorted_zones[1:] != sorted_zones[:-1]])[0]
+    ids = sorted_zones[first]
+    bounds[0][ids] = np.minimum.reduceat(rows[order], first)
+    bounds[1][ids] = np.minimum.reduceat(starts[order], first)
+    bounds[2][ids] = np.maximum.reduceat(rows[order], first) + 1
+    bounds[3][ids] = np.maximum.reduceat(ends[order], first)
+    return bounds + [cells]
+
+
+def hilbertIndex(x, y, order):
+    """Returns the distance of integer cell coordinates along a Hilbert curve.
+
+    Args:
+        x, y: integer arrays of coordinates, between 0 and 2 ** order - 1
+        order: order of the curve
+
+    Returns:
+        int64 array of distances along the curve.
+    """
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = 1 << (order - 1) if order > 0 else 0
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x[flip] = s - 1 - x[flip]
+        y[flip] = s - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return d
+
+
+def partitionZones(zones, grid, nbatches):
+    """Partitions zones into spatially coherent batches with similar numbers of cells.
+
+    The bounding box centers of the zones are ordered along a Hilbert curve over
+    the window, and the ordered zones are cut into runs of similar cell counts.
+    Neighbouring catchments therefore share a batch, and a worker re-reads as few
+    of the raster tiles read by the other workers as possible.
+
+    Args:
+        zones: zonal.ZoneSpans, or zonal.ZoneWeights for the SPARSE engine
+        grid: zonal.RasterGrid window of the zones
+        nbatches: number of batches
+
+    Returns:
+        List of arrays of zone indices, in curve order. Zones without cells are left out.
+    """
+    r0, c0, r1, c1, cells = zoneBounds(zones, grid.ncols)
+    used = np.nonzero(cells > 0)[0]
+    if len(used) == 0:
+        return []
+    order = int(math.ceil(math.log(max(grid.nrows, grid.ncols, 2), 2)))
+    curve = hilbertIndex((c0[used] + c1[used]) // 2, (r0[used] + r1[used]) // 2, order)
+    ordered = used[np.argsort(curve, kind="mergesort")]
+    cum = np.cumsum(cells[ordered])
+    batch = np.minimum((cum - cells[ordered]) * nbatches // cum[-1], nbatches - 1).astype(np.int64)
+    return [ordered[batch == b] for b in np.unique(batch)]
+
+
+def batchZones(zones, ids):
+    """Returns the spans (or weights) of a batch of zones, keeping their zone indices."""
+    member = np.zeros(zones.nzones, dtype=bool)
+    member[ids] = True
+    return zones.subset(member[zones.zones])
+
+
+def batchZoneSums(task):
+    """Worker function summarizing one batch of zones (see zonal.streamZoneSums).
+
+    Args:
+        task: (source, grid, zones, ids, engine, memory_mb, with_stats) tuple, where
+        zones holds only the spans (or weights) of the zone indices in ids, and
+        with_stats requests zonal.ZoneStats of the batch
+
+    Returns:
+        ids: array of zone indices of the batch
+        sums: array with the sum of valid cell values of each zone in ids
+        counts: array with the number (or weight) of valid cells of each zone in ids
+        tile_keys: set of (row, column) tuples of the first cell of every tile read
+        stats: dictionary returned by zonal.ZoneStats.subset for the zones in ids, or None
+    """
+    source, grid, zones, ids, engine, memory_mb, with_stats = task
+    tile_keys = set()
+    stats = zonal.ZoneStats(zones.nzones) if with_stats else None
+    sums, counts, tiles = zonal.streamZoneSums(source, grid, zones, engine, memory_mb, tile_keys, stats)
+    return ids, sums[ids], counts[ids], tile_keys, stats.subset(ids) if with_stats else None
+
+
+def parallelZoneSums(pool, source, grid, zones, batches, engine, memory_mb=zonal.MEMORY_MB, callback=None,
+                     stats=None):
+    """Sums the valid cells of a raster per zone with a pool of worker processes.
+
+    Args:
+        pool: multiprocessing.Pool returned by createPool, or None to summarize the
+        batches one after the other in this process
+        source: zonal.RasterSource or envstack.StackBand to read
+        grid: zonal.RasterGrid window of the zones
+        zones: zonal.ZoneSpans, or zonal.ZoneWeights for the SPARSE engine
+        batches: list of arrays of zone indices returned by partitionZones
+        engine: VECTORIZED, PREFIX_SUM or SPARSE
+        memory_mb: memory budget for a tile of each worker, in megabytes
+        callback: optional function called with the ids, sums, counts and statistics
+        (or None) of each batch as soon as it is summarized
+        stats: optional zonal.ZoneStats, updated with the statistics calculated by the workers
+
+    Returns:
+        sums: array with the sum of valid cell values per zone
+        counts: array with the number (or weight) of valid cells per zone
+        tiles: number of tiles read by all workers
+        rereads: number of tiles read more than once, by different workers
+    """
+    # the spatial reference does not pickle and is not needed to read the window
+    worker_grid = zonal.RasterGrid(grid.x_min, grid.y_max, grid.cell_w, grid.cell_h, grid.nrows, grid.ncols,
+                                   None, grid.row_off, grid.col_off)
+    sums = np.zeros(zones.nzones)
+    counts = np.zeros(zones.nzones, dtype=np.float64 if engine == "SPARSE" else np.int64)
+    tiles = 0
+    distinct = set()
+    tasks = ((source, worker_grid, batchZones(zones, ids), ids, engine, memory_mb, stats is not None)
+             for ids in batches)
+    results = pool.imap(batchZoneSums, tasks) if pool is not None else (batchZoneSums(task) for task in tasks)
+    for ids, batch_sums, batch_counts, tile_keys, batch_stats in results:
+        sums[ids] = batch_sums
+        counts[ids] = batch_counts
+        if stats is not None:
+            stats.assign(ids, batch_stats)
+        tiles += len(tile_keys)
+        distinct.update(tile_keys)
+        if callback is not None:
+            callback(ids, batch_sums, batch_counts, batch_stats)
+    return sums, counts, tiles, tiles - len(distinct)
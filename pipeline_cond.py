@@ -0,0 +1,186 @@
+# file name:	pipeline_cond.py
+# description:	This tool runs the Pre-process Environmental Parameters and Predict Conductivity tools as one
+#               pipeline.  The summarized parameter values are handed from the zonal statistics step to the Random
+#               Forest prediction and the join as in-memory columns, so no parameter table or prediction table is
+#               written to disk unless an intermediate parameter table is requested.  The generic metadata XML of
+#               both steps is written, and both steps are recorded in the Riverscapes project realization.
+# dependencies: ESRI arcpy module, Spatial Analyst extension
+
+import os
+import sys
+import time
+import gc
+import tempfile
+import arcpy
+import metadata.meta_sfr as meta_sfr
+import metadata.meta_rs as meta_rs
+import riverscapes as rs
+import forest
+import polystat_cond
+import predict_cond
+import tablewriter
+import zonal
+
+arcpy.env.overwriteOutput = True
+
+# input variables
+calc_ply = arcpy.GetParameterAsText(0) # polygon feature class (i.e. catchments)
+env_dir = arcpy.GetParameterAsText(1) # directory containing the conductivity model raster inputs
+in_fc = arcpy.GetParameterAsText(2) # stream network polyline feature class (i.e. segments)
+out_fc = arcpy.GetParameterAsText(3) # stream network polyline feature class, with predicted conductivity
+rs_bool = arcpy.GetParameterAsText(4) # boolean parameter to indicate if Riverscapes project outputs are required
+rs_dir = arcpy.GetParameterAsText(5) # directory where Riverscapes project files will be written
+rs_proj_name = arcpy.GetParameterAsText(6) # Riverscapes project name
+rs_real_name = arcpy.GetParameterAsText(7) # Riverscapes realization name
+zonal_engine = arcpy.GetParameterAsText(8) # zonal statistics engine used to summarize the parameter rasters
+nested_bool = arcpy.GetParameterAsText(9) # boolean parameter to accumulate nested catchments from incremental areas
+cache_dir = arcpy.GetParameterAsText(10) # directory of the rasterized catchment footprint cache
+memory_mb = arcpy.GetParameterAsText(11) # memory budget for streaming raster tiles, in megabytes
+workers = arcpy.GetParameterAsText(12) # number of worker processes used by the array-based engines
+out_tbl = arcpy.GetParameterAsText(13) # optional intermediate environmental parameter table
+chunk_rows = arcpy.GetParameterAsText(14) # number of parameter table rows predicted at once
+pred_cache_dir = arcpy.GetParameterAsText(15) # folder of the prediction cache
+
+# constants
+RS_PARAM_TABLE = "cond_params" + tablewriter.COLUMNAR_EXT # parameter table of a realization without out_tbl
+
+
+def writeParamTable(out_tbl, line_oids, columns, field_names):
+    """Writes the summarized parameter values to a parameter table.
+
+    Returns:
+        The number of rows written.
+    """
+    writer = tablewriter.openTableWriter(out_tbl, field_names)
+    writer.writeColumns(line_oids, columns)
+    writer.close()
+    return writer.rows
+
+
+def main(calc_ply, env_dir, in_fc, out_fc, rs_bool, rs_dir='', proj_name='', real_name='',
+         engine="ZONAL_STATISTICS", nested_bool="false", cache_dir='', memory_mb='', workers='', out_tbl='',
+         chunk_rows='', pred_cache_dir=''):
+    """Main processing function for the Pre-process and Predict Conductivity tool.
+
+    Args:
+        calc_ply: Input upstream catchment area polygon feature class, with a LineOID field
+        env_dir: Directory containing the environmental parameter rasters, or an environmental parameter stack
+        in_fc: Input stream network polyline feature class, with a LineOID field
+        out_fc: Output stream network polyline feature class, with predicted conductivity values
+        out_tbl: optional path of an intermediate environmental parameter table to write
+        chunk_rows: number of parameter table rows predicted at once
+        pred_cache_dir: folder of the prediction cache (a folder in the temporary folder by default)
+    """
+
+    if engine not in polystat_cond.ENGINE_LIST:
+        engine = "ZONAL_STATISTICS"
+    memory_mb = float(memory_mb) if memory_mb else zonal.MEMORY_MB
+    workers = max(int(workers), 1) if workers else 1
+    chunk_rows = max(int(chunk_rows), 1) if chunk_rows else forest.TABLE_CHUNK_ROWS
+    pred_cache_dir = pred_cache_dir or os.path.join(tempfile.gettempdir(), predict_cond.CACHE_FOLDER)
+
+    calc_ply_name = os.path.basename(calc_ply)
+    in_fc_name = os.path.basename(in_fc)
+    out_dir = os.path.dirname(out_fc)
+    out_fc_name = os.path.basename(out_fc)
+    if arcpy.Describe(os.path.dirname(in_fc)).workspaceType == "LocalDatabase":
+        in_shp_name = in_fc_name + ".shp"
+    else:
+        in_shp_name = in_fc_name
+
+    # initiate generic metadata XML objects of both steps
+    time_stamp = time.strftime("%Y%m%d%H%M")
+    poly_xml = os.path.join(out_dir, "{0}_{1}.{2}".format("meta_preprocess", time_stamp, "xml"))
+    pred_xml = os.path.join(out_dir, "{0}_{1}.{2}".format("meta_predict", time_stamp, "xml"))
+    polyWriter = meta_sfr.MetadataWriter("Pre-process Environmental Parameters", "0.4")
+    polyWriter.createRun()
+    polyWriter.currentRun.addParameter("Catchment area feature class", calc_ply)
+    polyWriter.currentRun.addParameter("Output environmental parameter table", out_tbl or "in_memory")
+    polyWriter.currentRun.addParameter("Environmental parameter workspace", env_dir)
+    polyWriter.currentRun.addParameter("Zonal statistics engine", engine)
+    polyWriter.currentRun.addParameter("Nested catchment accumulation", nested_bool)
+    if cache_dir:
+        polyWriter.currentRun.addParameter("Catchment footprint cache", cache_dir)
+    if engine != "ZONAL_STATISTICS":
+        polyWriter.currentRun.addParameter("Memory budget (MB)", str(memory_mb))
+        polyWriter.currentRun.addParameter("Worker processes", str(workers))
+    polyWriter.currentRun.addParameter("Output metadata XML", poly_xml)
+
+    if polystat_cond.checkLineOID(calc_ply) != True or predict_cond.checkLineOID(in_fc) != True:
+        arcpy.AddError("The LineOID attribute field is missing! Cancelling process...")
+        sys.exit(0) # terminate process
+    gc.enable()
+
+    if rs_bool == "true":
+        rs_xml = "{0}\\{1}".format(rs_dir, "project.rs.xml")
+        projectXML = meta_rs.ProjectXML("existing", rs_xml, "EC", proj_name)
+
+    # summarize the environmental parameters per catchment, kept in memory as columns
+    field_names = [p[0] for p in polystat_cond.PARAM_LIST]
+    # the pipeline does not resume, so it runs without a checkpoint
+    line_oids, columns = polystat_cond.summarizeParams(calc_ply, env_dir, polystat_cond.PARAM_LIST, None, engine,
+                                                       nested_bool, cache_dir, memory_mb, workers, "false",
+                                                       polyWriter)[:2]
+    polyWriter.currentRun.addResult("ParamTableRows", str(len(line_oids)))
+    if out_tbl:
+        arcpy.AddMessage("Writing the intermediate parameter table " + out_tbl)
+        writeParamTable(out_tbl, line_oids, columns, field_names)
+    polyWriter.finalizeRun("Success")
+    polyWriter.writeMetadataFile(poly_xml)
+
+    # record the Pre-process step in a new realization of the Riverscapes project
+    if rs_bool == "true":
+        arcpy.AddMessage("Exporting as a Riverscapes project...")
+        real_id = rs.getRealID(time_stamp)
+        tbl_name = os.path.basename(out_tbl) if out_tbl else RS_PARAM_TABLE
+        abs_ply_path = os.path.join(rs.getRSDirAbs(rs_dir, 1, 0, real_id), calc_ply_name)
+        abs_tbl_path = os.path.join(rs.getRSDirAbs(rs_dir, 1, 1, real_id), tbl_name)
+        rs.writeRealDir(rs_dir, real_id)
+        rs.copyRSFiles(calc_ply, abs_ply_path)
+        if out_tbl:
+            rs.copyRSFiles(out_tbl, abs_tbl_path)
+        else:
+            writeParamTable(abs_tbl_path, line_oids, columns, field_names)
+        rel_ply_path = os.path.join(rs.getRSDirRel(1, 0, real_id), calc_ply_name)
+        rel_tbl_path = os.path.join(rs.getRSDirRel(1, 1, real_id), tbl_name)
+        polystat_cond.metadata(projectXML, rel_ply_path, env_dir, rel_tbl_path, rs_bool, real_name, real_id)
+        # the Predict step reads the realization written by the Pre-process step
+        projectXML = meta_rs.ProjectXML("existing", rs_xml)
+
+    predWriter = meta_sfr.MetadataWriter("Predict Conductivity", "0.4")
+    predWriter.createRun()
+    predWriter.currentRun.addParameter("Stream network polyline feature class", in_fc)
+    predWriter.currentRun.addParameter("Environmental parameter table", out_tbl or "in_memory")
+    predWriter.currentRun.addParameter("Predicted conductivity feature class", out_fc)
+    predWriter.currentRun.addParameter("Output metadata XML", pred_xml)
+    predWriter.currentRun.addParameter("Prediction chunk size (rows)", str(chunk_rows))
+    predWriter.currentRun.addParameter("Prediction cache", pred_cache_dir)
+
+    # predict from the in-memory columns and join the predictions to the stream network
+    params = dict(columns)
+    params["LineOID"] = line_oids
+    line_oids, prdCond = predict_cond.predictParams(params, predWriter, chunk_rows, pred_cache_dir)
+    del params, columns
+    predict_cond.writePredictions(in_fc, line_oids, prdCond, out_fc, predWriter)
+    predWriter.finalizeRun("Success")
+    predWriter.writeMetadataFile(pred_xml)
+
+    # record the Predict step in the same realization
+    if rs_bool == "true":
+        abs_fc_path = os.path.join(rs.getRSDirAbs(rs_dir, 1, 0, real_id), in_fc_name)
+        abs_out_path = os.path.join(rs.getRSDirAbs(rs_dir, 1, 2, real_id), out_fc_name)
+        rs.copyRSFiles(in_fc, abs_fc_path)
+        rs.copyRSFiles(out_fc, abs_out_path)
+        rel_fc_path = os.path.join(rs.getRSDirRel(1, 0, real_id), in_shp_name)
+        rel_out_path = os.path.join(rs.getRSDirRel(1, 2, real_id), out_fc_name)
+        predict_cond.metadata(projectXML, rel_fc_path, rel_out_path, real_id)
+
+    # clean up
+    predict_cond.clear_inmemory()
+    arcpy.AddMessage("Conductivity pre-process and prediction pipeline complete!")
+    return
+
+
+if __name__ == "__main__":
+    main(calc_ply, env_dir, in_fc, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name, zonal_engine, nested_bool,
+         cache_dir, memory_mb, workers, out_tbl, chunk_rows, pred_cache_dir)
@@ -9,24 +9,30 @@
 # version:		0.5.5
 
 import gc, sys, arcpy
+import numpy as np
+import math
 import os
+import shutil
+import tempfile
 import time
 from arcpy.sa import *
 from time import strftime
 import metadata.meta_sfr as meta_sfr
 import metadata.meta_rs as meta_rs
 import riverscapes as rs
+import checkpoint
+import envstack
+import incremental
+import parallel
+import pyramid
+import rasterize
+import sampling
+import tablewriter
+import zonal
 
 version = "1.0.0"
 
-# start processing time
-startTime = time.time()
-printTime = strftime("%a, %d %b %Y %H:%M:%S")
-arcpy.AddMessage("Processing started at " + str(printTime))
-arcpy.AddMessage("------------------------------------")
-
 arcpy.env.overwriteOutput = True
-arcpy.CheckOutExtension("Spatial")
 
 # input variables:
 calc_ply = arcpy.GetParameterAsText(0) # polygon feature class (i.e. catchments)
@@ -36,6 +42,15 @@ rs_bool = arcpy.GetParameterAsText(3) # boolean parameter to indicate if Riversc
 rs_dir = arcpy.GetParameterAsText(4) # directory where Riverscapes project files will be written
 rs_proj_name = arcpy.GetParameterAsText(5) # Riverscapes project name
 rs_real_name = arcpy.GetParameterAsText(6) # Riverscapes realization name
+zonal_engine = arcpy.GetParameterAsText(7) # zonal statistics engine used to summarize the parameter rasters
+nested_bool = arcpy.GetParameterAsText(8) # boolean parameter to accumulate nested catchments from incremental areas
+cache_dir = arcpy.GetParameterAsText(9) # directory of the rasterized catchment footprint cache
+memory_mb = arcpy.GetParameterAsText(10) # memory budget for streaming raster tiles, in megabytes
+workers = arcpy.GetParameterAsText(11) # number of worker processes used by the array-based engines
+resume_bool = arcpy.GetParameterAsText(12) # boolean parameter to resume an interrupted run from its checkpoint
+prev_tbl = arcpy.GetParameterAsText(13) # previous parameter table, to only summarize added or modified catchments
+stat_list = arcpy.GetParameterAsText(14) # extra statistics per catchment and parameter, separated by semicolons
+preview_tol = arcpy.GetParameterAsText(15) # relative error tolerance of the sampled preview mode (blank: exact)
 
 
 # constants
@@ -58,6 +73,27 @@ PARAM_LIST= [["AtmCa", "ca_avg_250"], # list of model parameter names and associ
             ["PRMH_AVE", "permh_usgs"],
             ["S_Mean", "s_23aug10"],
             ["UCS_Mean", "ucs_19jan10"]]
+ENGINE_LIST = ["ZONAL_STATISTICS", # one ZonalStatisticsAsTable call per catchment polygon and parameter
+               "VECTORIZED", # all catchments summarized in a single numpy pass per parameter raster
+               "PREFIX_SUM", # catchments summarized as row spans over per-row cumulative sums of each raster
+               "SPARSE", # catchments summarized as sparse weights on the native cells of each raster
+               "PYRAMID"] # catchments summarized from cached sum/count pyramids, with cells only along their edges
+ZONE_CELL_SIZE = 30 # cell size used to rasterize catchment polygons for rasters with coarser cells
+STAT_LIST = ["COUNT", # number of valid (non-NoData) cells
+             "NODATA_FRACTION", # fraction of the catchment cells that are NoData
+             "MIN", # minimum valid cell value
+             "MAX", # maximum valid cell value
+             "STD"] # population standard deviation of the valid cell values
+STAT_FIELDS = {"COUNT": "COUNT", # statistics table field name of each statistic
+               "NODATA_FRACTION": "NODATA_FR",
+               "MIN": "MIN",
+               "MAX": "MAX",
+               "STD": "STD",
+               "CI_HALF": "CI_HALF", # half-width of the 95% confidence interval of a preview mean
+               "SAMPLES": "SAMPLES"} # number of cells read for a preview mean
+PREVIEW_STATS = ["CI_HALF", "SAMPLES"] # statistics written to the statistics table in preview mode
+APPROX_FIELD = "APPROX" # parameter table field set to 1 for catchments with estimated (preview) values
+CHECKPOINT_ZONES = 2000 # number of catchments summarized between checkpoint records in a single-process run
 
 
 def checkLineOID(in_fc):
@@ -108,7 +144,32 @@ def addParamFields(in_fc, inParam):
     return tmpFC
 
 
-def calcParams(in_fc, env_dir, inParam):
+def zstatValues(zstat_table, stat_names, zone_cells):
+    """Reads the extra statistics of a zone from a ZonalStatisticsAsTable output
+    calculated with the ALL statistics type.
+
+    Args:
+        zstat_table: zonal statistics table of a single zone
+        stat_names: list of extra statistics (see STAT_LIST)
+        zone_cells: number of cells of the zone, including NoData cells
+
+    Returns:
+        List of statistics values, in the order of stat_names.
+    """
+    row = None
+    with arcpy.da.SearchCursor(zstat_table, ["COUNT", "MIN", "MAX", "STD"]) as cursor:
+        for row in cursor:
+            break
+    count, vmin, vmax, std = row if row is not None else (0, float("nan"), float("nan"), float("nan"))
+    values = {"COUNT": count,
+              "NODATA_FRACTION": 1.0 - float(count) / zone_cells if zone_cells else float("nan"),
+              "MIN": vmin,
+              "MAX": vmax,
+              "STD": std}
+    return [values[name] for name in stat_names]
+
+
+def calcParams(in_fc, env_dir, inParam, stat_names=None, zone_stats=None, ckpt=None):
     """Build attribute table os summarized parameter values for the input
     feature class.
 
@@ -116,6 +177,16 @@ def calcParams(in_fc, env_dir, inParam):
         in_fc: Input upstream catchment area polygon feature class
         inParam: 2D list of model parameter names and associated raster
         dataset names
+        stat_names: optional list of extra statistics (see STAT_LIST); the
+        zonal statistics are then calculated with the ALL statistics type, in
+        the same raster pass as the mean
+        zone_stats: dictionary filled with (LineOID, parameter name): list of the
+        extra statistics values; required with stat_names
+        ckpt: optional checkpoint.Checkpoint of the run. The means of all
+        parameters are appended to it and flushed to disk together as soon as a
+        polygon is complete (as a sum with a count of 1, or a count of 0 for a
+        polygon without valid cells), and polygons already found in the
+        checkpoint are not summarized again.
 
     Returns:
         An in-memory polygon feature class, with summarized parameter values
@@ -124,8 +195,14 @@ def calcParams(in_fc, env_dir, inParam):
     """
     arcpy.AddMessage("Summarizing parameter values per catchment area polygon...")
     gc.enable()
+    # the layer is returned even if every polygon is restored from the checkpoint
+    arcpy.MakeFeatureLayer_management(in_fc, "tmpFC")
+    restored = set()
     with arcpy.da.SearchCursor(in_fc, ["LineOID"]) as cursor:
         for row in cursor:
+            if ckpt is not None and all(row[0] in ckpt.done(r[0]) for r in inParam):
+                restored.add(row[0])
+                continue
             expr = """ "LineOID" = """ + str(row[0])
             arcpy.MakeFeatureLayer_management(in_fc, "tmpFC")
             arcpy.SelectLayerByAttribute_management("tmpFC", "NEW_SELECTION", expr)
@@ -134,22 +211,452 @@ def calcParams(in_fc, env_dir, inParam):
             arcpy.AddField_management(ras_record, "LineOID", "LONG")
             arcpy.CalculateField_management(ras_record, "LineOID", "!Value!", "PYTHON_9.3")
             arcpy.CalculateStatistics_management(ras_record)
+            if stat_names:
+                with arcpy.da.SearchCursor(ras_record, ["Count"]) as ras_cursor:
+                    zone_cells = sum(ras_row[0] for ras_row in ras_cursor)
+            polygon_means = {}
             for r in inParam:
                 field_name = r[0]
                 ras_name = env_dir + "\\" + r[1]
                 zstat_result = "in_memory\\zstat_result"
-                ZonalStatisticsAsTable(ras_record, "LineOID", ras_name, zstat_result, "DATA", "MEAN")
+                ZonalStatisticsAsTable(ras_record, "LineOID", ras_name, zstat_result, "DATA",
+                                       "ALL" if stat_names else "MEAN")
+                if stat_names:
+                    zone_stats[(row[0], field_name)] = zstatValues(zstat_result, stat_names, zone_cells)
+                with arcpy.da.SearchCursor(zstat_result, ["MEAN"]) as zstat_cursor:
+                    polygon_means[field_name] = [zstat_row[0] for zstat_row in zstat_cursor]
                 arcpy.AddJoin_management("tmpFC", "LineOID", zstat_result, "LineOID", "KEEP_ALL")
                 arcpy.CalculateField_management("tmpFC", field_name, "!zstat_result.MEAN!", "PYTHON_9.3")
                 arcpy.RemoveJoin_management("tmpFC")
                 arcpy.Delete_management(zstat_result)
                 arcpy.AddMessage("Parameter " + field_name + " is summarized...")
+            if ckpt is not None:
+                for r in inParam:
+                    mean = polygon_means[r[0]][0] if polygon_means[r[0]] else None
+                    stats = None
+                    if stat_names:
+                        stats = dict((name, [value]) for name, value in zip(stat_names, zone_stats[(row[0], r[0])]))
+                    ckpt.append(r[0], [row[0]], [mean or 0.0], [0 if mean is None else 1], stats, sync=False)
+                ckpt.sync()
             arcpy.AddMessage("Polygon with LineOID " + str(row[0]) + " is complete...")
     arcpy.SelectLayerByAttribute_management("tmpFC", "CLEAR_SELECTION")
+    if restored:
+        arcpy.AddMessage("Polygons restored from the checkpoint: {0}".format(len(restored)))
+        field_names = [r[0] for r in inParam]
+        with arcpy.da.UpdateCursor(in_fc, ["LineOID"] + field_names) as cursor:
+            for row in cursor:
+                if row[0] not in restored:
+                    continue
+                done = [ckpt.done(name)[row[0]] for name in field_names]
+                cursor.updateRow([row[0]] + [d[0] if d[1] else None for d in done])
+                if stat_names:
+                    for name, d in zip(field_names, done):
+                        values = dict(zip(sorted(stat_names), d[2]))
+                        zone_stats[(row[0], name)] = [values[s] for s in stat_names]
     gc.disable()
     return "tmpFC"
 
 
+def buildZones(edges, source, grid, nested, engine, cache=None):
+    """Burns the catchment polygons into zones on the cell grid of a parameter raster.
+
+    Args:
+        edges: rasterize.CatchmentEdges in the raster's coordinate system
+        source: zonal.RasterSource or envstack.StackBand of the parameter raster
+        grid: zonal.RasterGrid window of the parameter raster
+        nested: decompose nested catchments into incremental areas
+        engine: array-based zonal statistics engine
+        cache: optional rasterize.SpanCache of catchment footprints
+
+    Returns:
+        zones: zonal.ZoneSpans, or zonal.ZoneWeights for the SPARSE engine
+        parent: array of parent zone indices, or None if not nested
+        order: array of zone indices with children before parents, or None if not nested
+    """
+    zone_grid = grid
+    if engine == "SPARSE":
+        if cache is not None:
+            weights_path = cache.weightsPath(edges, grid, ZONE_CELL_SIZE, nested)
+            if os.path.isfile(weights_path):
+                return zonal.ZoneWeights.load(weights_path)
+        if grid.cell_w > ZONE_CELL_SIZE or grid.cell_h > ZONE_CELL_SIZE:
+            zone_grid = source.window(edges.bounds(), ZONE_CELL_SIZE)
+    if cache is not None:
+        spans = rasterize.burnZonesCached(edges, zone_grid, cache)
+    else:
+        spans = rasterize.burnZones(edges, zone_grid)
+    parent = order = None
+    if nested:
+        try:
+            spans, parent, order = zonal.nestZones(spans, zone_grid.ncols)
+        except ValueError as e:
+            arcpy.AddError(str(e))
+            sys.exit(1) # terminate process
+    if engine == "SPARSE":
+        weights = zonal.zoneWeights(spans, zone_grid, grid)
+        if cache is not None:
+            weights.save(weights_path, parent, order)
+        return weights, parent, order
+    return spans, parent, order
+
+
+def calcParamsVectorized(in_fc, env_dir, inParam, nested=False, engine="VECTORIZED", cache=None,
+                         memory_mb=zonal.MEMORY_MB, run_stats=None, workers=1, ckpt=None, stat_names=None,
+                         zone_stats=None, pyramid_dir=None):
+    """Summarize parameter values for the catchment polygons of the input
+    feature class, reading each parameter raster only once.
+
+    All catchment polygons are burned together into row spans of raster cells
+    (CELL_CENTER rule) by the batch rasterizer, and the mean of each raster is
+    calculated for all polygons in a single vectorized pass. Rasters that share
+    the same cell grid reuse the burned spans.
+
+    The polygons are burned on the native cell grid of each raster (SPARSE uses
+    ZONE_CELL_SIZE zones on coarser rasters), while the ZONAL_STATISTICS engine
+    burns each polygon at 30 m and summarizes it at the largest cell size of its
+    inputs, so means can differ slightly from that engine along catchment edges.
+
+    In nested mode, the upstream catchment areas are decomposed into non-overlapping
+    incremental areas. Cell sums and counts are calculated once per incremental
+    area and accumulated down the drainage topology, so every raster cell is read
+    once no matter how many catchments it drains to.
+
+    With the PREFIX_SUM engine, per-row cumulative sums and valid-cell counts of
+    each raster are calculated once, and each row span of a polygon is evaluated
+    with two lookups, so a polygon costs the number of rows it crosses instead of
+    the number of cells it covers.
+
+    With the SPARSE engine, catchments are rasterized at ZONE_CELL_SIZE and turned
+    into a sparse matrix of weights on the native cells of each raster grid, so
+    each parameter mean is a sparse matrix-vector product at the raster's own
+    resolution. With a footprint cache, the matrices are saved and reused by later
+    runs on the same catchments and raster grid.
+
+    If a footprint cache is supplied, polygons rasterized on an earlier run with
+    the same geometry and cell grid are read from the cache instead.
+
+    Rasters are streamed in square tiles sized to the memory budget, clipped to
+    the union extent of the catchments, and tiles without any catchment cells are
+    skipped, so peak memory stays flat regardless of raster size.
+
+    If env_dir is an environmental parameter stack (see envstack.py), all
+    parameters share one cell grid and only the stack chunks intersected by the
+    catchments are read from the memory-mapped stack.
+
+    With more than one worker, the catchments are ordered along a Hilbert curve
+    through their bounding box centers and cut into spatially coherent batches,
+    so neighbouring catchments reuse the same raster tiles. The batches are
+    summarized by a pool of worker processes, each reading the rasters (through
+    arcpy) or the memory-mapped stack on its own. Every catchment belongs to
+    exactly one batch and raster tiles are anchored to the window, so the
+    results are identical to a serial run. The pool is shut down when the run
+    ends or fails.
+
+    If a checkpoint is supplied, the cell sums and counts of each parameter are
+    appended to it as soon as they are calculated, and catchments already found
+    in the checkpoint are not summarized again. Records are appended per worker
+    batch when running in parallel; a single-process run summarizes the
+    catchments in Hilbert curve batches of about CHECKPOINT_ZONES catchments and
+    appends a record per batch, at the cost of reading the raster tiles shared by
+    two batches twice. The PYRAMID engine appends one record per parameter.
+
+    Extra statistics (valid cell count, NoData fraction, minimum, maximum and
+    standard deviation) are accumulated tile by tile with streaming updates from
+    the same raster reads as the means, and merged down the drainage topology
+    in nested mode.
+
+    With the PYRAMID engine, the tiles of the sum/count pyramid of each raster
+    that the catchments reach are built once (or opened from pyramid_dir, shared
+    by all catchment extents) and the cells of each catchment are looked
+    up as the largest aligned blocks it fully covers, plus single cells along its
+    edge (see pyramid.pyramidZoneSums). The means are exact. Extra statistics
+    cannot be derived from sums and counts, so with extra statistics the rasters
+    are streamed like with the VECTORIZED engine.
+
+    Args:
+        in_fc: Input upstream catchment area polygon feature class, with a
+        LineOID field (the geometry is read directly, not copied)
+        env_dir: Directory containing the environmental parameter rasters, or an
+        environmental parameter stack directory
+        inParam: 2D list of model parameter names and associated raster
+        dataset names
+        nested: accumulate nested catchments from their incremental areas
+        engine: array-based zonal statistics engine (VECTORIZED, PREFIX_SUM, SPARSE or PYRAMID)
+        cache: optional rasterize.SpanCache of catchment footprints
+        memory_mb: memory budget for a raster tile, in megabytes
+        run_stats: optional dictionary; the number of raster tiles read is added
+        to its "tiles" item, the number of tiles read again by another worker
+        to its "rereads" item, and the number of pyramid lookups to its "lookups" item
+        workers: number of worker processes
+        ckpt: optional checkpoint.Checkpoint of the run
+        stat_names: optional list of extra statistics (see STAT_LIST) calculated
+        from the same raster reads
+        zone_stats: dictionary filled with (LineOID, parameter name): list of the
+        extra statistics values; required with stat_names
+        pyramid_dir: directory of the cached sum/count pyramids; required with the PYRAMID engine
+
+    Returns:
+        line_oids: list of the LineOID values of the catchments, in cursor order
+        columns: dictionary of parameter name: array of mean values aligned with
+        line_oids (NaN where a catchment has no valid cells)
+    """
+    arcpy.AddMessage("Summarizing parameter values per catchment area polygon (vectorized)...")
+    stack = envstack.EnvStack(env_dir) if envstack.isStack(env_dir) else None
+    catchments = {}
+    zone_sets = {}
+    means = {}
+    use_pyramid = engine == "PYRAMID" and not stat_names
+    pool = parallel.createPool(workers) if workers > 1 and not use_pyramid else None
+    batch_sets = {}
+    with arcpy.da.SearchCursor(in_fc, ["OID@", "LineOID"]) as cursor:
+        oid_lines = [(row[0], row[1]) for row in cursor]
+    line_oids = dict(oid_lines)
+    try:
+        for r in inParam:
+            field_name = r[0]
+            if stack is not None:
+                source = stack.band(field_name)
+            else:
+                source = zonal.RasterSource(env_dir + "\\" + r[1])
+            sr = source.spatialReference()
+            if sr.name not in catchments:
+                catchments[sr.name] = rasterize.readCatchmentEdges(in_fc, sr)
+            edges = catchments[sr.name]
+            if len(edges.zones) == 0:
+                # no catchment has a geometry, so there is nothing to read
+                means[field_name] = {}
+                arcpy.AddMessage("Parameter " + field_name + " is summarized...")
+                continue
+            grid = source.window(edges.bounds())
+            key = (sr.name,) + grid.key()
+            if key not in zone_sets:
+                zone_sets[key] = buildZones(edges, source, grid, nested, engine, cache)
+            zones, parent, order = zone_sets[key]
+            zone_lines = [line_oids[oid] for oid in edges.oids]
+            stats = zonal.ZoneStats(zones.nzones) if stat_names else None
+            if ckpt is not None:
+                done = ckpt.done(field_name)
+                todo = np.array([line_oid not in done for line_oid in zone_lines], dtype=bool)
+            else:
+                todo = np.ones(len(edges.oids), dtype=bool)
+            todo_zones = zones if todo.all() else parallel.batchZones(zones, np.nonzero(todo)[0])
+            if not todo.any():
+                sums = np.zeros(zones.nzones)
+                counts = np.zeros(zones.nzones, dtype=np.float64 if engine == "SPARSE" else np.int64)
+                tiles = rereads = 0
+            elif pool is not None or (ckpt is not None and not use_pyramid):
+                # worker batches, or batches committed to the checkpoint one at a time
+                if pool is not None:
+                    nbatches = workers * parallel.BATCHES_PER_WORKER
+                else:
+                    nbatches = max(int(math.ceil(np.count_nonzero(todo) / float(CHECKPOINT_ZONES))), 1)
+                if todo.all():
+                    if key not in batch_sets:
+                        batch_sets[key] = parallel.partitionZones(zones, grid, nbatches)
+                    batches = batch_sets[key]
+                else:
+                    batches = parallel.partitionZones(todo_zones, grid, nbatches)
+                commit = None
+                if ckpt is not None:
+                    commit = lambda ids, s, c, st: ckpt.append(field_name, [zone_lines[i] for i in ids], s, c, st)
+                sums, counts, tiles, rereads = parallel.parallelZoneSums(pool, source, grid, todo_zones, batches,
+                                                                         engine, memory_mb, commit, stats)
+                if ckpt is not None:
+                    # catchments without any cells are not part of a batch
+                    empty = np.setdiff1d(np.nonzero(todo)[0], np.concatenate(batches) if batches else [])
+                    ckpt.append(field_name, [zone_lines[i] for i in empty], sums[empty], counts[empty],
+                                stats.subset(empty) if stats else None)
+            else:
+                if use_pyramid:
+                    pyr, tiles = pyramid.openPyramid(source, grid, todo_zones, pyramid_dir, memory_mb)
+                    sums, counts, lookups = pyramid.pyramidZoneSums(pyr, todo_zones, grid)
+                    del pyr
+                    if run_stats is not None:
+                        run_stats["lookups"] = run_stats.get("lookups", 0) + lookups
+                else:
+                    sums, counts, tiles = zonal.streamZoneSums(source, grid, todo_zones, engine, memory_mb,
+                                                               stats=stats)
+                rereads = 0
+                if ckpt is not None:
+                    ids = np.nonzero(todo)[0]
+                    ckpt.append(field_name, [zone_lines[i] for i in ids], sums[ids], counts[ids],
+                                stats.subset(ids) if stats else None)
+            if ckpt is not None and not todo.all():
+                restored = np.nonzero(~todo)[0]
+                rows = [done[zone_lines[i]] for i in restored]
+                sums[restored] = [row[0] for row in rows]
+                counts[restored] = [row[1] for row in rows]
+                if stats is not None:
+                    fields = sorted(zonal.ZoneStats.FIELDS)
+                    stats.assign(restored, dict((f, np.array([row[2][k] for row in rows]))
+                                                for k, f in enumerate(fields)))
+            if run_stats is not None:
+                run_stats["tiles"] = run_stats.get("tiles", 0) + tiles
+                run_stats["rereads"] = run_stats.get("rereads", 0) + rereads
+            if nested:
+                sums = zonal.accumulateZones(sums, parent, order)
+                counts = zonal.accumulateZones(counts, parent, order)
+                if stats is not None:
+                    stats.accumulate(parent, order)
+            means[field_name] = dict(zip(edges.oids, zonal.zoneMeans(sums, counts)))
+            if stats is not None:
+                stat_values = stats.values(stat_names)
+                for i, line_oid in enumerate(zone_lines):
+                    zone_stats[(line_oid, field_name)] = [stat_values[name][i] for name in stat_names]
+            arcpy.AddMessage("Parameter " + field_name + " is summarized...")
+    finally:
+        if pool is not None:
+            # all batches are collected by now, unless an error stopped the run
+            pool.terminate()
+            pool.join()
+
+    # hand the parameter values over as columns in the cursor order of the catchments
+    columns = {}
+    for p in inParam:
+        columns[p[0]] = np.array([means[p[0]].get(oid, np.nan) for oid, line_oid in oid_lines])
+    return [line_oid for oid, line_oid in oid_lines], columns
+
+
+def calcParamsSampled(in_fc, env_dir, inParam, tolerance, cache=None, run_stats=None, zone_stats=None):
+    """Estimate parameter means for the catchment polygons of the input feature
+    class from stratified random samples of their cells (preview mode).
+
+    The catchment polygons are burned into row spans on the grid of each raster
+    like in calcParamsVectorized. Catchments small enough are read in full, and
+    the mean of every larger catchment is estimated from cells drawn in rounds
+    from square spatial strata, until the 95% confidence interval is within the
+    relative tolerance (see sampling.sampleZoneMeans). Nested catchments are
+    sampled directly, as their cost no longer grows with their area. The sampled
+    cells are read one by one from the memory-mapped chunks of an environmental
+    parameter stack; raster datasets cannot be read by cell through arcpy, so
+    preview mode requires a stack.
+
+    Args:
+        in_fc: Input upstream catchment area polygon feature class, with a LineOID field
+        env_dir: environmental parameter stack directory
+        inParam: 2D list of model parameter names and associated raster
+        dataset names
+        tolerance: relative error tolerance of the estimated means
+        cache: optional rasterize.SpanCache of catchment footprints
+        run_stats: optional dictionary; the number of cells read is added to its
+        "samples" item, and the number of catchment cells to its "cells" item
+        zone_stats: optional dictionary filled with (LineOID, parameter name):
+        [confidence interval half-width, number of cells read]
+
+    Returns:
+        line_oids: list of the LineOID values of the catchments, in cursor order
+        columns: dictionary of parameter name: array of mean values aligned with
+        line_oids, and APPROX_FIELD: array of 1 for catchments with any estimated
+        value and 0 for exact rows
+    """
+    arcpy.AddMessage("Estimating parameter values per catchment area polygon from cell samples (preview)...")
+    stack = envstack.EnvStack(env_dir)
+    catchments = {}
+    zone_sets = {}
+    means = {}
+    approx = {}
+    with arcpy.da.SearchCursor(in_fc, ["OID@", "LineOID"]) as cursor:
+        oid_lines = [(row[0], row[1]) for row in cursor]
+    line_oids = dict(oid_lines)
+    for r in inParam:
+        field_name = r[0]
+        source = stack.band(field_name)
+        sr = source.spatialReference()
+        if sr.name not in catchments:
+            catchments[sr.name] = rasterize.readCatchmentEdges(in_fc, sr)
+        edges = catchments[sr.name]
+        if len(edges.zones) == 0:
+            means[field_name] = {}
+            arcpy.AddMessage("Parameter " + field_name + " is estimated...")
+            continue
+        grid = source.window(edges.bounds())
+        key = (sr.name,) + grid.key()
+        if key not in zone_sets:
+            if cache is not None:
+                zone_sets[key] = rasterize.burnZonesCached(edges, grid, cache)
+            else:
+                zone_sets[key] = rasterize.burnZones(edges, grid)
+        spans = zone_sets[key]
+        values, half_widths, samples, exact = sampling.sampleZoneMeans(source, grid, spans, tolerance)
+        means[field_name] = dict(zip(edges.oids, values))
+        for i, oid in enumerate(edges.oids):
+            approx[oid] = approx.get(oid, False) or not exact[i]
+            if zone_stats is not None:
+                zone_stats[(line_oids[oid], field_name)] = [half_widths[i], samples[i]]
+        if run_stats is not None:
+            run_stats["samples"] = run_stats.get("samples", 0) + int(samples.sum())
+            run_stats["cells"] = run_stats.get("cells", 0) + int(spans.cellCounts().sum())
+        arcpy.AddMessage("Parameter " + field_name + " is estimated...")
+
+    # hand the parameter values over as columns in the cursor order of the catchments
+    columns = {}
+    for p in inParam:
+        columns[p[0]] = np.array([means[p[0]].get(oid, np.nan) for oid, line_oid in oid_lines])
+    columns[APPROX_FIELD] = np.array([1.0 if approx.get(oid) else 0.0 for oid, line_oid in oid_lines])
+    return [line_oid for oid, line_oid in oid_lines], columns
+
+
+def statsTablePath(out_tbl):
+    """Returns the path of the parameter statistics table written next to an output parameter table.
+
+    The statistics table of a columnar parameter table is a dBASE table, as it
+    holds a text field.
+    """
+    base, ext = os.path.splitext(out_tbl)
+    if tablewriter.isColumnar(out_tbl):
+        ext = ".dbf"
+    return base + "_stats" + ext
+
+
+def writeStatsTable(out_tbl, stat_names, zone_stats):
+    """Writes the extra statistics of each catchment and parameter to a table
+    with one record per LineOID and parameter.
+
+    Args:
+        out_tbl: path of the output parameter table
+        stat_names: list of extra statistics (see STAT_LIST)
+        zone_stats: dictionary of (LineOID, parameter name): list of statistics values
+
+    Returns:
+        Path of the statistics table.
+    """
+    stats_tbl = statsTablePath(out_tbl)
+    arcpy.AddMessage("Writing parameter statistics table " + stats_tbl + "...")
+    if arcpy.Exists(stats_tbl):
+        arcpy.Delete_management(stats_tbl)
+    arcpy.CreateTable_management(os.path.dirname(stats_tbl), os.path.basename(stats_tbl))
+    arcpy.AddField_management(stats_tbl, "LineOID", "LONG")
+    arcpy.AddField_management(stats_tbl, "PARAM", "TEXT", field_length=16)
+    for name in stat_names:
+        arcpy.AddField_management(stats_tbl, STAT_FIELDS[name], "DOUBLE")
+    # a new dBASE table is created with a placeholder field
+    if arcpy.ListFields(stats_tbl, "Field1"):
+        arcpy.DeleteField_management(stats_tbl, "Field1")
+    fields = ["LineOID", "PARAM"] + [STAT_FIELDS[name] for name in stat_names]
+    with arcpy.da.InsertCursor(stats_tbl, fields) as cursor:
+        for key in sorted(zone_stats):
+            # NaN means the statistic is undefined (no valid cells)
+            cursor.insertRow(list(key) + [None if v is None or v != v else float(v) for v in zone_stats[key]])
+    return stats_tbl
+
+
+def readStatsTable(out_tbl, stat_names):
+    """Reads the parameter statistics table of a previous output parameter table.
+
+    Returns:
+        Dictionary of (LineOID, parameter name): list of statistics values, empty
+        if the table does not exist or lacks one of the statistics.
+    """
+    stats_tbl = statsTablePath(out_tbl)
+    fields = [STAT_FIELDS[name] for name in stat_names]
+    if not arcpy.Exists(stats_tbl) or not set(fields) <= set(f.name for f in arcpy.ListFields(stats_tbl)):
+        arcpy.AddWarning("The previous parameter table has no matching statistics table, so statistics are only "
+                         "written for the summarized values.")
+        return {}
+    with arcpy.da.SearchCursor(stats_tbl, ["LineOID", "PARAM"] + fields) as cursor:
+        return dict(((row[0], row[1]), list(row[2:])) for row in cursor)
+
+
 def clear_inmemory():
     """Clears all in_memory datasets."""
     arcpy.env.workspace = r"IN_MEMORY"
@@ -195,9 +702,132 @@ def metadata(ecXML, calc_ply, env_dir, out_tbl, rs_bool, real_name, real_id):
     ecXML.write()
 
 
-def main(in_fc, env_dir, out_tbl, rs_bool, rs_dir='', proj_name = '', real_name=''):
+def summarizeParams(in_fc, env_dir, inParam, ckpt_path, engine, nested_bool, cache_dir, memory_mb, workers,
+                    resume_bool, mWriter, stat_names=None, zone_stats=None, preview_tol=0, fingerprints=None):
+    """Summarizes the parameter rasters for the catchment polygons of a feature class
+    with the selected zonal statistics engine, and records the run statistics.
+
+    Args:
+        in_fc: Input upstream catchment area polygon feature class, with a LineOID field
+        env_dir: Directory containing the environmental parameter rasters, or an
+        environmental parameter stack directory
+        inParam: 2D list of model parameter names and associated raster
+        dataset names
+        ckpt_path: path of the checkpoint file, or None to run without a checkpoint
+        engine: zonal statistics engine
+        nested_bool: accumulate nested catchments from their incremental areas ("true" or "false")
+        cache_dir: catchment footprint cache folder, or an empty string
+        memory_mb: memory budget for a raster tile, in megabytes
+        workers: number of worker processes
+        resume_bool: resume from an existing checkpoint ("true" or "false")
+        mWriter: metadata writer of the run
+        stat_names: optional list of extra statistics (see STAT_LIST)
+        zone_stats: dictionary filled with (LineOID, parameter name): list of the
+        extra statistics values; required with stat_names
+        preview_tol: relative error tolerance of the sampled preview mode; 0 for exact means
+        fingerprints: optional ordered dictionary of LineOID: geometry digest of the
+        catchments of in_fc (see incremental.geometryFingerprints), if already calculated
+
+    Returns:
+        line_oids: list of the LineOID values of the catchments
+        columns: dictionary of parameter name: sequence of values aligned with line_oids
+        ckpt: checkpoint.Checkpoint of the run to remove once the output is written, or None
+    """
+    ckpt = None
+    if ckpt_path and not preview_tol:
+        # the memory budget and the number of workers do not change the results, so they do not block a resume
+        if fingerprints is None:
+            fingerprints = incremental.geometryFingerprints(in_fc)
+        signature = checkpoint.runSignature(fingerprints, env_dir, incremental.rasterHashes(env_dir, inParam),
+                                            [engine, nested_bool, stat_names])
+        try:
+            ckpt = checkpoint.Checkpoint(ckpt_path, signature, resume_bool == "true")
+        except ValueError as e:
+            arcpy.AddError(str(e))
+            sys.exit(1) # terminate process
+        restored = sum(len(ckpt.done(p[0])) for p in inParam)
+        if restored:
+            arcpy.AddMessage("Resuming from checkpoint: {0} catchment parameter values restored".format(restored))
+    if engine == "ZONAL_STATISTICS":
+        arcpy.CheckOutExtension("Spatial")
+        addFieldsFC = addParamFields(in_fc, inParam)
+        calcParamsFC = calcParams(addFieldsFC, env_dir, inParam, stat_names, zone_stats, ckpt)
+        field_names = [p[0] for p in inParam]
+        with arcpy.da.SearchCursor(calcParamsFC, ["LineOID"] + field_names) as cursor:
+            rows = [row for row in cursor]
+        arcpy.Delete_management(calcParamsFC)
+        arcpy.Delete_management(addFieldsFC)
+        columns = dict((f, [row[i + 1] for row in rows]) for i, f in enumerate(field_names))
+        return [row[0] for row in rows], columns, ckpt
+    cache = rasterize.SpanCache(cache_dir) if cache_dir else None
+    run_stats = {}
+    if preview_tol:
+        line_oids, columns = calcParamsSampled(in_fc, env_dir, inParam, preview_tol, cache, run_stats, zone_stats)
+        arcpy.AddMessage("Cells read: {0} of {1}".format(run_stats.get("samples", 0), run_stats.get("cells", 0)))
+        mWriter.currentRun.addResult("CellsSampled", str(run_stats.get("samples", 0)))
+        mWriter.currentRun.addResult("CatchmentCells", str(run_stats.get("cells", 0)))
+        mWriter.currentRun.addResult("ApproximateRows", str(int(np.sum(columns[APPROX_FIELD]))))
+        if cache is not None:
+            cache.close()
+        return line_oids, columns, None
+    pyramid_dir = None
+    if engine == "PYRAMID":
+        # pyramids are kept with the footprint cache, or only for this run
+        pyramid_dir = os.path.join(cache_dir, "pyramids") if cache_dir else tempfile.mkdtemp(prefix="pyramids_")
+    line_oids, columns = calcParamsVectorized(in_fc, env_dir, inParam, nested_bool == "true", engine, cache,
+                                              memory_mb, run_stats, workers, ckpt, stat_names, zone_stats,
+                                              pyramid_dir)
+    if pyramid_dir is not None:
+        arcpy.AddMessage("Pyramid block and cell lookups: {0}".format(run_stats.get("lookups", 0)))
+        mWriter.currentRun.addResult("PyramidLookups", str(run_stats.get("lookups", 0)))
+        if not cache_dir:
+            shutil.rmtree(pyramid_dir, ignore_errors=True)
+    peak_mb = zonal.peakMemoryMB()
+    mWriter.currentRun.addResult("RasterTilesRead", str(run_stats.get("tiles", 0)))
+    mWriter.currentRun.addResult("RasterTileRereads", str(run_stats.get("rereads", 0)))
+    arcpy.AddMessage("Raster tiles read: {0}, re-read by another batch: {1}".format(run_stats.get("tiles", 0),
+                                                                                    run_stats.get("rereads", 0)))
+    if peak_mb is not None:
+        mWriter.currentRun.addResult("PeakMemoryMB", str(round(peak_mb, 1)))
+    if cache is not None:
+        arcpy.AddMessage("Footprint cache hits: {0}, misses: {1}".format(cache.hits, cache.misses))
+        mWriter.currentRun.addResult("FootprintCacheHits", str(cache.hits))
+        mWriter.currentRun.addResult("FootprintCacheMisses", str(cache.misses))
+        cache.close()
+    return line_oids, columns, ckpt
+
+
+def main(in_fc, env_dir, out_tbl, rs_bool, rs_dir='', proj_name = '', real_name='', engine="ZONAL_STATISTICS",
+         nested_bool="false", cache_dir='', memory_mb='', workers='', resume_bool="false", prev_tbl='',
+         stat_list='', preview_tol=''):
     """Main processing function"""
 
+    # start processing time
+    startTime = time.time()
+    printTime = strftime("%a, %d %b %Y %H:%M:%S")
+    arcpy.AddMessage("Processing started at " + str(printTime))
+    arcpy.AddMessage("------------------------------------")
+
+    if engine not in ENGINE_LIST:
+        engine = "ZONAL_STATISTICS"
+    memory_mb = float(memory_mb) if memory_mb else zonal.MEMORY_MB
+    workers = max(int(workers), 1) if workers else 1
+    stat_names = [name for name in STAT_LIST if name in (stat_list or '').replace("'", "").split(";")]
+    preview_tol = float(preview_tol) if preview_tol and engine != "ZONAL_STATISTICS" else 0
+    if preview_tol and not envstack.isStack(env_dir):
+        arcpy.AddWarning("Preview mode reads sampled cells from an environmental parameter stack, and the parameter "
+                         "workspace is not a stack, so exact means are calculated.")
+        preview_tol = 0
+    if preview_tol:
+        # estimated values are never reused by an incremental update, and only have confidence intervals
+        if prev_tbl:
+            arcpy.AddWarning("Preview mode summarizes all catchments, so the previous parameter table is not used.")
+        if stat_names:
+            arcpy.AddWarning("Preview mode does not calculate extra statistics; confidence intervals are written "
+                             "to the statistics table instead.")
+        prev_tbl = ''
+        stat_names = PREVIEW_STATS
+
     in_fc_dir = os.path.dirname(in_fc)
     in_fc_name = os.path.basename(in_fc)
     out_dir = os.path.dirname(out_tbl)
@@ -215,6 +845,18 @@ def main(in_fc, env_dir, out_tbl, rs_bool, rs_dir='', proj_name = '', real_name=
     mWriter.currentRun.addParameter("Catchment area feature class", in_fc)
     mWriter.currentRun.addParameter("Output environmental parameter table", out_tbl)
     mWriter.currentRun.addParameter("Environmental parameter workspace", env_dir)
+    mWriter.currentRun.addParameter("Zonal statistics engine", engine)
+    mWriter.currentRun.addParameter("Nested catchment accumulation", nested_bool)
+    if cache_dir:
+        mWriter.currentRun.addParameter("Catchment footprint cache", cache_dir)
+    if engine != "ZONAL_STATISTICS":
+        mWriter.currentRun.addParameter("Memory budget (MB)", str(memory_mb))
+        mWriter.currentRun.addParameter("Worker processes", str(workers))
+        mWriter.currentRun.addParameter("Resume from checkpoint", resume_bool)
+    if stat_names:
+        mWriter.currentRun.addParameter("Extra parameter statistics", ";".join(stat_names))
+    if preview_tol:
+        mWriter.currentRun.addParameter("Preview error tolerance", str(preview_tol))
     mWriter.currentRun.addParameter("Output metadata XML", out_xml)
 
     # initiate Riverscapes project XML object
@@ -223,9 +865,96 @@ def main(in_fc, env_dir, out_tbl, rs_bool, rs_dir='', proj_name = '', real_name=
         projectXML = meta_rs.ProjectXML("existing", rs_xml, "EC", proj_name)
 
     # run the environmental parameter summary
-    addFieldsFC = addParamFields(in_fc, PARAM_LIST)
-    calcParamsFC = calcParams(addFieldsFC, env_dir, PARAM_LIST)
-    arcpy.TableToTable_conversion(calcParamsFC, out_dir, out_tbl_name)
+    if checkLineOID(in_fc) != True:
+        arcpy.AddMessage("The LineOID attribute field is missing! Cancelling process...")
+        sys.exit(0) # terminate process
+    field_names = [p[0] for p in PARAM_LIST]
+    previous = None
+    if prev_tbl:
+        try:
+            previous = incremental.readSidecar(prev_tbl)
+            if previous is None:
+                arcpy.AddWarning("The previous parameter table has no sidecar file, so all catchments are summarized.")
+        except ValueError as e:
+            arcpy.AddWarning(str(e) + " All catchments are summarized.")
+    if not preview_tol:
+        # the sidecar of a preview is never written, so the catchments and rasters are not fingerprinted
+        fingerprints = incremental.geometryFingerprints(in_fc)
+        hashes = incremental.rasterHashes(env_dir, PARAM_LIST, previous["rasters"] if previous else None)
+    ckpts = []
+    zone_stats = {}
+    if previous is None:
+        line_oids, columns, ckpt = summarizeParams(in_fc, env_dir, PARAM_LIST,
+                                                   incremental.sidecarPath(out_tbl, checkpoint.CHECKPOINT_EXT),
+                                                   engine, nested_bool, cache_dir, memory_mb, workers, resume_bool,
+                                                   mWriter, stat_names, zone_stats, preview_tol,
+                                                   None if preview_tol else fingerprints)
+        ckpts.append(ckpt)
+        writer = tablewriter.openTableWriter(out_tbl, field_names + ([APPROX_FIELD] if preview_tol else []))
+        writer.writeColumns(line_oids, columns)
+    else:
+        mWriter.currentRun.addParameter("Previous environmental parameter table", prev_tbl)
+        added, removed, modified = incremental.changedCatchments(fingerprints, previous["catchments"])
+        changed_params, unchanged_params = incremental.changedParams(hashes, previous["rasters"], PARAM_LIST)
+        arcpy.AddMessage("Incremental update: {0} catchments added, {1} removed, {2} modified".format(
+            len(added), len(removed), len(modified)))
+        arcpy.AddMessage("Parameter rasters changed: {0}".format(", ".join(p[1] for p in changed_params) or "none"))
+        mWriter.currentRun.addResult("CatchmentsAdded", str(len(added)))
+        mWriter.currentRun.addResult("CatchmentsRemoved", str(len(removed)))
+        mWriter.currentRun.addResult("CatchmentsModified", str(len(modified)))
+        mWriter.currentRun.addResult("ParametersRecomputed", str(len(changed_params)))
+        values = dict((line_oid, {}) for line_oid in fingerprints)
+        # columns of changed rasters are summarized again for all catchments
+        if changed_params:
+            ckpt_path = incremental.sidecarPath(out_tbl, ".columns" + checkpoint.CHECKPOINT_EXT)
+            line_oids, columns, ckpt = summarizeParams(in_fc, env_dir, changed_params, ckpt_path,
+                                                       engine, nested_bool, cache_dir, memory_mb, workers,
+                                                       resume_bool, mWriter, stat_names, zone_stats,
+                                                       fingerprints=fingerprints)
+            ckpts.append(ckpt)
+            for p in changed_params:
+                for line_oid, value in zip(line_oids, columns[p[0]]):
+                    values[line_oid][p[0]] = value
+        # other columns are copied from the previous table, except for added or modified catchments
+        unchanged_names = [p[0] for p in unchanged_params]
+        if unchanged_params:
+            changed_rows = set(added + modified)
+            for line_oid, row in incremental.readValues(prev_tbl, unchanged_names).items():
+                if line_oid in values and line_oid not in changed_rows:
+                    values[line_oid].update(zip(unchanged_names, row))
+            if changed_rows:
+                changedFC = incremental.selectCatchments(in_fc, added + modified, r"in_memory\changed_fc")
+                ckpt_path = incremental.sidecarPath(out_tbl, ".rows" + checkpoint.CHECKPOINT_EXT)
+                line_oids, columns, ckpt = summarizeParams(changedFC, env_dir, unchanged_params, ckpt_path,
+                                                           engine, nested_bool, cache_dir, memory_mb, workers,
+                                                           resume_bool, mWriter, stat_names, zone_stats)
+                ckpts.append(ckpt)
+                arcpy.Delete_management(changedFC)
+                for name in unchanged_names:
+                    for line_oid, value in zip(line_oids, columns[name]):
+                        values[line_oid][name] = value
+            if stat_names:
+                # extra statistics of values copied from the previous table are copied from its statistics table
+                for k, v in readStatsTable(prev_tbl, stat_names).items():
+                    if k[0] in values and k[0] not in changed_rows and k[1] in unchanged_names:
+                        zone_stats.setdefault(k, v)
+        # the previous table is read before the output is created, as they may be the same table
+        writer = tablewriter.openTableWriter(out_tbl, field_names)
+        for line_oid in fingerprints:
+            writer.writeRow(line_oid, [values[line_oid].get(f) for f in field_names])
+    writer.close()
+    arcpy.AddMessage("Parameter table rows written: {0}".format(writer.rows))
+    mWriter.currentRun.addResult("ParamTableRows", str(writer.rows))
+    for ckpt in ckpts:
+        if ckpt is not None:
+            ckpt.remove() # the run completed, so the checkpoint is no longer needed
+    if preview_tol:
+        incremental.removeSidecar(out_tbl) # estimated values must not be copied by a later incremental update
+    else:
+        incremental.writeSidecar(out_tbl, PARAM_LIST, fingerprints, hashes)
+    if stat_names:
+        stats_tbl = writeStatsTable(out_tbl, stat_names, zone_stats)
+        mWriter.currentRun.addParameter("Output parameter statistics table", stats_tbl)
 
     # finalize and write generic XML file
     tool_status = "Success"
@@ -254,18 +983,17 @@ def main(in_fc, env_dir, out_tbl, rs_bool, rs_dir='', proj_name = '', real_name=
                  real_id)
 
     # clean up
-    arcpy.Delete_management(addFieldsFC)
-    arcpy.Delete_management(calcParamsFC)
     clear_inmemory()
 
+    # end processing time
+    printTime = strftime("%a, %d %b %Y %H:%M:%S")
+    arcpy.AddMessage("-------------------------------------")
+    arcpy.AddMessage("Processing completed at " + str(printTime))
+    curTime = time.time()
+    totalTime = (curTime - startTime)/60.0
+    arcpy.AddMessage("Total processing time was " + str(round(totalTime,2)) + " minutes.")
+
 
 if __name__ == "__main__":
-    main(calc_ply, env_dir, out_tbl, rs_bool, rs_dir, rs_proj_name, rs_real_name)
-
-# end processing time
-printTime = strftime("%a, %d %b %Y %H:%M:%S")
-arcpy.AddMessage("-------------------------------------")
-arcpy.AddMessage("Processing completed at " + str(printTime))
-curTime = time.time()
-totalTime = (curTime - startTime)/60.0
-arcpy.AddMessage("Total processing time was " + str(round(totalTime,2)) + " minutes.")
\ No newline at end of file
+    main(calc_ply, env_dir, out_tbl, rs_bool, rs_dir, rs_proj_name, rs_real_name, zonal_engine, nested_bool, cache_dir,
+         memory_mb, workers, resume_bool, prev_tbl, stat_list, preview_tol)
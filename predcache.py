@@ -0,0 +1,184 @@
+# file name:	predcache.py
+# description:	On-disk cache of conductivity predictions for the Predict Conductivity tool.  Predictions are stored in
+#               a SQLite database keyed by a hash of the model name and the rounded parameter vector of a row, so the
+#               rows of re-runs and other realizations of a project with the same parameter values skip the model.
+#               The cache holds a bounded number of predictions and evicts the least recently used ones.  Every
+#               lookup and store is committed at once, so concurrent runs sharing the cache only wait for each other
+#               briefly; a run that still finds the database locked predicts the remaining rows without the cache.
+# dependencies: numpy, built-in Python modules
+
+import os
+import hashlib
+import sqlite3
+import numpy as np
+
+# constants
+CACHE_NAME = "prediction_cache.sqlite" # file name of the cache database in the cache folder
+MAX_ENTRIES = 2000000 # maximum number of cached predictions
+KEY_MANTISSA_BITS = 32 # mantissa bits of the parameter values kept in the cache key (about 9 significant digits)
+QUERY_KEYS = 500 # number of keys per query, below the SQLite limit of 999 variables
+NAN_BITS = 0x7FF8000000000000 # bit pattern of all missing parameter values in the cache key
+LOCK_TIMEOUT = 30.0 # seconds to wait for a lock held by another run before the cache is given up
+
+
+def roundVectors(x, bits=KEY_MANTISSA_BITS):
+    """Rounds parameter values to a number of mantissa bits.
+
+    Args:
+        x: array of shape (rows, features)
+        bits: number of mantissa bits kept (of 52)
+
+    Returns:
+        Array of the bit patterns of the rounded values (unsigned 64-bit integers).
+    """
+    x = np.ascontiguousarray(x, dtype="<f8")
+    drop = 52 - bits
+    raw = x.view("<u8")
+    mask = np.uint64((2 ** 64 - 1) ^ (2 ** drop - 1))
+    rounded = (raw + np.uint64(2 ** (drop - 1))) & mask
+    rounded[np.isnan(x)] = np.uint64(NAN_BITS)
+    return rounded
+
+
+class PredictionCache(object):
+    """Cache of predicted values keyed by model and parameter vector.
+
+    The database is opened in write-ahead log mode, so lookups of other runs
+    are not blocked by a write. If the database cannot be opened or stays
+    locked, the cache is disabled and records the error; predict then runs the
+    model for all rows.
+
+    Args:
+        cache_dir: folder of the cache database (created if missing)
+        model: name of the model whose predictions are cached
+        max_entries: maximum number of cached predictions
+    """
+
+    def __init__(self, cache_dir, model, max_entries=MAX_ENTRIES):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, CACHE_NAME)
+        self.model = model.encode("utf-8")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stamp = 0
+        self.error = None
+        self.conn = None
+        try:
+            self.conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+            # file systems without shared memory (network folders) keep the default rollback journal
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, value REAL, used INTEGER)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)")
+            self.conn.commit()
+            # the use counter keeps growing across runs, so older runs are evicted first
+            self.stamp = self.conn.execute("SELECT COALESCE(MAX(used), 0) FROM predictions").fetchone()[0]
+        except sqlite3.Error as e:
+            self.disable(e)
+
+    def disable(self, error):
+        """Stops using the database after an error, such as a lock held longer than the timeout."""
+        self.error = str(error)
+        if self.conn is not None:
+            try:
+                self.conn.rollback()
+                self.conn.close()
+            except sqlite3.Error:
+                pass
+        self.conn = None
+
+    def keys(self, x):
+        """Returns the cache key of every row of a parameter array."""
+        rounded = roundVectors(x)
+        return [hashlib.sha1(self.model + row.tobytes()).hexdigest() for row in rounded]
+
+    def lookup(self, keys):
+        """Looks up cached predictions.
+
+        Returns:
+            values: array with the cached value of each key (NaN where missing or undefined)
+            hit: boolean array, True for cached keys
+        """
+        self.stamp += 1
+        found = {}
+        for i in range(0, len(keys), QUERY_KEYS):
+            chunk = keys[i:i + QUERY_KEYS]
+            marks = ",".join("?" * len(chunk))
+            found.update(self.conn.execute("SELECT key, value FROM predictions WHERE key IN ({0})".format(marks),
+                                           chunk).fetchall())
+            self.conn.execute("UPDATE predictions SET used = ? WHERE key IN ({0})".format(marks), [self.stamp] + chunk)
+        # the write lock of the use stamps is not held while the missing rows are predicted
+        self.conn.commit()
+        hit = np.array([k in found for k in keys], dtype=bool)
+        # undefined predictions are stored as NULL
+        values = np.array([found.get(k) for k in keys], dtype=np.float64)
+        return values, hit
+
+    def store(self, keys, values):
+        """Stores predictions of the given keys."""
+        rows = [(k, None if v != v else float(v), self.stamp) for k, v in zip(keys, values)]
+        self.conn.executemany("INSERT OR REPLACE INTO predictions (key, value, used) VALUES (?, ?, ?)", rows)
+        self.conn.commit()
+
+    def predict(self, x, predict):
+        """Predicts a batch of rows, running the model only for rows missing from the cache.
+
+        The hits and misses of the rows are counted once the batch is predicted, so
+        rows of a batch whose prediction fails are not counted.
+
+        Args:
+            x: array of shape (rows, features)
+            predict: function returning the predictions of an array of shape (rows, features)
+
+        Returns:
+            Array with the prediction of each row.
+        """
+        if self.conn is None:
+            values = predict(x)
+            self.misses += len(x)
+            return values
+        keys = self.keys(x)
+        try:
+            values, hit = self.lookup(keys)
+        except sqlite3.Error as e:
+            self.disable(e)
+            values = predict(x)
+            self.misses += len(keys)
+            return values
+        miss = np.nonzero(~hit)[0]
+        if len(miss):
+            values[miss] = predict(np.asarray(x)[miss])
+            try:
+                self.store([keys[i] for i in miss], values[miss])
+            except sqlite3.Error as e:
+                self.disable(e)
+        self.hits += len(keys) - len(miss)
+        self.misses += len(miss)
+        return values
+
+    def evict(self):
+        """Deletes the least recently used predictions above the maximum number of entries."""
+        count = self.conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute("DELETE FROM predictions WHERE key IN "
+                              "(SELECT key FROM predictions ORDER BY used LIMIT ?)", [count - self.max_entries])
+        return max(count - self.max_entries, 0)
+
+    def hitRate(self):
+        """Returns the fraction of looked up rows found in the cache."""
+        return self.hits / float(self.hits + self.misses) if self.hits + self.misses else 0.0
+
+    def close(self):
+        """Evicts old predictions, commits and closes the database. Returns the number of evicted predictions."""
+        if self.conn is None:
+            return 0
+        try:
+            evicted = self.evict()
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+            return 0
+        self.conn.close()
+        self.conn = None
+        return evicted
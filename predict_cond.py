@@ -1,35 +1,57 @@
 # file name:	predict_cond.py
 # description:	This tool automates the process of predicting conductivity values for a stream network. Based on a table
 #               of summarized model parameters (output from the Pre-process Environmental Parameters tool) , a Random Forest
-#               (RF) model is applied to the parameter table using an external R script.  After the R script is called, the
-#               RF prediction is then joined back to the input stream network.
+#               (RF) model is applied to the parameter table, either in-process with the trees of the model exported
+#               once and compiled into a memory-mapped file (see forest.py), by a running R prediction worker (see
+#               rworker.py), or using an external R script.  The RF prediction is then joined back to the input stream
+#               network.
 # author:		Jesse Langdon
 # dependencies: ESRI arcpy module, built-in Python modules
 
 
 import arcpy
 import time
+import socket
 import subprocess
 import os.path
 import sys
 import gc
+import csv
+import shutil
+import tempfile
+import numpy as np
 import metadata.meta_sfr as meta_sfr
 import metadata.meta_rs as meta_rs
 import riverscapes as rs
+import forest
+import incremental
+import polystat_cond
+import predcache
+import rworker
+import tablewriter
 
 arcpy.env.overwriteOutput = True
 
 # input variables
 in_fc = arcpy.GetParameterAsText(0) # stream network polyline feature class (i.e. segments)
-in_params = arcpy.GetParameterAsText(1) # filepath to the dbf file with summarized parameters
+in_params = arcpy.GetParameterAsText(1) # filepath to the dbf file (or .ctab columnar table) with summarized parameters
 out_fc = arcpy.GetParameterAsText(2) # stream network polyline feature class, with predicted conductivity
 rs_bool = arcpy.GetParameterAsText(3) # Boolean value indicates if this is a Riverscapes project
 rs_dir = arcpy.GetParameterAsText(4) # Directory where Riverscapes project files will be written
 rs_proj_name = arcpy.GetParameterAsText(5) # Riverscapes project name.
 rs_real_name = arcpy.GetParameterAsText(6) # Riverscapes project realization name.
+chunk_rows = arcpy.GetParameterAsText(7) # number of parameter table rows predicted at once
+cache_dir = arcpy.GetParameterAsText(8) # folder of the prediction cache
 
 # constants
 MODEL_RF = "rf17bCnd9" # name of random forest model (source: Carl Saunders, ELR)
+DENSE_RATIO = 4 # LineOID values are indexed in a dense array if their range is at most this multiple of their number
+FIELD_TYPES = {"SmallInteger": "SHORT", # AddField types of the kept stream network fields
+               "Integer": "LONG",
+               "Single": "FLOAT",
+               "Double": "DOUBLE",
+               "String": "TEXT"}
+CACHE_FOLDER = "conductivity_cache" # default prediction cache folder, in the temporary folder of the user
 
 
 def checkLineOID(in_fc):
@@ -50,26 +72,311 @@ def checkLineOID(in_fc):
             return False
 
 
-def removeFields(in_fc):
-    """Removes junk fields from final feature class output.
+def keptFields(in_fc):
+    """Returns the attribute fields of the stream network that are kept in the final output.
 
     Args:
-        in FC: Input stream network polyline feature class
+        in_fc: Input stream network polyline feature class
+
+    Returns:
+        List of arcpy Field objects (LineOID and error_code), in the order of in_fc.
+    """
+    return [f for f in arcpy.ListFields(in_fc) if f.name in ("LineOID", "error_code")]
+
+
+class PredictionIndex(object):
+    """Predicted conductivity values indexed by LineOID.
+
+    LineOID values that fill most of their range are looked up in a dense
+    array (offset by the smallest LineOID), other values in a dictionary.
+
+    Args:
+        line_oids: sequence of LineOID values
+        values: sequence of predicted conductivity values aligned with line_oids, NaN where undefined
+    """
+
+    def __init__(self, line_oids, values):
+        line_oids = np.asarray(line_oids, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        self.dense = None
+        self.lookup = None
+        span = int(line_oids.max() - line_oids.min()) + 1 if len(line_oids) else 0
+        if len(line_oids) and span <= DENSE_RATIO * len(line_oids):
+            self.base = int(line_oids.min())
+            self.dense = np.empty(span)
+            self.dense.fill(np.nan)
+            self.matched = np.zeros(span, dtype=bool)
+            self.dense[line_oids - self.base] = values
+            self.matched[line_oids - self.base] = True
+            self.dense = self.dense.tolist()
+            self.matched = self.matched.tolist()
+        else:
+            self.lookup = dict(zip(line_oids.tolist(), values.tolist()))
+
+    def get(self, line_oid):
+        """Returns True and the predicted value of a LineOID (None if undefined), or False and None if it has none."""
+        if line_oid is None:
+            return False, None
+        if self.dense is not None:
+            i = int(line_oid) - self.base
+            if i < 0 or i >= len(self.dense) or not self.matched[i]:
+                return False, None
+            value = self.dense[i]
+        else:
+            value = self.lookup.get(line_oid)
+            if value is None:
+                return False, None
+        # NaN means the prediction is undefined
+        return True, None if value != value else value
+
+
+def readPredictionCSV(pred_csv):
+    """Reads the LineOID and prdCond columns of the prediction CSV file written by condRF.R.
+
+    Returns:
+        line_oids: list of LineOID values
+        values: list of predicted values, NaN where undefined (NA)
+    """
+    line_oids = []
+    values = []
+    with open(pred_csv) as f:
+        for row in csv.DictReader(f):
+            line_oids.append(int(float(row["LineOID"])))
+            values.append(float("nan") if row["prdCond"] == "NA" else float(row["prdCond"]))
+    return line_oids, values
+
+
+def joinPredictions(in_fc, line_oids, values, out_fc):
+    """Writes the stream network with the predicted conductivity values, matched by LineOID.
+
+    The output feature class is created with the kept fields of the stream
+    network and a prdCond field, and the segments are streamed into it in a
+    single pass.
+
+    Args:
+        in_fc: Input stream network polyline feature class
+        line_oids: sequence of LineOID values
+        values: sequence of predicted conductivity values aligned with line_oids
+        out_fc: Output stream network polyline feature class
+
+    Returns:
+        segments: number of segments written
+        unmatched: number of segments without a prediction for their LineOID
+    """
+    index = PredictionIndex(line_oids, values)
+    fields = keptFields(in_fc)
+    desc = arcpy.Describe(in_fc)
+    arcpy.AddMessage("Exporting final feature class as " + out_fc)
+    if arcpy.Exists(out_fc):
+        arcpy.Delete_management(out_fc)
+    arcpy.CreateFeatureclass_management(os.path.dirname(out_fc), os.path.basename(out_fc), "POLYLINE",
+                                        has_m="ENABLED" if desc.hasM else "DISABLED",
+                                        has_z="ENABLED" if desc.hasZ else "DISABLED",
+                                        spatial_reference=desc.spatialReference)
+    for f in fields:
+        arcpy.AddField_management(out_fc, f.name, FIELD_TYPES.get(f.type, "DOUBLE"), field_length=f.length)
+    arcpy.AddField_management(out_fc, "prdCond", "DOUBLE")
+    # a new shapefile is created with a placeholder field
+    if arcpy.ListFields(out_fc, "Id"):
+        arcpy.DeleteField_management(out_fc, "Id")
+    names = [f.name for f in fields]
+    line_pos = names.index("LineOID")
+    segments = 0
+    unmatched = 0
+    with arcpy.da.SearchCursor(in_fc, ["SHAPE@"] + names) as search, \
+            arcpy.da.InsertCursor(out_fc, ["SHAPE@"] + names + ["prdCond"]) as insert:
+        for row in search:
+            matched, value = index.get(row[1 + line_pos])
+            insert.insertRow(list(row) + [value])
+            segments += 1
+            unmatched += not matched
+    return segments, unmatched
+
+
+def predictTable(in_params, features, predict, chunk_rows=forest.TABLE_CHUNK_ROWS, cache=None):
+    """Predicts conductivity for a parameter table, one chunk of rows at a time.
+
+    Only one chunk of parameter values is held in memory; the predictions are
+    appended to arrays aligned with the LineOID values.
+
+    Args:
+        in_params: table of summarized model parameter values
+        features: list of predictor field names of the model, in column order
+        predict: function returning the predictions of an array of shape (rows, features)
+        chunk_rows: number of parameter table rows per chunk
+        cache: optional predcache.PredictionCache; rows found in it are not predicted
+
+    Returns:
+        line_oids: array of LineOID values
+        values: array of predicted conductivity values, NaN where undefined
+    """
+    line_oids = []
+    values = []
+    for chunk_oids, x in forest.iterParamChunks(in_params, features, chunk_rows):
+        values.append(cache.predict(x, predict) if cache else predict(x))
+        line_oids.append(chunk_oids)
+        del x
+    if not line_oids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    return np.concatenate(line_oids), np.concatenate(values)
+
+
+def openModel(modelPath, forestPath, compiledPath):
+    """Opens the compiled Random Forest model, compiling it again when the .rdata model changed.
+
+    Args:
+        modelPath: path of the .rdata file of the model
+        forestPath: folder of the exported trees of the model
+        compiledPath: compiled forest file
 
     Returns:
-        Stream network polyline feature class, with field removed"""
-
-    arcpy.AddMessage("Cleaning up final output...")
-    field_obj_list = arcpy.ListFields(in_fc)
-    field_name_list = []
-    for f in field_obj_list:
-        if not f.type == "Geometry" \
-                and not f.type == "OID" \
-                and not f.name == "LineOID"\
-                and not f.name == 'error_code'\
-                and not f.name == 'prdCond':
-            field_name_list.append(str(f.name))
-    arcpy.DeleteField_management(in_fc, field_name_list)
+        CompiledForest, or None if the trees of the model cannot be exported or
+        written, so the model is evaluated in R.
+    """
+    features = [p[0] for p in polystat_cond.PARAM_LIST]
+    if forest.isCompiledCurrent(compiledPath, modelPath, features):
+        return forest.CompiledForest(compiledPath)
+    arcpy.AddMessage("Exporting the Random Forest model trees for in-process prediction...")
+    try:
+        if not os.path.isdir(os.path.dirname(compiledPath)):
+            os.makedirs(os.path.dirname(compiledPath))
+        if not forest.exportForest(modelPath, forestPath):
+            if os.path.isfile(compiledPath):
+                arcpy.AddWarning("The Random Forest model changed, but its trees could not be exported again.")
+                return None
+            # trees exported earlier are only compiled if they were exported from this model file
+            if not forest.isForest(forestPath):
+                return None
+            if not forest.isExportedFrom(forestPath, modelPath):
+                arcpy.AddWarning("The exported trees in {0} were not exported from {1}, so they are not used."
+                                 .format(forestPath, modelPath))
+                return None
+        forest.compileForest(forestPath, compiledPath, modelPath, features)
+    except (IOError, OSError) as e:
+        arcpy.AddWarning("The compiled Random Forest model could not be written ({0}), so R is used instead."
+                         .format(e))
+        return None
+    return forest.CompiledForest(compiledPath)
+
+
+def predictParams(in_params, mWriter, chunk_rows=forest.TABLE_CHUNK_ROWS, cache_dir=''):
+    """Predicts conductivity for the rows of a parameter table.
+
+    The trees of the model exported from R are evaluated in-process when they
+    are available, otherwise a running R prediction worker is used, and the
+    one-shot R script is the last resort. The prediction engine and the run
+    statistics are recorded in the metadata of the run.
+
+    Args:
+        in_params: table of summarized model parameter values, or a dictionary of LineOID and parameter
+        name: sequence of values (in-memory columnar data handed over by the Pre-process step)
+        mWriter: metadata writer of the run
+        chunk_rows: number of parameter table rows predicted at once
+        cache_dir: folder of the prediction cache and of the exported and compiled model (a folder in the
+        temporary folder by default)
+
+    Returns:
+        line_oids: sequence of LineOID values
+        prdCond: sequence of predicted conductivity values aligned with line_oids, NaN where undefined
+    """
+    cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), CACHE_FOLDER)
+
+    # variables for the subprocess function
+    scriptPathName = os.path.realpath(__file__)
+    pathName = os.path.dirname(scriptPathName)
+    scriptName = 'condRF.R'
+    modelName = 'rf17bCnd9.rdata'
+    rScriptPath = os.path.join(pathName, scriptName)
+    modelPath = os.path.join(pathName, modelName)
+    # the toolbox folder may not be writable, so the exported and compiled model is kept with the cache
+    forestPath = os.path.join(cache_dir, MODEL_RF + forest.FOREST_EXT)
+    compiledPath = os.path.join(cache_dir, MODEL_RF + forest.COMPILED_EXT)
+
+    # the trees of the model are exported from R and compiled once, then evaluated in-process
+    openStart = time.time()
+    model = openModel(modelPath, forestPath, compiledPath)
+    if model is not None:
+        mWriter.currentRun.addResult("ModelOpenSeconds", str(round(time.time() - openStart, 3)))
+
+    prdCond = None
+    predictStart = time.time()
+    # rows with the parameter values of an earlier prediction are taken from the cache, separately for each
+    # version of the model file, whichever engine predicts them
+    sourceHash = incremental.contentHash(modelPath) if model is None else model.source_hash
+    cache = predcache.PredictionCache(cache_dir, MODEL_RF + ":" + sourceHash)
+    if model is not None:
+        arcpy.AddMessage("Predicting conductivity using the compiled Random Forest model...")
+        line_oids, prdCond = predictTable(in_params, model.features, model.predict, chunk_rows, cache)
+        mWriter.currentRun.addResult("PredictionEngine", "NUMPY")
+    else:
+        # a running worker keeps the model loaded in R across runs
+        workerModel, features = rworker.pingWorker()
+        if workerModel == MODEL_RF:
+            arcpy.AddMessage("Predicting conductivity using the running R prediction worker...")
+            try:
+                line_oids, prdCond = predictTable(in_params, features,
+                                                  lambda x: rworker.predictWorker(x, features), chunk_rows, cache)
+                mWriter.currentRun.addResult("PredictionEngine", "R_WORKER")
+            except (socket.error, RuntimeError) as e:
+                arcpy.AddWarning("The R prediction worker failed ({0}), so the R script is run instead.".format(e))
+    evicted = cache.close()
+    if cache.error:
+        arcpy.AddWarning("The prediction cache could not be used ({0}), so rows were predicted without it."
+                         .format(cache.error))
+    mWriter.currentRun.addResult("PredictionCacheHits", str(cache.hits))
+    mWriter.currentRun.addResult("PredictionCacheMisses", str(cache.misses))
+    mWriter.currentRun.addResult("PredictionCacheHitRate", str(round(cache.hitRate(), 4)))
+    mWriter.currentRun.addResult("PredictionCacheEvictions", str(evicted))
+    if prdCond is None:
+        arcpy.AddMessage("Predicting conductivity using Random Forest model in R...")
+        # the R script reads and writes its files in a temporary folder
+        r_dir = tempfile.mkdtemp(prefix="predict_cond_")
+        if isinstance(in_params, dict):
+            names = [name for name in in_params if name != "LineOID"]
+            writer = tablewriter.ColumnarTableWriter(os.path.join(r_dir, "params" + tablewriter.COLUMNAR_EXT), names)
+            writer.writeColumns(in_params["LineOID"], in_params)
+            in_params = writer.close()
+        argR = [modelPath, r_dir, in_params] # list of arguments for condRF.R script
+
+        cmd = ['Rscript', rScriptPath] + argR # construct R command line argument
+
+        # send command to predict_conductivity.r
+        process = subprocess.Popen(cmd, universal_newlines=True, shell=True)
+        process.wait()
+        mWriter.currentRun.addResult("PredictionEngine", "R")
+
+        # predictive output, written by condRF.R in the format of the parameter table
+        if tablewriter.isColumnar(in_params):
+            columns = tablewriter.readColumnar(os.path.join(r_dir, "predicted_cond" + tablewriter.COLUMNAR_EXT),
+                                               ["LineOID", "prdCond"])
+            line_oids, prdCond = columns["LineOID"].tolist(), columns["prdCond"].tolist()
+            del columns
+        else:
+            line_oids, prdCond = readPredictionCSV(os.path.join(r_dir, "predicted_cond.csv"))
+        shutil.rmtree(r_dir, ignore_errors=True)
+    predictSeconds = max(time.time() - predictStart, 1e-6)
+    mWriter.currentRun.addResult("PredictedRows", str(len(line_oids)))
+    mWriter.currentRun.addResult("RowsPerSecond", str(round(len(line_oids) / predictSeconds, 1)))
+    return line_oids, prdCond
+
+
+def writePredictions(in_fc, line_oids, prdCond, out_fc, mWriter):
+    """Joins the predicted conductivity values to the stream network, and records the join in the metadata.
+
+    Args:
+        in_fc: Input stream network polyline feature class
+        line_oids: sequence of LineOID values
+        prdCond: sequence of predicted conductivity values aligned with line_oids
+        out_fc: Output stream network polyline feature class
+        mWriter: metadata writer of the run
+    """
+    arcpy.AddMessage("Joining predicted conductivity results to the stream network...")
+    segments, unmatched = joinPredictions(in_fc, line_oids, prdCond, out_fc)
+    mWriter.currentRun.addResult("SegmentsWritten", str(segments))
+    mWriter.currentRun.addResult("UnmatchedSegments", str(unmatched))
+    if unmatched:
+        arcpy.AddWarning("{0} of {1} stream segments have no predicted conductivity for their LineOID.".format(
+            unmatched, segments))
     return
 
 
@@ -115,7 +422,7 @@ def metadata(ecXML, in_fc, out_fc, real_id):
     ecXML.write()
 
 
-def main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name):
+def main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name, chunk_rows='', cache_dir=''):
     """Main processing function for the Predict Conductivity tool.
 
     Args:
@@ -124,8 +431,13 @@ def main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name):
         in_xml: the project XML file generated by polystat_cond.py
         out_fc: Output stream network polyline feature class, with predicted conductivity values joined
         as new attribute fields.
+        chunk_rows: number of parameter table rows predicted at once
+        cache_dir: folder of the prediction cache (a folder in the temporary folder by default)
     """
 
+    chunk_rows = max(int(chunk_rows), 1) if chunk_rows else forest.TABLE_CHUNK_ROWS
+    cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), CACHE_FOLDER)
+
     in_fc_dir = os.path.dirname(in_fc)
     in_fc_name = os.path.basename(in_fc)
     out_dir = os.path.dirname(out_fc)
@@ -146,9 +458,10 @@ def main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name):
     mWriter.currentRun.addParameter("Environmental parameter table", in_params)
     mWriter.currentRun.addParameter("Predicted conductivity feature class", out_fc)
     mWriter.currentRun.addParameter("Output metadata XML", out_xml)
+    mWriter.currentRun.addParameter("Prediction chunk size (rows)", str(chunk_rows))
+    mWriter.currentRun.addParameter("Prediction cache", cache_dir)
 
     if checkLineOID(in_fc) == True:
-        arcpy.AddMessage("Predicting conductivity using Random Forest model in R...")
         gc.enable()
 
         # initiate Riverscapes project XML object and start processing timestamp
@@ -156,36 +469,10 @@ def main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name):
             rs_xml = "{0}\\{1}".format(rs_dir, "project.rs.xml")
             projectXML = meta_rs.ProjectXML("existing", rs_xml)
 
-        # variables for the subprocess function
-        scriptPathName = os.path.realpath(__file__)
-        pathName = os.path.dirname(scriptPathName)
-        scriptName = 'condRF.R'
-        modelName = 'rf17bCnd9.rdata'
-        rScriptPath = os.path.join(pathName, scriptName)
-        modelPath = os.path.join(pathName, modelName)
-
-        argR = [modelPath, out_dir, in_params] # list of arguments for condRF.R script
-
-        cmd = ['Rscript', rScriptPath] + argR # construct R command line argument
-
-        # send command to predict_conductivity.r
-        process = subprocess.Popen(cmd, universal_newlines=True, shell=True)
-        process.wait()
-
-        # predictive output
-        predictedCondCSV = out_dir + "\\predicted_cond.csv"
-        arcpy.TableToTable_conversion(predictedCondCSV, out_dir, r"predicted_cond.dbf")
+        line_oids, prdCond = predictParams(in_params, mWriter, chunk_rows, cache_dir)
 
         # join conductivity predictive output to stream segment feature class
-        arcpy.AddMessage("Joining predicted conductivity results to the stream network...")
-        arcpy.MakeTableView_management(out_dir + r"\predicted_cond.dbf", "predicted_cond_view")
-        arcpy.MakeFeatureLayer_management(in_fc, "in_fc_lyr")
-        arcpy.FeatureClassToFeatureClass_conversion("in_fc_lyr", r"in_memory", "in_fc_tmp")
-        arcpy.JoinField_management(r"in_memory\in_fc_tmp", "LineOID", "predicted_cond_view", "LineOID")
-        arcpy.MakeFeatureLayer_management(r"in_memory\in_fc_tmp", "join_fc_lyr")
-        arcpy.AddMessage("Exporting final feature class as " + out_fc)
-        arcpy.CopyFeatures_management("join_fc_lyr", out_fc)
-        removeFields(out_fc)
+        writePredictions(in_fc, line_oids, prdCond, out_fc, mWriter)
 
         # finalize and write generic XML file
         tool_status = "Success"
@@ -208,8 +495,6 @@ def main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name):
 
         # clean up
         clear_inmemory()
-        arcpy.Delete_management(out_dir + r"\predicted_cond.dbf")
-        arcpy.Delete_management(out_dir + r"\predicted_cond.csv")
 
         arcpy.AddMessage("Conductivity prediction process complete!")
 
@@ -219,4 +504,4 @@ def main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name):
     return
 
 if __name__ == "__main__":
-    main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name)
\ No newline at end of file
+    main(in_fc, in_params, out_fc, rs_bool, rs_dir, rs_proj_name, rs_real_name, chunk_rows, cache_dir)
\ No newline at end of file
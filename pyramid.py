@@ -0,0 +1,346 @@
+# file name:	pyramid.py
+# description:	Sum/count pyramids of the environmental parameter rasters for the PYRAMID zonal statistics engine.
+#               Level k of a pyramid holds the sum and the number of valid cells of every block of 2^k by 2^k
+#               raster cells, aligned to the origin of the raster.  The cells of a catchment are decomposed into the
+#               largest blocks it fully covers plus the single cells left along its edge, so the exact sum and count
+#               of a large catchment cost a number of lookups proportional to its perimeter rather than its area.
+#               A pyramid covers the whole raster in square tiles, written as memory-mapped files when a catchment
+#               first reaches them, so later runs on the same raster reuse the tiles of any catchment extent.
+# dependencies: numpy
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import checkpoint
+import zonal
+
+# constants
+PYRAMID_LEVELS = 8 # number of coarse pyramid levels above the raster cells (blocks of up to 256 by 256 cells)
+PYRAMID_VERSION = 2 # version of the pyramid file layout
+PYRAMID_MANIFEST = "manifest.json" # manifest of each pyramid directory, touched whenever the pyramid is used
+PYRAMID_TILE = 2048 # maximum number of rows and columns of a pyramid tile, built only when a catchment reaches it
+PYRAMID_CACHE_MB = 8192 # default size limit of a pyramid folder; the least recently used pyramids are evicted
+
+
+def sourceStamp(source):
+    """Returns a JSON-serializable identity of the data of a raster source.
+
+    A stack band is identified by its checksum, and a raster dataset by its path
+    and the size and time of its files (see checkpoint.pathStamp), so a pyramid
+    is built again when the raster changes, including rasters in a file
+    geodatabase, which are stamped with the files of the geodatabase.
+    """
+    if hasattr(source, "stack"):
+        return source.stack.manifest["bands"][source.band]["checksum"]
+    return [os.path.abspath(source.path), checkpoint.pathStamp(source.path)]
+
+
+def gridOrigin(grid):
+    """Returns the (x, y) coordinates of the top left corner of the raster of a window."""
+    return grid.x_min - grid.col_off * grid.cell_w, grid.y_max + grid.row_off * grid.cell_h
+
+
+def pyramidKey(source, grid):
+    """Returns a hexadecimal key of the pyramid of a raster source.
+
+    The key depends on the raster and the cell alignment of the window, not on the
+    extent of the window, so every window of the raster shares one pyramid.
+    """
+    x, y = gridOrigin(grid)
+    content = [PYRAMID_VERSION, PYRAMID_LEVELS, sourceStamp(source),
+               [round(x, 6), round(y, 6), round(grid.cell_w, 6), round(grid.cell_h, 6)]]
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def windowSpans(spans, grid):
+    """Returns ZoneSpans of a window in the rows and columns of its raster (see zonal.RasterGrid row_off)."""
+    return zonal.ZoneSpans(spans.zones, spans.rows + grid.row_off, spans.starts + grid.col_off,
+                           spans.ends + grid.col_off, spans.nzones)
+
+
+class SumPyramid(object):
+    """Sum/count pyramid of a raster, opened from its directory.
+
+    Each tile of tile by tile cells is stored as two flat files, with the sums
+    (float64) and the valid cell counts (int32) of every level of the tile one
+    after the other. Cells outside the raster have a count of zero.
+
+    Args:
+        path: directory of the pyramid files
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, PYRAMID_MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.levels = self.manifest["levels"]
+        self.tile = self.manifest["tile"]
+        sizes = [(self.tile >> k) ** 2 for k in range(self.levels + 1)]
+        self.offsets = np.cumsum([0] + sizes)
+        self.opened = {}
+
+    def tilePath(self, tile_row, tile_col, part):
+        """Returns the path of the "sum" or "count" file of a tile."""
+        return os.path.join(self.path, "T{0}_{1}_{2}.npy".format(tile_row, tile_col, part))
+
+    def hasTile(self, tile_row, tile_col):
+        """Checks if a tile is built. The count file is written last."""
+        return os.path.isfile(self.tilePath(tile_row, tile_col, "count"))
+
+    def lookup(self, level, rows, cols):
+        """Looks up the sums and valid cell counts of blocks of a level.
+
+        Args:
+            level: pyramid level
+            rows, cols: arrays of block rows and columns of the level in the raster
+
+        Returns:
+            sums, counts: arrays of the sums and valid cell counts of the blocks
+        """
+        size = self.tile >> level
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        sums = np.zeros(len(rows))
+        counts = np.zeros(len(rows), dtype=np.int64)
+        if len(rows) == 0:
+            return sums, counts
+        ntc = int(cols.max()) // size + 1
+        tiles = (rows // size) * ntc + cols // size
+        order = np.argsort(tiles, kind="mergesort")
+        bounds = np.nonzero(np.r_[True, tiles[order][1:] != tiles[order][:-1], True])[0]
+        for i in range(len(bounds) - 1):
+            idx = order[bounds[i]:bounds[i + 1]]
+            tile = (int(tiles[idx[0]]) // ntc, int(tiles[idx[0]]) % ntc)
+            if tile not in self.opened:
+                self.opened[tile] = (np.load(self.tilePath(tile[0], tile[1], "sum"), mmap_mode="r"),
+                                     np.load(self.tilePath(tile[0], tile[1], "count"), mmap_mode="r"))
+            tile_sums, tile_counts = self.opened[tile]
+            flat = self.offsets[level] + (rows[idx] % size) * size + cols[idx] % size
+            sums[idx] = tile_sums[flat]
+            counts[idx] = tile_counts[flat]
+        return sums, counts
+
+
+def touchedTiles(spans, tile):
+    """Returns the sorted (tile row, tile column) pairs of the tiles crossed by ZoneSpans of a raster."""
+    first = spans.starts // tile
+    n = np.where(spans.ends > spans.starts, (spans.ends - 1) // tile - first + 1, 0)
+    idx = np.repeat(np.arange(len(n)), n)
+    if len(idx) == 0:
+        return []
+    cols = first[idx] + np.arange(len(idx)) - np.repeat(np.cumsum(n) - n, n)
+    rows = spans.rows[idx] // tile
+    ntc = int(cols.max()) + 1
+    keys = np.unique(rows * ntc + cols)
+    return [(int(k // ntc), int(k % ntc)) for k in keys]
+
+
+def buildTile(source, grid, pyramid, tile_row, tile_col):
+    """Builds one tile of the sum/count pyramid of a raster.
+
+    The cells of the tile inside the raster are read once, and every level is
+    aggregated from the level below it (2 by 2 blocks).
+
+    Args:
+        source: zonal.RasterSource or envstack.StackBand to read
+        grid: zonal.RasterGrid window of the raster, giving its cell alignment
+        pyramid: SumPyramid to add the tile to
+        tile_row, tile_col: position of the tile in the raster, in tiles
+    """
+    size = pyramid.tile
+    x, y = gridOrigin(grid)
+    # the bounding box is kept half a cell inside the tile, so it snaps to the tile cells exactly
+    bounds = (x + (tile_col * size + 0.5) * grid.cell_w, y - ((tile_row + 1) * size - 0.5) * grid.cell_h,
+              x + ((tile_col + 1) * size - 0.5) * grid.cell_w, y - (tile_row * size + 0.5) * grid.cell_h)
+    window = source.window(bounds, grid.cell_w)
+    s = np.zeros((size, size))
+    c = np.zeros((size, size), dtype=np.int32)
+    if window.nrows > 0 and window.ncols > 0:
+        values = source.read(window)
+        ok = ~np.isnan(values)
+        r0 = window.row_off - tile_row * size
+        c0 = window.col_off - tile_col * size
+        s[r0:r0 + window.nrows, c0:c0 + window.ncols] = np.where(ok, values, 0.0)
+        c[r0:r0 + window.nrows, c0:c0 + window.ncols] = ok
+        del values, ok
+    sums = [s.reshape(-1)]
+    counts = [c.reshape(-1)]
+    for k in range(1, pyramid.levels + 1):
+        n = s.shape[0] // 2
+        s = s.reshape(n, 2, n, 2).sum(axis=(1, 3))
+        c = c.reshape(n, 2, n, 2).sum(axis=(1, 3)).astype(np.int32)
+        sums.append(s.reshape(-1))
+        counts.append(c.reshape(-1))
+    for part, levels in (("sum", sums), ("count", counts)):
+        path = pyramid.tilePath(tile_row, tile_col, part)
+        tmp_path = path[:-len(".npy")] + ".tmp.npy"
+        np.save(tmp_path, np.concatenate(levels))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # built at the same time by another run
+            if not os.path.isfile(path):
+                raise
+            os.remove(tmp_path)
+
+
+def pyramidSize(path):
+    """Returns the size of the files of a pyramid directory, in bytes."""
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def evictPyramids(pyramid_dir, max_mb=PYRAMID_CACHE_MB, keep=None):
+    """Deletes the least recently used pyramids until a pyramid folder fits its size limit.
+
+    Args:
+        pyramid_dir: directory holding the cached pyramids
+        max_mb: maximum size of the pyramids, in megabytes
+        keep: optional path of a pyramid in use, which is never deleted
+
+    Returns:
+        Number of pyramids deleted.
+    """
+    entries = []
+    for name in os.listdir(pyramid_dir):
+        path = os.path.join(pyramid_dir, name)
+        manifest = os.path.join(path, PYRAMID_MANIFEST)
+        if os.path.isfile(manifest):
+            entries.append((os.path.getmtime(manifest), path, pyramidSize(path)))
+    total = sum(e[2] for e in entries)
+    deleted = 0
+    for used, path, nbytes in sorted(entries):
+        if total <= max_mb * 1024 * 1024:
+            break
+        if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= nbytes
+        deleted += 1
+    return deleted
+
+
+def openPyramid(source, grid, spans, pyramid_dir, memory_mb=zonal.MEMORY_MB, max_mb=PYRAMID_CACHE_MB):
+    """Opens the pyramid of a raster, building the tiles reached by a set of zones that are not cached.
+
+    Tiles that none of the zones reaches are not read. The pyramid is marked as
+    used, and the least recently used pyramids of pyramid_dir are then evicted
+    beyond its size limit (see evictPyramids).
+
+    Args:
+        source: zonal.RasterSource or envstack.StackBand
+        grid: zonal.RasterGrid window of the zones
+        spans: ZoneSpans on the window
+        pyramid_dir: directory holding the cached pyramids
+        memory_mb: memory budget for a raster tile while building, in megabytes; it
+        sets the tile size of a new pyramid, up to PYRAMID_TILE
+        max_mb: size limit of pyramid_dir, in megabytes
+
+    Returns:
+        pyramid: SumPyramid
+        tiles: number of raster tiles read to build it (0 if all were cached)
+    """
+    path = os.path.join(pyramid_dir, pyramidKey(source, grid))
+    manifest = os.path.join(path, PYRAMID_MANIFEST)
+    if not os.path.isfile(manifest):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        top = 2 ** PYRAMID_LEVELS
+        size = min(max(zonal.tileSize(memory_mb, "PYRAMID") // top * top, top), PYRAMID_TILE)
+        with open(manifest, "w") as f:
+            json.dump({"version": PYRAMID_VERSION, "levels": PYRAMID_LEVELS, "tile": size}, f)
+    else:
+        os.utime(manifest, None)
+    pyr = SumPyramid(path)
+    tiles = 0
+    for tile_row, tile_col in touchedTiles(windowSpans(spans, grid), pyr.tile):
+        if not pyr.hasTile(tile_row, tile_col):
+            buildTile(source, grid, pyr, tile_row, tile_col)
+            tiles += 1
+    if tiles:
+        evictPyramids(pyramid_dir, max_mb, keep=path)
+    return pyr, tiles
+
+
+def coveredBlocks(spans, size):
+    """Finds the aligned blocks of cells fully covered by each zone.
+
+    Args:
+        spans: ZoneSpans without overlapping spans within a zone
+        size: number of rows and columns of a block
+
+    Returns:
+        zones, block_rows, block_cols: arrays identifying each covered block
+    """
+    first = -(-spans.starts // size)
+    n = np.maximum(spans.ends // size - first, 0)
+    idx = np.repeat(np.arange(len(n)), n)
+    cols = first[idx] + np.arange(len(idx)) - np.repeat(np.cumsum(n) - n, n)
+    if len(idx) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    zones = spans.zones[idx]
+    block_rows = spans.rows[idx] // size
+    ncb = int(cols.max()) + 1
+    nrb = int(block_rows.max()) + 1
+    keys = np.sort((zones * nrb + block_rows) * ncb + cols)
+    # a block is covered once each of its rows has a span across it
+    bounds = np.nonzero(np.r_[True, keys[1:] != keys[:-1], True])[0]
+    full = keys[bounds[:-1]][np.diff(bounds) == size]
+    return full // (nrb * ncb), (full // ncb) % nrb, full % ncb
+
+
+def blockSpans(zones, block_rows, block_cols, size, nzones):
+    """Returns the ZoneSpans of the cells of blocks of a zone."""
+    n = len(zones)
+    rows = np.repeat(block_rows * size, size) + np.tile(np.arange(size), n)
+    starts = np.repeat(block_cols * size, size)
+    return zonal.ZoneSpans(np.repeat(zones, size), rows, starts, starts + size, nzones)
+
+
+def pyramidZoneSums(pyramid, spans, grid, max_cells=zonal.CHUNK_CELLS):
+    """Sums the valid cells of a raster per zone from its sum/count pyramid.
+
+    From the coarsest level down, the blocks fully covered by the cells of a zone
+    that are not yet accounted for are looked up, and their cells are removed from
+    the zone. The cells left along the zone edge are looked up one by one in the
+    bottom level. The result is exact.
+
+    Args:
+        pyramid: SumPyramid of the raster, with the tiles of the spans built (see openPyramid)
+        spans: ZoneSpans without overlapping spans within a zone
+        grid: zonal.RasterGrid window of the spans
+        max_cells: maximum number of edge cells gathered into memory at once
+
+    Returns:
+        sums: array with the sum of valid cell values per zone
+        counts: array with the number of valid cells per zone
+        lookups: number of blocks and cells looked up
+    """
+    nzones = spans.nzones
+    sums = np.zeros(nzones)
+    counts = np.zeros(nzones, dtype=np.int64)
+    lookups = 0
+    # blocks are aligned to the raster origin, not to the window
+    remaining = windowSpans(spans, grid)
+    for k in range(pyramid.levels, 0, -1):
+        size = 2 ** k
+        zones, block_rows, block_cols = coveredBlocks(remaining, size)
+        if len(zones) == 0:
+            continue
+        block_sums, block_counts = pyramid.lookup(k, block_rows, block_cols)
+        sums += np.bincount(zones, weights=block_sums, minlength=nzones)
+        counts += np.bincount(zones, weights=block_counts, minlength=nzones).astype(np.int64)
+        lookups += len(zones)
+        remaining = zonal.spanDifference(remaining, blockSpans(zones, block_rows, block_cols, size, nzones))
+    if len(remaining.ends) == 0:
+        return sums, counts, lookups
+    ncols = int(remaining.ends.max())
+    for chunk in zonal.chunkSpans(remaining, max_cells):
+        flat, zone = chunk.cellIndex(ncols)
+        cell_sums, cell_counts = pyramid.lookup(0, flat // ncols, flat % ncols)
+        sums += np.bincount(zone, weights=cell_sums, minlength=nzones)
+        counts += np.bincount(zone, weights=cell_counts, minlength=nzones).astype(np.int64)
+        lookups += len(flat)
+    return sums, counts, lookups
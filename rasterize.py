@@ -0,0 +1,456 @@
+# file name:	rasterize.py
+# description:	Batch scanline rasterizer for catchment area polygons.  All polygons of a feature class are read in a
+#               single cursor pass and burned together into compact row spans of raster cells, using the same
+#               CELL_CENTER rule as PolygonToRaster_conversion.  The spans feed the array-based zonal statistics
+#               engines in zonal.py, so no intermediate zone rasters are written.  Footprints can be kept in an
+#               on-disk cache, so polygons that did not change are not rasterized again on later runs.
+# dependencies: numpy, ESRI arcpy module (catchment feature classes, imported where they are read)
+
+import os
+import time
+import zlib
+import struct
+import hashlib
+import sqlite3
+import numpy as np
+import zonal
+
+# constants
+MAX_CROSSINGS = 20000000 # maximum number of edge/row crossings held in memory at once while burning
+SPAN_CACHE_MB = 2048 # default size limit of the rasterized footprint cache, in megabytes
+FOOTPRINT_VERSION = 3 # version of the cached footprints; footprints of other versions are rasterized again
+
+
+class CatchmentEdges(object):
+    """Boundary edges of a set of catchment polygons.
+
+    Every ring of a polygon (the exterior and interior rings of each part) is a
+    closed chain of its own, so under the even-odd rule interior rings remain
+    holes and all parts of a multipart polygon are filled.
+
+    Args:
+        oids: list of ObjectIDs; the zone index of a polygon is its position in this list
+        zones: array with the zone index of each edge
+        x0, y0, x1, y1: arrays with the start and end coordinates of each edge
+        structure: optional list with the ring structure of each polygon, an int64 array holding for
+        each part its number of rings followed by the number of edges of each of its rings
+    """
+
+    def __init__(self, oids, zones, x0, y0, x1, y1, structure=None):
+        self.oids = oids
+        self.zones = zones
+        self.x0 = x0
+        self.y0 = y0
+        self.x1 = x1
+        self.y1 = y1
+        self.structure = structure
+        self.nzones = len(oids)
+
+    def bounds(self):
+        """Returns the (x_min, y_min, x_max, y_max) tuple covering all polygons."""
+        if len(self.zones) == 0:
+            return (0.0, 0.0, 0.0, 0.0)
+        return (float(np.minimum(self.x0, self.x1).min()), float(np.minimum(self.y0, self.y1).min()),
+                float(np.maximum(self.x0, self.x1).max()), float(np.maximum(self.y0, self.y1).max()))
+
+
+def readCatchmentEdges(in_fc, sr=None):
+    """Reads the boundary edges of all catchment polygons in a single pass.
+
+    Args:
+        in_fc: Input upstream catchment area polygon feature class
+        sr: spatial reference the coordinates are returned in
+
+    Returns:
+        CatchmentEdges of all polygons, with zones numbered in cursor order.
+    """
+    import arcpy
+    oids = []
+    zone_rings = []
+    zone_parts = []
+    with arcpy.da.SearchCursor(in_fc, ["OID@", "SHAPE@WKB"], spatial_reference=sr) as cursor:
+        for oid, wkb in cursor:
+            oids.append(oid)
+            parts = []
+            zone_rings.append(wkbRings(wkb, parts) if wkb else [])
+            zone_parts.append(parts)
+    return ringEdges(oids, zone_rings, zone_parts)
+
+
+def wkbRings(wkb, parts=None):
+    """Returns the rings of a polygon or multipolygon in well-known binary (WKB) format.
+
+    Args:
+        wkb: WKB of the geometry, with or without z and m values
+        parts: optional list, to which the number of rings of each polygon part is appended
+
+    Returns:
+        List of float64 arrays of shape (vertices, 2), one per exterior or interior ring of each part.
+
+    Raises:
+        ValueError: the geometry is not a polygon or multipolygon
+    """
+    rings = []
+    readWkbPolygon(bytes(wkb), 0, rings, parts)
+    return rings
+
+
+def readWkbPolygon(data, pos, rings, parts=None):
+    """Appends the rings of the WKB polygon or multipolygon starting at pos to rings, and the number of
+    rings of each of its polygon parts to parts (if given).
+
+    Returns:
+        Position of the first byte after the geometry.
+    """
+    order = "<" if struct.unpack_from("B", data, pos)[0] == 1 else ">"
+    wkb_type, count = struct.unpack_from(order + "II", data, pos + 1)
+    pos += 9
+    # z and m values are flagged in the high bits (EWKB) or in the thousands of the type (ISO WKB)
+    iso = (wkb_type & 0xFFFF) // 1000
+    dims = 2 + int(bool(wkb_type & 0x80000000) or iso in (1, 3)) + int(bool(wkb_type & 0x40000000) or iso in (2, 3))
+    base = (wkb_type & 0xFFFF) % 1000
+    if base == 3:
+        if parts is not None:
+            parts.append(count)
+        for i in range(count):
+            n = struct.unpack_from(order + "I", data, pos)[0]
+            xyzm = np.frombuffer(data, order + "f8", n * dims, pos + 4).reshape(n, dims)
+            rings.append(xyzm[:, :2].astype(np.float64))
+            pos += 4 + 8 * n * dims
+    elif base == 6:
+        for i in range(count):
+            pos = readWkbPolygon(data, pos, rings, parts)
+    else:
+        raise ValueError("Only polygon geometries can be rasterized.")
+    return pos
+
+
+def ringEdges(oids, zone_rings, zone_parts=None):
+    """Builds the boundary edges of catchment polygons from their rings.
+
+    Args:
+        oids: list of ObjectIDs
+        zone_rings: list with the rings of each polygon in oids, as arrays of shape (vertices, 2)
+        zone_parts: optional list with the number of rings of each part of each polygon (see wkbRings);
+        by default all rings of a polygon belong to one part
+
+    Returns:
+        CatchmentEdges with every ring closed on its own.
+    """
+    zones = []
+    x0 = []
+    y0 = []
+    x1 = []
+    y1 = []
+    structure = []
+    for zone, rings in enumerate(zone_rings):
+        parts = zone_parts[zone] if zone_parts is not None else [len(rings)]
+        ring_edges = []
+        for ring in rings:
+            if len(ring) > 1 and (ring[0] == ring[-1]).all():
+                ring = ring[:-1]
+            ring_edges.append(len(ring) if len(ring) >= 3 else 0)
+            if len(ring) < 3:
+                continue
+            # each vertex is joined to the next vertex of the same ring, and the last vertex back to the first
+            nxt = np.roll(ring, -1, axis=0)
+            zones.append(np.repeat(np.int64(zone), len(ring)))
+            x0.append(ring[:, 0])
+            y0.append(ring[:, 1])
+            x1.append(nxt[:, 0])
+            y1.append(nxt[:, 1])
+        layout = []
+        first = 0
+        for count in parts:
+            layout.append(count)
+            layout.extend(ring_edges[first:first + count])
+            first += count
+        structure.append(np.array(layout, dtype=np.int64))
+    if not zones:
+        empty = np.zeros(0)
+        return CatchmentEdges(oids, np.zeros(0, dtype=np.int64), empty, empty, empty, empty, structure)
+    return CatchmentEdges(oids, np.concatenate(zones), np.concatenate(x0), np.concatenate(y0),
+                          np.concatenate(x1), np.concatenate(y1), structure)
+
+
+def burnZones(edges, grid, max_crossings=MAX_CROSSINGS):
+    """Burns all catchment polygons into row spans of a raster grid.
+
+    A cell is covered by a polygon if its center falls inside the polygon
+    (CELL_CENTER rule, even-odd fill). All polygons are burned together, in
+    groups of whole polygons holding at most max_crossings edge/row crossings.
+
+    Args:
+        edges: CatchmentEdges in the coordinate system of the grid
+        grid: zonal.RasterGrid to burn the polygons into
+        max_crossings: maximum number of edge/row crossings processed at once
+
+    Returns:
+        zonal.ZoneSpans sorted by zone, row and column.
+    """
+    zones = []
+    rows = []
+    starts = []
+    ends = []
+    if len(edges.zones) > 0 and grid.nrows > 0 and grid.ncols > 0:
+        y_lo = np.minimum(edges.y0, edges.y1)
+        y_hi = np.maximum(edges.y0, edges.y1)
+        # rows whose cell center y satisfies y_lo <= y < y_hi
+        first = np.floor((grid.y_max - y_hi) / grid.cell_h - 0.5).astype(np.int64) + 1
+        last = np.floor((grid.y_max - y_lo) / grid.cell_h - 0.5).astype(np.int64)
+        first = np.maximum(first, 0)
+        last = np.minimum(last, grid.nrows - 1)
+        n = np.maximum(last - first + 1, 0)
+
+        # split the edges into groups of whole polygons
+        zone_start = np.ones(len(n), dtype=bool)
+        zone_start[1:] = edges.zones[1:] != edges.zones[:-1]
+        bounds = np.append(np.nonzero(zone_start)[0], len(n))
+        cum = np.concatenate([[0], np.cumsum(n)])[bounds]
+        i = 0
+        while i < len(bounds) - 1:
+            j = max(int(np.searchsorted(cum, cum[i] + max_crossings, side="right")) - 1, i + 1)
+            sel = slice(bounds[i], bounds[j])
+            burned = burnEdges(edges.zones[sel], edges.x0[sel], edges.y0[sel], edges.x1[sel], edges.y1[sel],
+                               first[sel], n[sel], grid)
+            zones.append(burned[0])
+            rows.append(burned[1])
+            starts.append(burned[2])
+            ends.append(burned[3])
+            i = j
+    if not zones:
+        return zonal.ZoneSpans([], [], [], [], edges.nzones)
+    return zonal.ZoneSpans(np.concatenate(zones), np.concatenate(rows), np.concatenate(starts),
+                           np.concatenate(ends), edges.nzones)
+
+
+def burnEdges(zones, x0, y0, x1, y1, first, n, grid):
+    """Burns a group of polygon edges into row spans.
+
+    Args:
+        zones: array with the zone index of each edge
+        x0, y0, x1, y1: arrays with the start and end coordinates of each edge
+        first: array with the first grid row crossed by each edge
+        n: array with the number of grid rows crossed by each edge
+        grid: zonal.RasterGrid to burn the edges into
+
+    Returns:
+        zones, rows, starts, ends: arrays describing the covered row spans
+    """
+    edge = np.repeat(np.arange(len(n)), n)
+    rows = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(n) - n, n)
+    yc = grid.y_max - (rows + 0.5) * grid.cell_h
+    xc = x0[edge] + (yc - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+    zc = zones[edge]
+    order = np.lexsort((xc, rows, zc))
+    xc = xc[order]
+    zc = zc[order][0::2]
+    rows = rows[order][0::2]
+    starts = np.clip(np.ceil((xc[0::2] - grid.x_min) / grid.cell_w - 0.5), 0, grid.ncols).astype(np.int64)
+    ends = np.clip(np.ceil((xc[1::2] - grid.x_min) / grid.cell_w - 0.5), 0, grid.ncols).astype(np.int64)
+    keep = ends > starts
+    return zc[keep], rows[keep], starts[keep], ends[keep]
+
+
+def zoneKeys(edges, grid):
+    """Returns a cache key for the footprint of each catchment polygon on a raster grid.
+
+    The key is a hash of the polygon's edges and ring structure (the rings of
+    each part and the edges of each ring), the spatial reference, the cell size
+    and the alignment of the grid origin, so it does not change when the
+    window of the grid moves. Cached footprints are therefore stored whole, not
+    clipped to the window they were first burned for.
+
+    Args:
+        edges: CatchmentEdges in the coordinate system of the grid
+        grid: zonal.RasterGrid the polygons are burned into
+
+    Returns:
+        List of hex digest strings, one per zone.
+    """
+    sr_name = grid.sr.name if grid.sr is not None else ""
+    x_align = round(grid.x_min - round(grid.x_min / grid.cell_w) * grid.cell_w, 6) + 0.0
+    y_align = round(grid.y_max - round(grid.y_max / grid.cell_h) * grid.cell_h, 6) + 0.0
+    alignment = "{0}|{1}|{2:.6f}|{3:.6f}|{4:.6f}|{5:.6f}".format(FOOTPRINT_VERSION, sr_name, grid.cell_w,
+                                                                   grid.cell_h, x_align, y_align)
+    offsets = np.searchsorted(edges.zones, np.arange(edges.nzones + 1), side="left")
+    keys = []
+    for i in range(edges.nzones):
+        sel = slice(offsets[i], offsets[i + 1])
+        digest = hashlib.sha1(alignment.encode("utf-8"))
+        for coords in (edges.x0, edges.y0, edges.x1, edges.y1):
+            digest.update(np.ascontiguousarray(coords[sel]).tobytes())
+        if edges.structure is not None:
+            digest.update(np.ascontiguousarray(edges.structure[i], dtype="<i8").tobytes())
+        keys.append(digest.hexdigest())
+    return keys
+
+
+class SpanCache(object):
+    """On-disk cache of rasterized catchment footprints.
+
+    Footprints are stored as run-length-encoded row spans (delta-coded rows, start
+    columns and span lengths, zlib compressed) in an SQLite database, in grid
+    coordinates anchored to the coordinate system origin. When the cache grows
+    beyond its size limit, the least recently used footprints are evicted.
+
+    Args:
+        cache_dir: directory where the cache database is stored
+        max_mb: maximum size of the stored footprints, in megabytes
+    """
+
+    def __init__(self, cache_dir, max_mb=SPAN_CACHE_MB):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, "span_cache.sqlite")
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS spans "
+                          "(key TEXT PRIMARY KEY, data BLOB, nbytes INTEGER, last_used REAL)")
+        self.conn.commit()
+
+    def get(self, keys):
+        """Looks up the footprints of a list of keys.
+
+        Returns:
+            Dictionary of key: (rows, starts, ends) for the keys found in the cache.
+        """
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            sql = "SELECT key, data FROM spans WHERE key IN ({0})".format(",".join("?" * len(chunk)))
+            for key, data in self.conn.execute(sql, chunk):
+                found[key] = decodeSpans(data)
+        now = time.time()
+        self.conn.executemany("UPDATE spans SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+        self.conn.commit()
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put(self, items):
+        """Stores a list of (key, rows, starts, ends) footprints, then evicts old footprints if needed."""
+        now = time.time()
+        records = []
+        for key, rows, starts, ends in items:
+            data = encodeSpans(rows, starts, ends)
+            records.append((key, sqlite3.Binary(data), len(data), now))
+        self.conn.executemany("INSERT OR REPLACE INTO spans VALUES (?, ?, ?, ?)", records)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used footprints until the cache fits its size limit."""
+        total = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM spans").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, nbytes in self.conn.execute("SELECT key, nbytes FROM spans ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= nbytes
+        self.conn.executemany("DELETE FROM spans WHERE key = ?", stale)
+        self.conn.commit()
+
+    def weightsPath(self, edges, grid, cell_size, nested):
+        """Returns the path of the saved zone weight matrix of a catchment set on a raster grid.
+
+        Args:
+            edges: CatchmentEdges in the coordinate system of the grid
+            grid: zonal.RasterGrid of the raster
+            cell_size: cell size the catchments are rasterized at
+            nested: whether the weights are for nested incremental areas
+        """
+        weights_dir = os.path.join(os.path.dirname(self.path), "weights")
+        if not os.path.isdir(weights_dir):
+            os.makedirs(weights_dir)
+        digest = hashlib.sha1("|".join(zoneKeys(edges, grid)).encode("utf-8"))
+        digest.update(repr((grid.key(), cell_size, bool(nested))).encode("utf-8"))
+        return os.path.join(weights_dir, digest.hexdigest() + ".npz")
+
+    def close(self):
+        self.conn.close()
+
+
+def encodeSpans(rows, starts, ends):
+    """Run-length encodes row spans as compressed bytes."""
+    drows = np.array(rows, dtype=np.int64)
+    drows[1:] -= rows[:-1]
+    packed = np.concatenate([drows, starts, np.asarray(ends) - np.asarray(starts)]).astype("<i4")
+    return zlib.compress(packed.tobytes())
+
+
+def decodeSpans(data):
+    """Decodes row spans encoded by encodeSpans."""
+    packed = np.frombuffer(zlib.decompress(bytes(data)), dtype="<i4").astype(np.int64)
+    n = len(packed) // 3
+    rows = np.cumsum(packed[:n])
+    starts = packed[n:2 * n]
+    return rows, starts, starts + packed[2 * n:]
+
+
+def burnZonesCached(edges, grid, cache):
+    """Burns catchment polygons into row spans, reusing footprints from a SpanCache.
+
+    Only polygons whose footprint is not in the cache are rasterized, and their
+    footprints are added to the cache. They are rasterized on a grid with the
+    alignment of grid that covers the polygons completely, and clipped to the
+    window of grid when the spans are assembled, so a footprint burned for one
+    window is also complete in any other window.
+
+    Args:
+        edges: CatchmentEdges in the coordinate system of the grid
+        grid: zonal.RasterGrid to burn the polygons into
+        cache: SpanCache instance
+
+    Returns:
+        zonal.ZoneSpans sorted by zone, row and column.
+    """
+    keys = zoneKeys(edges, grid)
+    found = cache.get(keys)
+    row_off = int(round(-grid.y_max / grid.cell_h))
+    col_off = int(round(grid.x_min / grid.cell_w))
+
+    # rasterize the polygons missing from the cache
+    missing = np.array([k not in found for k in keys], dtype=bool)
+    miss_zones = np.nonzero(missing)[0]
+    if len(miss_zones) > 0:
+        sel = missing[edges.zones]
+        miss_edges = CatchmentEdges(miss_zones, np.searchsorted(miss_zones, edges.zones[sel]), edges.x0[sel],
+                                    edges.y0[sel], edges.x1[sel], edges.y1[sel])
+        x_min, y_min, x_max, y_max = miss_edges.bounds()
+        r0 = int(np.floor((grid.y_max - y_max) / grid.cell_h))
+        r1 = int(np.ceil((grid.y_max - y_min) / grid.cell_h)) + 1
+        c0 = int(np.floor((x_min - grid.x_min) / grid.cell_w))
+        c1 = int(np.ceil((x_max - grid.x_min) / grid.cell_w)) + 1
+        burned = burnZones(miss_edges, grid.subGrid(r0, r1, c0, c1))
+        offsets = burned.zoneOffsets()
+        items = []
+        for i, zone in enumerate(miss_zones):
+            part = slice(offsets[i], offsets[i + 1])
+            footprint = (burned.rows[part] + (row_off + r0), burned.starts[part] + (col_off + c0),
+                         burned.ends[part] + (col_off + c0))
+            found[keys[zone]] = footprint
+            items.append((keys[zone],) + footprint)
+        cache.put(items)
+
+    # assemble the spans of all zones in the window of the grid
+    zones = []
+    rows = []
+    starts = []
+    ends = []
+    for zone, key in enumerate(keys):
+        r, s, e = found[key]
+        zones.append(np.repeat(zone, len(r)))
+        rows.append(r - row_off)
+        starts.append(s - col_off)
+        ends.append(e - col_off)
+    if not zones:
+        return zonal.ZoneSpans([], [], [], [], edges.nzones)
+    starts = np.clip(np.concatenate(starts), 0, grid.ncols)
+    ends = np.clip(np.concatenate(ends), 0, grid.ncols)
+    spans = zonal.ZoneSpans(np.concatenate(zones), np.concatenate(rows), starts, ends, edges.nzones)
+    return spans.subset((spans.rows >= 0) & (spans.rows < grid.nrows) & (spans.ends > spans.starts))
@@ -69,6 +69,12 @@ def writeRealDir(rs_root, real_id):
 
 
 def copyRSFiles(from_file, out_file):
+    if os.path.isdir(from_file) and from_file.lower().endswith(".ctab"):
+        # columnar tables are folders of plain files
+        if os.path.exists(out_file):
+            shutil.rmtree(out_file)
+        shutil.copytree(from_file, out_file)
+        return
     from_desc = arcpy.Describe(from_file)
     if from_desc.dataType == "DbaseTable":
         arcpy.MakeTableView_management(from_file, "from_file_view")
@@ -0,0 +1,150 @@
+# file name:	rworker.py
+# description:	Client of the long-lived R prediction worker (condWorker.R).  The worker loads the Random Forest model
+#               once and answers prediction requests on a local TCP port in a binary columnar format, so the Predict
+#               Conductivity tool can reuse it across runs and watersheds without starting R, installing packages or
+#               loading the model again.  When no worker is running, the tool falls back to the one-shot R script.
+# dependencies: numpy
+
+import os
+import sys
+import time
+import socket
+import struct
+import subprocess
+import numpy as np
+
+# constants
+WORKER_HOST = "127.0.0.1" # address of the worker, which runs on this computer
+WORKER_PORT = 6317 # TCP port of the worker
+WORKER_SCRIPT = "condWorker.R" # R script of the worker
+PING_TIMEOUT = 2.0 # seconds to wait for a worker to answer a ping
+PREDICT_TIMEOUT = 3600.0 # seconds to wait for a worker to answer a prediction request
+START_TIMEOUT = 120.0 # seconds to wait for a new worker to load the model
+OP_PREDICT = 1 # request codes of the worker protocol
+OP_PING = 2
+OP_STOP = 3
+
+
+def recvExact(sock, nbytes):
+    """Receives exactly nbytes from a socket."""
+    chunks = []
+    while nbytes > 0:
+        chunk = sock.recv(min(nbytes, 1048576))
+        if not chunk:
+            raise socket.error("The prediction worker closed the connection.")
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b"".join(chunks)
+
+
+def recvText(sock):
+    """Receives a length-prefixed UTF-8 string."""
+    nbytes = struct.unpack("<i", recvExact(sock, 4))[0]
+    return recvExact(sock, nbytes).decode("utf-8")
+
+
+def request(op, payload=b"", port=WORKER_PORT, timeout=PING_TIMEOUT):
+    """Sends one request to the worker and returns its connected socket, positioned after the success status.
+
+    Raises:
+        socket.error: the worker is not running or did not answer in time
+        RuntimeError: the worker answered with an error
+    """
+    sock = socket.create_connection((WORKER_HOST, port), timeout)
+    try:
+        sock.sendall(struct.pack("<i", op) + payload)
+        status = struct.unpack("<i", recvExact(sock, 4))[0]
+        if status != 0:
+            raise RuntimeError("The prediction worker failed: " + recvText(sock))
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def pingWorker(port=WORKER_PORT):
+    """Checks for a running worker.
+
+    Returns:
+        model: name of the model loaded by the worker, or None if no worker is running
+        features: list of the predictor names of the model
+    """
+    try:
+        sock = request(OP_PING, port=port)
+        try:
+            lines = recvText(sock).split("\n")
+        finally:
+            sock.close()
+    except (socket.error, RuntimeError):
+        return None, []
+    return lines[0], lines[1:]
+
+
+def predictWorker(x, features, port=WORKER_PORT):
+    """Predicts a batch of rows with the worker.
+
+    Args:
+        x: array of shape (rows, features), NaN for missing values
+        features: list of predictor names of the columns of x
+
+    Returns:
+        Array with the prediction of each row, NaN where undefined.
+
+    Raises:
+        socket.error: the worker is not running or did not answer in time
+        RuntimeError: the worker answered with an error
+    """
+    x = np.asarray(x, dtype="<f8")
+    names = [f.encode("utf-8") for f in features]
+    payload = [struct.pack("<ii", x.shape[0], len(names))]
+    payload.extend(struct.pack("<i", len(n)) + n for n in names)
+    # the values are sent column by column
+    payload.append(np.asfortranarray(x).tobytes(order="F"))
+    sock = request(OP_PREDICT, b"".join(payload), port, PREDICT_TIMEOUT)
+    try:
+        nrows = struct.unpack("<i", recvExact(sock, 4))[0]
+        return np.frombuffer(recvExact(sock, 8 * nrows), dtype="<f8").astype(np.float64)
+    finally:
+        sock.close()
+
+
+def startWorker(model_path, port=WORKER_PORT):
+    """Starts a worker in the background and waits until it answers.
+
+    Args:
+        model_path: path of the .rdata file of the model
+
+    Returns:
+        The name of the model loaded by the worker, or None if it did not start.
+    """
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), WORKER_SCRIPT)
+    try:
+        subprocess.Popen(["Rscript", script, model_path, str(port)])
+    except OSError:
+        return None
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        model = pingWorker(port)[0]
+        if model is not None:
+            return model
+        time.sleep(1.0)
+    return None
+
+
+def stopWorker(port=WORKER_PORT):
+    """Stops a running worker. Returns True if a worker was stopped."""
+    try:
+        request(OP_STOP, port=port).close()
+    except (socket.error, RuntimeError):
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    # python rworker.py start <model .rdata> | stop | status
+    if sys.argv[1] == "start":
+        print("Worker started with model {0}".format(startWorker(sys.argv[2])))
+    elif sys.argv[1] == "stop":
+        print("Worker stopped" if stopWorker() else "No worker is running")
+    else:
+        print("Worker running with model {0}".format(pingWorker()[0]))
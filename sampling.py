@@ -0,0 +1,218 @@
+# file name:	sampling.py
+# description:	Stratified random sampling estimates of catchment parameter means, used by the preview mode of the
+#               Pre-process Environmental Parameters tool.  The cells of each catchment are split into square
+#               spatial strata sized to the catchment, cells are drawn from every stratum in rounds of growing size,
+#               and a catchment stops being sampled once the confidence interval of its mean is within the requested
+#               tolerance.  Catchments small enough to be read in full are summarized exactly, and no round draws
+#               more cells than a catchment has left of its budget, so the number of cells read per catchment is
+#               bounded no matter how large or elongated the catchment is.
+# dependencies: numpy
+
+import numpy as np
+import zonal
+
+# constants
+TARGET_STRATA = 16 # approximate number of spatial strata per catchment
+MAX_STRATA = 32 # maximum number of strata per catchment; neighbouring strata of elongated catchments are merged
+FIRST_ROUND = 64 # number of cells drawn per catchment in the first round; each later round doubles the total
+MAX_SAMPLES = 4096 # maximum number of cells drawn per catchment; catchments with fewer cells are read in full
+MIN_STRATUM_SAMPLES = 2 # minimum number of cells drawn per stratum and round, so its variance can be estimated
+Z_SCORE = 1.96 # standard normal quantile of the reported 95% confidence interval
+SAMPLE_SEED = 20170 # seed of the random cell draws, so a repeated preview gives the same values
+
+
+def stratify(spans, nstrata=TARGET_STRATA, max_strata=MAX_STRATA):
+    """Splits the cells of each zone into square spatial strata.
+
+    The block size of a zone is chosen so that the zone covers about nstrata
+    blocks, and its spans are split at the block edges. The cost is proportional
+    to the number of spans and blocks crossed, not the number of cells. An
+    elongated zone crosses many more blocks than nstrata; runs of neighbouring
+    blocks are then merged into one stratum, so no zone has more than max_strata.
+
+    Args:
+        spans: ZoneSpans of the zones
+        nstrata: approximate number of strata per zone
+        max_strata: maximum number of strata per zone
+
+    Returns:
+        pieces: ZoneSpans of the span pieces, sorted by stratum
+        stratum: array with the stratum index of each piece
+        strata_zone: array with the zone index of each stratum
+        strata_cells: array with the number of cells of each stratum
+    """
+    cells = spans.cellCounts()
+    size = np.maximum(np.ceil(np.sqrt(cells / float(nstrata))), 1).astype(np.int64)
+    s = size[spans.zones]
+    b0 = spans.starts // s
+    n = (spans.ends - 1) // s - b0 + 1
+    idx = np.repeat(np.arange(len(n)), n)
+    block = b0[idx] + np.arange(len(idx)) - np.repeat(np.cumsum(n) - n, n)
+    s = s[idx]
+    zones = spans.zones[idx]
+    rows = spans.rows[idx]
+    starts = np.maximum(spans.starts[idx], block * s)
+    ends = np.minimum(spans.ends[idx], (block + 1) * s)
+    block_row = rows // s
+    order = np.lexsort((starts, rows, block, block_row, zones))
+    zones, rows, starts, ends = zones[order], rows[order], starts[order], ends[order]
+    block, block_row = block[order], block_row[order]
+    new = np.ones(len(zones), dtype=bool)
+    new[1:] = (zones[1:] != zones[:-1]) | (block_row[1:] != block_row[:-1]) | (block[1:] != block[:-1])
+    stratum = np.cumsum(new) - 1
+    strata_zone = zones[new]
+    if len(strata_zone):
+        # position of each block in its zone, and the number of blocks merged per stratum of the zone
+        first = np.searchsorted(strata_zone, strata_zone)
+        local = np.arange(len(strata_zone)) - first
+        per_zone = np.bincount(strata_zone)[strata_zone]
+        merged = local // -(-per_zone // max_strata)
+        new_stratum = np.ones(len(strata_zone), dtype=bool)
+        new_stratum[1:] = (strata_zone[1:] != strata_zone[:-1]) | (merged[1:] != merged[:-1])
+        renumber = np.cumsum(new_stratum) - 1
+        stratum = renumber[stratum]
+        strata_zone = strata_zone[new_stratum]
+    strata_cells = np.bincount(stratum, weights=ends - starts).astype(np.int64) if len(stratum) else \
+        np.zeros(0, dtype=np.int64)
+    return zonal.ZoneSpans(zones, rows, starts, ends, spans.nzones), stratum, strata_zone, strata_cells
+
+
+def drawCells(pieces, stratum, strata_cells, counts, rng):
+    """Draws cells at random (with replacement) from each stratum.
+
+    Args:
+        pieces, stratum, strata_cells: strata returned by stratify
+        counts: array with the number of cells to draw from each stratum
+        rng: numpy RandomState
+
+    Returns:
+        rows, cols: arrays with the grid row and column of each drawn cell
+        h: array with the stratum index of each drawn cell
+    """
+    lengths = pieces.lengths()
+    cum = np.cumsum(lengths)
+    first = np.searchsorted(stratum, np.arange(len(strata_cells)))
+    offset = (cum - lengths)[first]
+    h = np.repeat(np.arange(len(counts)), counts)
+    pos = offset[h] + np.minimum(np.floor(rng.random_sample(len(h)) * strata_cells[h]).astype(np.int64),
+                                 strata_cells[h] - 1)
+    piece = np.searchsorted(cum, pos, side="right")
+    cols = pieces.starts[piece] + pos - (cum[piece] - lengths[piece])
+    return pieces.rows[piece], cols, h
+
+
+def estimateMeans(acc, strata_zone, strata_cells, nzones):
+    """Estimates the mean of the valid cells of each zone from stratified samples.
+
+    The mean is a combined ratio estimator (sum of values over number of valid
+    cells), so NoData cells are handled like in the exact engines. Its variance
+    is estimated by linearization from the within-stratum sample variances.
+
+    Args:
+        acc: array of shape (6, strata) with the number of draws and the sums of
+        y, x, y * y, x * x and x * y of each stratum, where x is 1 for valid cells
+        and y is the cell value (0 for NoData)
+        strata_zone: array with the zone index of each stratum
+        strata_cells: array with the number of cells of each stratum
+        nzones: number of zones
+
+    Returns:
+        means: array with the estimated mean of each zone (NaN without valid samples)
+        half_widths: array with the half-width of the confidence interval of each mean
+    """
+    n, sy, sx, syy, sxx, sxy = acc
+    big_n = strata_cells.astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        y_total = np.bincount(strata_zone, big_n * sy / n, minlength=nzones)
+        x_total = np.bincount(strata_zone, big_n * sx / n, minlength=nzones)
+        means = np.where(x_total > 0, y_total / x_total, np.nan)
+        r = np.nan_to_num(means)[strata_zone]
+        # sample variance of the residuals y - r * x in each stratum
+        ss = syy - 2 * r * sxy + r * r * sxx - (sy - r * sx) ** 2 / n
+        var_h = big_n ** 2 * np.maximum(ss, 0.0) / (n - 1) / n
+        var = np.bincount(strata_zone, var_h, minlength=nzones) / x_total ** 2
+        half_widths = np.where(x_total > 0, Z_SCORE * np.sqrt(var), np.nan)
+    return means, half_widths
+
+
+def sampleZoneMeans(source, grid, spans, tolerance, seed=SAMPLE_SEED):
+    """Estimates the mean of a raster per zone from stratified random samples of cells.
+
+    Zones with at most MAX_SAMPLES cells are read in full and their means are
+    exact. Larger zones are sampled in rounds, each drawing cells from all of the
+    zone's strata in proportion to their size; a zone stops being sampled once the
+    half-width of the confidence interval of its mean is at most tolerance times
+    the mean, or once MAX_SAMPLES cells were drawn. A round never draws more than
+    the cells left of a zone's MAX_SAMPLES.
+
+    Args:
+        source: envstack.StackBand (or other source with a readCells method) to read
+        grid: zonal.RasterGrid window of the spans
+        spans: ZoneSpans of the zones
+        tolerance: relative error tolerance (e.g. 0.01 for 1 percent of the mean)
+        seed: seed of the random cell draws
+
+    Returns:
+        means: array with the (estimated) mean per zone, NaN where undefined
+        half_widths: array with the half-width of the confidence interval of each
+        mean, 0 for exact means
+        samples: array with the number of cells read per zone
+        exact: boolean array, True for zones whose mean is exact
+    """
+    nzones = spans.nzones
+    cells = spans.cellCounts()
+    means = np.empty(nzones)
+    means.fill(np.nan)
+    half_widths = np.zeros(nzones)
+    samples = np.zeros(nzones, dtype=np.int64)
+    exact = cells <= MAX_SAMPLES
+    small = exact & (cells > 0)
+    if small.any():
+        flat, zone = spans.subset(small[spans.zones]).cellIndex(grid.ncols)
+        v = source.readCells(grid, flat // grid.ncols, flat % grid.ncols)
+        ok = ~np.isnan(v)
+        sums = np.bincount(zone[ok], weights=v[ok], minlength=nzones)
+        counts = np.bincount(zone[ok], minlength=nzones)
+        means[small] = zonal.zoneMeans(sums, counts)[small]
+        samples[small] = cells[small]
+    if exact.all():
+        return means, half_widths, samples, exact
+    pieces, stratum, strata_zone, strata_cells = stratify(spans.subset(~exact[spans.zones]))
+    nstrata = len(strata_cells)
+    share = strata_cells / cells[strata_zone].astype(np.float64)
+    rng = np.random.RandomState(seed)
+    acc = np.zeros((6, nstrata))
+    active = ~exact
+    drawn = 0
+    round_n = FIRST_ROUND
+    while True:
+        counts = np.where(active[strata_zone], np.maximum(np.round(round_n * share), MIN_STRATUM_SAMPLES), 0)
+        # the draws of a zone are scaled down to the cells left of its MAX_SAMPLES
+        total = np.bincount(strata_zone, weights=counts, minlength=nzones)
+        room = np.maximum(MAX_SAMPLES - samples, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scale = np.where(total > room, room / total, 1.0)
+        counts = np.floor(counts * scale[strata_zone])
+        # zones with too few cells left to draw one per stratum keep the estimate of the last round
+        active &= np.bincount(strata_zone, weights=counts, minlength=nzones) > 0
+        if not active.any():
+            break
+        rows, cols, h = drawCells(pieces, stratum, strata_cells, counts.astype(np.int64), rng)
+        v = source.readCells(grid, rows, cols)
+        x = (~np.isnan(v)).astype(np.float64)
+        y = np.where(x > 0, v, 0.0)
+        for k, w in enumerate([None, y, x, y * y, x * x, x * y]):
+            acc[k] += np.bincount(h, weights=w, minlength=nstrata)
+        samples += np.bincount(strata_zone, weights=counts, minlength=nzones).astype(np.int64)
+        est, hw = estimateMeans(acc, strata_zone, strata_cells, nzones)
+        with np.errstate(invalid="ignore"):
+            met = hw <= tolerance * np.abs(est)
+        active &= ~met & (samples < MAX_SAMPLES)
+        if not active.any():
+            break
+        # every round doubles the number of cells drawn so far
+        drawn += round_n
+        round_n = drawn
+    means[~exact] = est[~exact]
+    half_widths[~exact] = hw[~exact]
+    return means, half_widths, samples, exact
@@ -0,0 +1,211 @@
+# file name:	tablewriter.py
+# description:	Buffered writers of the environmental parameter table.  Parameter values are handed over by the zonal
+#               statistics engines as columns keyed by LineOID, and written to a new table (dBASE or geodatabase) in
+#               bulk insert batches, so no catchment geometry is copied and no per-value joins are needed.  A table
+#               path ending in .ctab is written as a columnar table instead: a folder holding a CSV manifest and one
+#               raw little-endian binary file per column, which Python reads as memory-mapped arrays and R reads
+#               with readBin, without the 2 GB and 10-character field name limits of dBASE.
+# dependencies: numpy, ESRI arcpy module (dBASE and geodatabase tables, imported where they are written)
+
+import os
+import csv
+import shutil
+import numpy as np
+
+# constants
+BUFFER_ROWS = 50000 # number of rows buffered before they are inserted into the output table
+COLUMNAR_EXT = ".ctab" # folder extension of a columnar table
+COLUMNAR_VERSION = 1 # version of the columnar table layout
+MANIFEST_NAME = "manifest.csv" # name of the manifest file of a columnar table
+COLUMN_TYPES = {"int32": "<i4", # LineOID values
+                "float64": "<f8"} # parameter and prediction values, NaN where undefined
+
+
+class ParamTableWriter(object):
+    """Writes a parameter table with a LineOID field and one DOUBLE field per parameter.
+
+    The table is created with CreateTable_management, so an output path ending in
+    .dbf is written as a dBASE table and a path inside a geodatabase as a
+    geodatabase table. Rows are buffered and inserted with one insert cursor per
+    batch.
+
+    Args:
+        out_tbl: path of the table to create (an existing table is replaced)
+        field_names: list of parameter field names
+        buffer_rows: number of rows buffered before they are inserted
+    """
+
+    def __init__(self, out_tbl, field_names, buffer_rows=BUFFER_ROWS):
+        import arcpy
+        self.out_tbl = out_tbl
+        self.field_names = list(field_names)
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.rows = 0
+        if arcpy.Exists(out_tbl):
+            arcpy.Delete_management(out_tbl)
+        arcpy.CreateTable_management(os.path.dirname(out_tbl), os.path.basename(out_tbl))
+        arcpy.AddField_management(out_tbl, "LineOID", "LONG")
+        for field_name in self.field_names:
+            arcpy.AddField_management(out_tbl, field_name, "DOUBLE")
+        # a new dBASE table is created with a placeholder field
+        if arcpy.ListFields(out_tbl, "Field1"):
+            arcpy.DeleteField_management(out_tbl, "Field1")
+
+    def writeRow(self, line_oid, values):
+        """Buffers one row of parameter values, in the order of field_names."""
+        # NaN means the value is undefined (no valid cells)
+        self.buffer.append([line_oid] + [None if v is None or v != v else float(v) for v in values])
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def writeColumns(self, line_oids, columns):
+        """Buffers the rows of a block of columns.
+
+        Args:
+            line_oids: list of LineOID values
+            columns: dictionary of field name: sequence of values aligned with line_oids
+        """
+        cols = [columns[f] for f in self.field_names]
+        for i, line_oid in enumerate(line_oids):
+            self.writeRow(line_oid, [c[i] for c in cols])
+
+    def flush(self):
+        """Inserts the buffered rows into the table."""
+        if not self.buffer:
+            return
+        import arcpy
+        with arcpy.da.InsertCursor(self.out_tbl, ["LineOID"] + self.field_names) as cursor:
+            for row in self.buffer:
+                cursor.insertRow(row)
+        self.rows += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        """Inserts the remaining buffered rows."""
+        self.flush()
+        return self.out_tbl
+
+
+class ColumnarTableWriter(object):
+    """Writes a columnar table with a LineOID column and one float64 column per field.
+
+    Has the same interface as ParamTableWriter. Buffered rows are appended to
+    the column files, and the manifest is written last by close, so a table
+    left by an interrupted run cannot be read.
+
+    Args:
+        out_tbl: path of the columnar table folder to create (an existing table is replaced)
+        field_names: list of field names
+        buffer_rows: number of rows buffered before they are appended to the column files
+    """
+
+    def __init__(self, out_tbl, field_names, buffer_rows=BUFFER_ROWS):
+        self.out_tbl = out_tbl
+        self.field_names = list(field_names)
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.rows = 0
+        if os.path.isdir(out_tbl):
+            shutil.rmtree(out_tbl)
+        os.makedirs(out_tbl)
+        self.columns = [("LineOID", "int32")] + [(f, "float64") for f in self.field_names]
+        self.files = [open(os.path.join(out_tbl, name + ".bin"), "wb") for name, col_type in self.columns]
+
+    def writeRow(self, line_oid, values):
+        """Buffers one row of values, in the order of field_names."""
+        self.buffer.append([line_oid] + [np.nan if v is None else v for v in values])
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def writeColumns(self, line_oids, columns):
+        """Appends a block of columns.
+
+        Args:
+            line_oids: list of LineOID values
+            columns: dictionary of field name: sequence of values aligned with line_oids
+        """
+        self.flush()
+        blocks = [line_oids] + [[np.nan if v is None else v for v in columns[f]] for f in self.field_names]
+        self.appendBlocks(blocks)
+
+    def appendBlocks(self, blocks):
+        """Appends one sequence of values to every column file."""
+        for f, (name, col_type), block in zip(self.files, self.columns, blocks):
+            np.asarray(block, dtype=COLUMN_TYPES[col_type]).tofile(f)
+        self.rows += len(blocks[0])
+
+    def flush(self):
+        """Appends the buffered rows to the column files."""
+        if not self.buffer:
+            return
+        self.appendBlocks(list(zip(*self.buffer)))
+        self.buffer = []
+
+    def close(self):
+        """Appends the remaining buffered rows and writes the manifest."""
+        self.flush()
+        for f in self.files:
+            f.close()
+        manifest = os.path.join(self.out_tbl, MANIFEST_NAME)
+        with open(manifest + ".tmp", "w") as f:
+            f.write("# columnar table version {0}\n".format(COLUMNAR_VERSION))
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["name", "type", "rows", "file"])
+            for name, col_type in self.columns:
+                writer.writerow([name, col_type, self.rows, name + ".bin"])
+        if os.path.isfile(manifest):
+            os.remove(manifest)
+        os.rename(manifest + ".tmp", manifest)
+        return self.out_tbl
+
+
+def isColumnar(path):
+    """Checks if a table path is a columnar table."""
+    return os.path.splitext(path)[1].lower() == COLUMNAR_EXT
+
+
+def openTableWriter(out_tbl, field_names, buffer_rows=BUFFER_ROWS):
+    """Returns a ColumnarTableWriter for a .ctab table path, or a ParamTableWriter otherwise."""
+    if isColumnar(out_tbl):
+        return ColumnarTableWriter(out_tbl, field_names, buffer_rows)
+    return ParamTableWriter(out_tbl, field_names, buffer_rows)
+
+
+def readColumnar(in_tbl, field_names=None):
+    """Opens the columns of a columnar table as memory-mapped arrays.
+
+    Args:
+        in_tbl: path of the columnar table folder
+        field_names: optional list of the columns to open; all columns by default
+
+    Returns:
+        Dictionary of column name: read-only numpy memmap (or empty array).
+
+    Raises:
+        ValueError: the table has no manifest, a newer layout version, or a missing column
+    """
+    manifest = os.path.join(in_tbl, MANIFEST_NAME)
+    if not os.path.isfile(manifest):
+        raise ValueError("The columnar table " + in_tbl + " has no manifest and is incomplete.")
+    with open(manifest) as f:
+        version = f.readline().split()[-1]
+        if int(version) > COLUMNAR_VERSION:
+            raise ValueError("The columnar table " + in_tbl + " has an unsupported layout version.")
+        rows = list(csv.DictReader(f))
+    entries = dict((row["name"], row) for row in rows)
+    if field_names is None:
+        field_names = [row["name"] for row in rows]
+    columns = {}
+    for name in field_names:
+        if name not in entries:
+            raise ValueError("The columnar table " + in_tbl + " has no column " + name + ".")
+        entry = entries[name]
+        nrows = int(entry["rows"])
+        if nrows == 0:
+            # empty files cannot be memory-mapped
+            columns[name] = np.zeros(0, dtype=COLUMN_TYPES[entry["type"]])
+        else:
+            columns[name] = np.memmap(os.path.join(in_tbl, entry["file"]), dtype=COLUMN_TYPES[entry["type"]],
+                                      mode="r", shape=(nrows,))
+    return columns
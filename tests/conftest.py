@@ -0,0 +1,6 @@
+# Behavior tests of the Conductivity Tools.  Run with "python -m pytest tests" from the repository folder, in the
+# Python installation of ArcGIS; modules that need arcpy are skipped where it is not installed.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,66 @@
+# Behavior tests of the run checkpoint.
+import collections
+import numpy as np
+import pytest
+
+import checkpoint
+
+
+def testSignatureFollowsTheCatchmentGeometries(tmpdir):
+    fingerprints = collections.OrderedDict([(1, "a"), (2, "b")])
+    signature = checkpoint.runSignature(fingerprints, str(tmpdir), {}, ["VECTORIZED", "false", []])
+    assert signature == checkpoint.runSignature(collections.OrderedDict(fingerprints), str(tmpdir), {},
+                                                ["VECTORIZED", "false", []])
+    changed = collections.OrderedDict([(1, "a"), (2, "c")])
+    assert signature != checkpoint.runSignature(changed, str(tmpdir), {}, ["VECTORIZED", "false", []])
+    assert signature != checkpoint.runSignature(fingerprints, str(tmpdir), {}, ["PREFIX_SUM", "false", []])
+
+
+def testSignatureFollowsTheParameterRastersOnly(tmpdir):
+    tmpdir.join("ca_avg_250.tif").write("raster")
+    fingerprints = collections.OrderedDict([(1, "a")])
+
+    def signature():
+        hashes = {"AtmCa": {"stamp": checkpoint.pathStamp(str(tmpdir.join("ca_avg_250.tif"))), "sha1": None}}
+        return checkpoint.runSignature(fingerprints, str(tmpdir), hashes, ["VECTORIZED", "false", []])
+
+    before = signature()
+    # an output table and its checkpoint written to the parameter directory
+    tmpdir.join("params.dbf").write("table")
+    tmpdir.join("params.ckpt").write("{}")
+    assert signature() == before
+    tmpdir.join("ca_avg_250.tif").write("changed raster")
+    assert signature() != before
+
+
+def testRecordsAppendedWithoutSyncAreFlushedTogether(tmpdir, monkeypatch):
+    syncs = []
+    monkeypatch.setattr(checkpoint.os, "fsync", lambda fd: syncs.append(fd))
+    path = str(tmpdir.join("table.ckpt"))
+    ckpt = checkpoint.Checkpoint(path, "sig")
+    for param in ["AtmCa", "AtmMg", "AtmSO4"]:
+        ckpt.append(param, [10], [1.0], [1], sync=False)
+    ckpt.sync()
+    ckpt.close()
+    assert len(syncs) == 2 # the signature record, then the three records of the catchment
+    resumed = checkpoint.Checkpoint(path, "sig", resume=True)
+    assert all(10 in resumed.done(p) for p in ["AtmCa", "AtmMg", "AtmSO4"])
+    resumed.close()
+
+
+def testResumeRestoresCompleteRecordsOnly(tmpdir):
+    path = str(tmpdir.join("table.ckpt"))
+    ckpt = checkpoint.Checkpoint(path, "sig")
+    ckpt.append("AtmCa", [10, 11], np.array([1.5, 0.0]), np.array([1, 0]))
+    ckpt.append("AtmCa", [12], [2.5], [2], {"n": [2.0], "mean": [1.25]})
+    ckpt.close()
+    with open(path, "ab") as f:
+        f.write(b'{"param": "AtmCa", "line_o') # record cut off by a crash
+    resumed = checkpoint.Checkpoint(path, "sig", resume=True)
+    assert sorted(resumed.done("AtmCa")) == [10, 11, 12]
+    assert resumed.done("AtmCa")[12] == (2.5, 2.0, (1.25, 2.0))
+    resumed.append("AtmMg", [10], [3.0], [1])
+    resumed.close()
+    assert sorted(checkpoint.Checkpoint(path, "sig", resume=True).done("AtmMg")) == [10]
+    with pytest.raises(ValueError):
+        checkpoint.Checkpoint(path, "other", resume=True)
@@ -0,0 +1,79 @@
+# Behavior tests of the environmental parameter stack.
+import os
+import time
+import hashlib
+import numpy as np
+import pytest
+
+import checkpoint
+import envstack
+
+
+def writeStack(stack_dir, values, chunk=4, cell_size=30.0):
+    """Writes a one-band float64 stack of a 2D array, laid out in chunks as buildStack does."""
+    nrows, ncols = values.shape
+    n_tr = envstack.chunkCount(nrows, chunk)
+    n_tc = envstack.chunkCount(ncols, chunk)
+    padded = np.empty((n_tr * chunk, n_tc * chunk))
+    padded.fill(np.nan)
+    padded[:nrows, :ncols] = values
+    chunks = padded.reshape(n_tr, chunk, n_tc, chunk).transpose(0, 2, 1, 3)
+    data_path = os.path.join(stack_dir, envstack.DATA_NAME)
+    with open(data_path, "wb") as f:
+        f.write(np.ascontiguousarray(chunks).tobytes())
+    checksum = hashlib.sha1()
+    for tr in range(n_tr):
+        checksum.update(np.ascontiguousarray(chunks[tr]).tobytes())
+    manifest = {"version": envstack.STACK_VERSION,
+                "bands": [{"name": "BAND", "source": "band", "checksum": checksum.hexdigest()}],
+                "dtype": "float64",
+                "nodata": "NaN",
+                "transform": [0.0, cell_size, 0.0, nrows * cell_size, 0.0, -cell_size],
+                "nrows": nrows,
+                "ncols": ncols,
+                "chunk": chunk,
+                "spatial_reference": "TEST",
+                "data_stamp": checkpoint.pathStamp(data_path)}
+    envstack.writeManifest(stack_dir, manifest)
+    return data_path
+
+
+def testWindowsInsideAChunkAreReadWithoutCopying(tmpdir):
+    values = np.arange(100, dtype=np.float64).reshape(10, 10)
+    writeStack(str(tmpdir), values)
+    stack = envstack.EnvStack(str(tmpdir))
+    inside = stack.grid.subGrid(4, 7, 5, 8)
+    arr = stack.read(0, inside)
+    assert np.may_share_memory(arr, stack.data)
+    assert np.array_equal(arr, values[4:7, 5:8])
+    across = stack.grid.subGrid(2, 9, 3, 10)
+    assert np.array_equal(stack.read(0, across), values[2:9, 3:10])
+
+
+def testWindowsHonorTheCellSize(tmpdir):
+    writeStack(str(tmpdir), np.zeros((10, 10)))
+    band = envstack.EnvStack(str(tmpdir)).band("BAND")
+    grid = band.window((35.0, 35.0, 95.0, 125.0))
+    assert (grid.row_off, grid.col_off, grid.nrows, grid.ncols, grid.cell_w) == (5, 1, 4, 3, 30.0)
+    fine = band.window((35.0, 35.0, 95.0, 125.0), 10.0)
+    assert (fine.x_min, fine.y_max, fine.nrows, fine.ncols, fine.cell_w) == (30.0, 130.0, 10, 7, 10.0)
+
+
+def testChangedDataIsDetectedOnOpen(tmpdir):
+    data_path = writeStack(str(tmpdir), np.zeros((10, 10)))
+    # a new modification time alone only updates the stamp
+    t = time.time() + 10
+    os.utime(data_path, (t, t))
+    stack = envstack.EnvStack(str(tmpdir))
+    assert stack.manifest["data_stamp"] == checkpoint.pathStamp(data_path)
+    assert envstack.EnvStack(str(tmpdir)).manifest["data_stamp"] == checkpoint.pathStamp(data_path)
+    del stack
+    with open(data_path, "r+b") as f:
+        f.write(np.ones(1).tobytes())
+    with pytest.raises(ValueError):
+        envstack.EnvStack(str(tmpdir))
+    assert envstack.verifyStack(str(tmpdir)) == ["BAND"]
+    with open(data_path, "ab") as f:
+        f.write(b"\0" * 8)
+    with pytest.raises(ValueError):
+        envstack.EnvStack(str(tmpdir), verify=False)
@@ -0,0 +1,140 @@
+# Behavior tests of the in-process Random Forest evaluator and its compiled file.
+import os
+import csv
+import hashlib
+import pickle
+import numpy as np
+import pytest
+import forest
+import tablewriter
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rf17bCnd9.rdata")
+
+
+def writeForest(forest_dir):
+    """Writes an exported forest of two trees over the predictors b and a, in the layout of export_forest.R."""
+    columns = [("tree_start", "int32", [0, 3, 8]),
+               ("left", "int32", [1, 1, 2, 4, 4, 6, 6, 7]),
+               ("right", "int32", [2, 1, 2, 5, 4, 7, 6, 7]),
+               ("feature", "int32", [0, -1, -1, 1, -1, 0, -1, -1]),
+               ("threshold", "float64", [1.0, 0, 0, 0.5, 0, 2.0, 0, 0]),
+               ("value", "float64", [0, 10.0, 20.0, 0, 1.0, 0, 3.0, 5.0])]
+    os.makedirs(forest_dir)
+    with open(os.path.join(forest_dir, tablewriter.MANIFEST_NAME), "w") as f:
+        f.write("# columnar table version {0}\n".format(tablewriter.COLUMNAR_VERSION))
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["name", "type", "rows", "file"])
+        for name, col_type, values in columns:
+            np.asarray(values, dtype=tablewriter.COLUMN_TYPES[col_type]).tofile(os.path.join(forest_dir, name + ".bin"))
+            writer.writerow([name, col_type, len(values), name + ".bin"])
+    with open(os.path.join(forest_dir, forest.FEATURES_NAME), "w") as f:
+        f.write("b\na\n")
+    return forest_dir
+
+
+# rows of (b, a): ties at a split point go left, and a missing predictor gives no prediction
+ROWS = [[1.0, 0.5], [1.5, 0.7], [2.5, 1.0], [0.0, np.nan]]
+EXPECTED = [5.5, 11.5, 12.5, np.nan]
+
+
+def hasRscript():
+    """Checks if Rscript is on the PATH."""
+    for folder in os.environ.get("PATH", "").split(os.pathsep):
+        if any(os.path.isfile(os.path.join(folder, name)) for name in ("Rscript", "Rscript.exe")):
+            return True
+    return False
+
+
+def testForestFollowsTheSplitRulesOfRandomForest(tmpdir):
+    model = forest.Forest(writeForest(str(tmpdir.join("m.forest"))))
+    np.testing.assert_array_equal(model.predict(ROWS, chunk_rows=3), EXPECTED)
+
+
+def testCompiledForestPredictsLikeTheExportedForest(tmpdir):
+    forest_dir = writeForest(str(tmpdir.join("m.forest")))
+    model_path = str(tmpdir.join("m.rdata"))
+    with open(model_path, "wb") as f:
+        f.write(b"model")
+    compiled_path = forest.compileForest(forest_dir, str(tmpdir.join("m.rfbin")), model_path, ["a", "b", "c"])
+    assert forest.verifyCompiled(compiled_path)
+    compiled = forest.CompiledForest(compiled_path)
+    # the columns are in the order of the given predictor list
+    x = np.array([[a, b, 99.0] for b, a in ROWS])
+    np.testing.assert_array_equal(compiled.predict(x), EXPECTED)
+    np.testing.assert_array_equal(pickle.loads(pickle.dumps(compiled)).predict(x), EXPECTED)
+    with pytest.raises(ValueError):
+        forest.compileForest(forest_dir, compiled_path, model_path, ["a"])
+
+
+def testCompiledForestIsStaleWhenTheModelOrPredictorsChange(tmpdir):
+    forest_dir = writeForest(str(tmpdir.join("m.forest")))
+    model_path = str(tmpdir.join("m.rdata"))
+    with open(model_path, "wb") as f:
+        f.write(b"model")
+    compiled_path = forest.compileForest(forest_dir, str(tmpdir.join("m.rfbin")), model_path, ["a", "b"])
+    assert forest.isCompiledCurrent(compiled_path, model_path, ["a", "b"])
+    assert not forest.isCompiledCurrent(compiled_path, model_path, ["b", "a"])
+    # a copy of the same model is recognized by its digest
+    os.utime(model_path, (1000000000, 1000000000))
+    assert forest.isCompiledCurrent(compiled_path, model_path, ["a", "b"])
+    with open(model_path, "wb") as f:
+        f.write(b"other")
+    assert not forest.isCompiledCurrent(compiled_path, model_path, ["a", "b"])
+
+
+def testExportedForestIsOnlyUsedForTheModelItWasExportedFrom(tmpdir):
+    forest_dir = writeForest(str(tmpdir.join("m.forest")))
+    model_path = str(tmpdir.join("m.rdata"))
+    with open(model_path, "wb") as f:
+        f.write(b"model")
+    # a folder of unknown provenance
+    assert not forest.isExportedFrom(forest_dir, model_path)
+    with open(os.path.join(forest_dir, forest.SOURCE_NAME), "w") as f:
+        f.write(hashlib.md5(b"model").hexdigest() + "\n")
+    assert forest.isExportedFrom(forest_dir, model_path)
+    with open(model_path, "wb") as f:
+        f.write(b"other")
+    assert not forest.isExportedFrom(forest_dir, model_path)
+
+
+def testParityCheckReportsTheLargestDifference(tmpdir):
+    model = forest.Forest(writeForest(str(tmpdir.join("m.forest"))))
+    params = {"LineOID": [1, 2, 3, 4], "b": [r[0] for r in ROWS], "a": [r[1] for r in ROWS]}
+    parity_tbl = str(tmpdir.join("parity.ctab"))
+    writer = tablewriter.ColumnarTableWriter(parity_tbl, ["prdCond"])
+    writer.writeColumns([1, 2, 3, 4], {"prdCond": [5.5, 11.5, 12.0, np.nan]})
+    writer.close()
+    rows, max_abs, max_rel = forest.parityCheck(model, params, parity_tbl)
+    assert (rows, max_abs) == (4, 0.5)
+    assert max_rel == pytest.approx(0.5 / 12.0)
+
+
+@pytest.mark.skipif(not hasRscript() or not os.path.isfile(MODEL_PATH), reason="needs Rscript and rf17bCnd9.rdata")
+def testExportedModelPredictsLikeR(tmpdir):
+    forest_dir = str(tmpdir.join("rf17bCnd9.forest"))
+    assert forest.exportForest(MODEL_PATH, forest_dir)
+    assert forest.isExportedFrom(forest_dir, MODEL_PATH)
+    model = forest.Forest(forest_dir)
+    # predictor values at and between the split points of the model, so ties at the thresholds are compared
+    rng = np.random.RandomState(17)
+    nrows = 2000
+    columns = {"LineOID": np.arange(1, nrows + 1)}
+    for i, name in enumerate(model.features):
+        splits = np.unique(model.threshold[model.feature == i])
+        if len(splits) == 0:
+            splits = np.array([0.0])
+        values = rng.choice(splits, nrows)
+        between = rng.rand(nrows) < 0.5
+        values[between] += rng.uniform(-1.0, 1.0, between.sum()) * np.maximum(np.abs(values[between]), 1.0) * 0.01
+        columns[name] = values
+    in_params = str(tmpdir.join("fixture.ctab"))
+    writer = tablewriter.ColumnarTableWriter(in_params, model.features)
+    writer.writeColumns(columns["LineOID"].tolist(), columns)
+    writer.close()
+    assert forest.exportForest(MODEL_PATH, forest_dir, in_params)
+
+    compiled_path = forest.compileForest(forest_dir, str(tmpdir.join("rf17bCnd9.rfbin")), MODEL_PATH, model.features)
+    for evaluator in (forest.Forest(forest_dir), forest.CompiledForest(compiled_path)):
+        rows, max_abs, max_rel = forest.parityCheck(evaluator, in_params, os.path.join(forest_dir, forest.PARITY_NAME))
+        assert rows == nrows
+        assert max_rel <= 1e-9
@@ -0,0 +1,77 @@
+# Behavior tests of the incremental update support.
+import os
+import json
+import pytest
+
+import checkpoint
+import incremental
+
+PARAMS = [["AtmCa", "ca_avg_250.tif"], ["AtmMg", "mg_avg_250.tif"]]
+
+
+def writeRasters(env_dir, content=b"cells"):
+    for p in PARAMS:
+        with open(os.path.join(env_dir, p[1]), "wb") as f:
+            f.write(content)
+
+
+def testRastersAreOnlyHashedWhenComparedAndStale(tmpdir, monkeypatch):
+    env_dir = str(tmpdir)
+    writeRasters(env_dir)
+    hashed = []
+    content_hash = incremental.contentHash
+    monkeypatch.setattr(incremental, "contentHash", lambda path: hashed.append(path) or content_hash(path))
+    first = incremental.rasterHashes(env_dir, PARAMS)
+    assert hashed == [] and first["AtmCa"]["sha1"] is None
+    second = incremental.rasterHashes(env_dir, PARAMS, first)
+    assert hashed == [] and second == first
+    assert incremental.changedParams(second, first, PARAMS) == ([], PARAMS)
+
+    # a new stamp is hashed, and without a hash of the previous run the raster counts as changed
+    path = os.path.join(env_dir, PARAMS[0][1])
+    os.utime(path, (os.path.getmtime(path) + 10, os.path.getmtime(path) + 10))
+    third = incremental.rasterHashes(env_dir, PARAMS, second)
+    assert hashed == [path]
+    assert incremental.changedParams(third, second, PARAMS) == ([PARAMS[0]], [PARAMS[1]])
+    # once hashed, a new stamp with the same content is unchanged
+    os.utime(path, (os.path.getmtime(path) + 10, os.path.getmtime(path) + 10))
+    fourth = incremental.rasterHashes(env_dir, PARAMS, third)
+    assert incremental.changedParams(fourth, third, PARAMS) == ([], PARAMS)
+
+
+def testGeodatabaseRastersAreStampedWithTheGeodatabase(tmpdir):
+    gdb = tmpdir.mkdir("params.gdb")
+    gdb.join("a00000001.gdbtable").write(b"x" * 10)
+    raster = os.path.join(str(gdb), "ca_avg_250")
+    stamp = checkpoint.pathStamp(raster)
+    assert stamp[0] == 10
+    gdb.join("a00000002.gdbtable").write(b"y" * 5)
+    assert checkpoint.pathStamp(raster) != stamp
+
+
+def testOnlyTheChangedGeodatabaseRasterIsSummarizedAgain(tmpdir, monkeypatch):
+    gdb = tmpdir.mkdir("params.gdb")
+    gdb.join("a00000001.gdbtable").write(b"x")
+    params = [["AtmCa", "ca_avg_250"], ["AtmMg", "mg_avg_250"]]
+    cells = {"ca_avg_250": "1", "mg_avg_250": "2"}
+    monkeypatch.setattr(incremental, "datasetHash", lambda path: cells[os.path.basename(path)])
+    first = incremental.rasterHashes(str(gdb), params)
+    assert incremental.changedParams(incremental.rasterHashes(str(gdb), params, first), first, params) == ([], params)
+    # after a change to the geodatabase the rasters are hashed, and without earlier hashes they count as changed
+    gdb.join("a00000002.gdbtable").write(b"y")
+    second = incremental.rasterHashes(str(gdb), params, first)
+    assert second["AtmCa"]["sha1"] == "1"
+    cells["ca_avg_250"] = "3"
+    gdb.join("a00000002.gdbtable").write(b"yz")
+    third = incremental.rasterHashes(str(gdb), params, second)
+    assert incremental.changedParams(third, second, params) == ([params[0]], [params[1]])
+
+
+def testSidecarVersionMismatchIsReported(tmpdir):
+    out_tbl = str(tmpdir.join("params.dbf"))
+    assert incremental.readSidecar(out_tbl) is None
+    with open(incremental.sidecarPath(out_tbl), "w") as f:
+        json.dump({"version": 1, "catchments": {}, "rasters": {}}, f)
+    with pytest.raises(ValueError) as e:
+        incremental.readSidecar(out_tbl)
+    assert "sidecar version 1" in str(e.value)
@@ -0,0 +1,49 @@
+# Behavior tests of the batched (worker process) zonal statistics.
+import numpy as np
+import pytest
+
+import envstack
+import parallel
+import zonal
+from test_envstack import writeStack
+from test_zonal import squareSpans
+
+
+@pytest.mark.parametrize("engine", ["VECTORIZED", "PREFIX_SUM"])
+def testBatchesMatchASerialRunExactly(tmpdir, engine):
+    values = np.random.RandomState(3).uniform(0.0, 1000.0, (16, 16)) / 7.0
+    values[2:5, 9] = np.nan
+    writeStack(str(tmpdir), values)
+    band = envstack.EnvStack(str(tmpdir)).band("BAND")
+    grid = band.window((0.0, 0.0, 16 * 30.0, 16 * 30.0))
+    boxes = {0: [(0, 3, 0, 3)], 1: [(1, 6, 9, 16)], 2: [(9, 16, 1, 15)], 3: [(12, 14, 13, 16)], 4: [(6, 8, 0, 16)]}
+    zones = squareSpans(boxes, 5)
+    sums, counts, tiles = zonal.streamZoneSums(band, grid, zones, engine)
+    batches = parallel.partitionZones(zones, grid, 5)
+    assert len(batches) > 1
+    for ids in batches:
+        task = (band, grid, parallel.batchZones(zones, ids), ids, engine, zonal.MEMORY_MB, False)
+        ids, batch_sums, batch_counts, tile_keys, stats = parallel.batchZoneSums(task)
+        assert batch_sums.tolist() == sums[ids].tolist()
+        assert batch_counts.tolist() == counts[ids].tolist()
+
+
+def testInProcessBatchesCommitOneAtATime():
+    values = np.arange(256, dtype=np.float64).reshape(16, 16)
+    boxes = dict((z, [(z, z + 2, 0, 16)]) for z in range(12))
+    zones = squareSpans(boxes, 12)
+    grid = zonal.RasterGrid(0.0, 16.0, 1.0, 1.0, 16, 16)
+
+    class ArraySource(object):
+        def read(self, grid, zones=None):
+            return values[grid.row_off:grid.row_off + grid.nrows, grid.col_off:grid.col_off + grid.ncols]
+
+    committed = []
+    batches = parallel.partitionZones(zones, grid, 4)
+    sums, counts, tiles, rereads = parallel.parallelZoneSums(None, ArraySource(), grid, zones, batches, "VECTORIZED",
+                                                             callback=lambda ids, s, c, st: committed.append(ids))
+    assert len(committed) == len(batches) == 4
+    assert sorted(np.concatenate(committed).tolist()) == list(range(12))
+    direct_sums, direct_counts = zonal.zoneSums(zones, values)
+    assert sums.tolist() == direct_sums.tolist()
+    assert counts.tolist() == direct_counts.tolist()
@@ -0,0 +1,61 @@
+# Behavior tests of the prediction cache shared by concurrent runs.
+import sqlite3
+import numpy as np
+import pytest
+
+import predcache
+
+
+def countRows(calls):
+    """Returns a prediction function recording the number of rows it predicted."""
+    def predict(x):
+        calls.append(len(x))
+        return np.asarray(x).sum(axis=1)
+    return predict
+
+
+def testConcurrentRunsShareTheCache(tmpdir):
+    x = np.arange(12.0).reshape(6, 2)
+    first = predcache.PredictionCache(str(tmpdir), "m")
+    second = predcache.PredictionCache(str(tmpdir), "m")
+    calls = []
+    np.testing.assert_array_equal(first.predict(x[:4], countRows(calls)), x[:4].sum(axis=1))
+    # the second run neither waits for the open first run nor predicts its rows again
+    np.testing.assert_array_equal(second.predict(x, countRows(calls)), x.sum(axis=1))
+    assert calls == [4, 2]
+    second.close()
+    first.close()
+    assert (first.error, second.error) == (None, None)
+    assert (second.hits, second.misses) == (4, 2)
+
+
+def testLockedCacheFallsBackToTheModel(tmpdir, monkeypatch):
+    monkeypatch.setattr(predcache, "LOCK_TIMEOUT", 0.1)
+    x = np.arange(8.0).reshape(4, 2)
+    cache = predcache.PredictionCache(str(tmpdir), "m")
+    other = sqlite3.connect(cache.path)
+    other.execute("BEGIN EXCLUSIVE")
+    calls = []
+    np.testing.assert_array_equal(cache.predict(x, countRows(calls)), x.sum(axis=1))
+    assert "locked" in cache.error
+    np.testing.assert_array_equal(cache.predict(x, countRows(calls)), x.sum(axis=1))
+    assert calls == [4, 4] and cache.misses == 8
+    assert cache.close() == 0
+    other.rollback()
+    other.close()
+
+
+def testRowsOfAFailedPredictionAreNotCounted(tmpdir):
+    x = np.arange(8.0).reshape(4, 2)
+    cache = predcache.PredictionCache(str(tmpdir), "m")
+    calls = []
+    cache.predict(x[:1], countRows(calls))
+
+    def fail(rows):
+        raise RuntimeError("worker stopped")
+    with pytest.raises(RuntimeError):
+        cache.predict(x, fail)
+    assert (cache.hits, cache.misses) == (0, 1)
+    np.testing.assert_array_equal(cache.predict(x, countRows(calls)), x.sum(axis=1))
+    assert calls == [1, 3] and (cache.hits, cache.misses) == (1, 4)
+    cache.close()
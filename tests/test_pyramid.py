@@ -0,0 +1,101 @@
+# Behavior tests of the sum/count pyramids.
+import os
+import math
+import numpy as np
+import pyramid
+import zonal
+from test_zonal import squareSpans
+
+
+def testPyramidsOfGeodatabaseRastersAreRebuiltWhenTheGeodatabaseChanges(tmpdir):
+    gdb = tmpdir.mkdir("params.gdb")
+    gdb.join("a00000009.gdbtable").write(b"x" * 100)
+    source = zonal.RasterSource(str(gdb.join("ca_avg_250")))
+    grid = zonal.RasterGrid(0.0, 100.0, 1.0, 1.0, 100, 100)
+    key = pyramid.pyramidKey(source, grid)
+    # reading the raster leaves lock files behind, which do not change the raster
+    gdb.join("a00000009.sr.lock").write(b"")
+    assert pyramid.pyramidKey(source, grid) == key
+    gdb.join("a00000009.gdbtable").write(b"y" * 120)
+    assert pyramid.pyramidKey(source, grid) != key
+
+
+class ArrayRaster(object):
+    """Source reading windows of an in-memory raster with its top left corner at (0, height)."""
+
+    def __init__(self, values):
+        self.values = values
+        self.path = "memory"
+        self.reads = 0
+
+    def window(self, bounds, cell_size=None):
+        nrows, ncols = self.values.shape
+        c0 = max(int(math.floor(bounds[0])), 0)
+        c1 = min(int(math.ceil(bounds[2])), ncols)
+        r0 = max(int(math.floor(nrows - bounds[3])), 0)
+        r1 = min(int(math.ceil(nrows - bounds[1])), nrows)
+        return zonal.RasterGrid(c0, nrows - r0, 1.0, 1.0, max(r1 - r0, 0), max(c1 - c0, 0), None, r0, c0)
+
+    def read(self, grid, zones=None):
+        self.reads += 1
+        return self.values[grid.row_off:grid.row_off + grid.nrows, grid.col_off:grid.col_off + grid.ncols]
+
+
+def directSums(values, boxes, r0, c0):
+    """Returns the sums and valid cell counts of boxes of a window starting at row r0 and column c0."""
+    sums, counts = [], []
+    for z in sorted(boxes):
+        cells = np.concatenate([values[r0 + a:r0 + b, c0 + c:c0 + d].ravel() for a, b, c, d in boxes[z]])
+        sums.append(np.nansum(cells))
+        counts.append(np.count_nonzero(~np.isnan(cells)))
+    return sums, counts
+
+
+def testWindowsOfARasterShareOnePyramidBuiltWhereZonesReach(tmpdir):
+    values = np.random.RandomState(5).normal(10.0, 2.0, (700, 900))
+    values[values > 13.0] = np.nan
+    source = ArrayRaster(values)
+    # tiny memory budget, so the pyramid has tiles of 256 by 256 cells
+    memory_mb = 0.001
+    boxes = {0: [(3, 300, 7, 290)], 1: [(10, 20, 400, 410), (200, 260, 300, 333)]}
+    grid = source.window((50.0, 150.0, 800.0, 640.0))
+    spans = squareSpans(boxes, 2)
+    pyr, tiles = pyramid.openPyramid(source, grid, spans, str(tmpdir), memory_mb)
+    # the window covers 12 tiles of the raster, of which the zones reach 4
+    assert pyr.tile == 256 and tiles == 4
+    sums, counts, lookups = pyramid.pyramidZoneSums(pyr, spans, grid)
+    expected_sums, expected_counts = directSums(values, boxes, grid.row_off, grid.col_off)
+    np.testing.assert_allclose(sums, expected_sums)
+    np.testing.assert_array_equal(counts, expected_counts)
+    assert lookups < counts.sum()
+    # another extent of the same raster reuses the tiles and builds only the ones it reaches first
+    other = source.window((0.0, 0.0, 600.0, 700.0))
+    assert pyramid.pyramidKey(source, other) == pyramid.pyramidKey(source, grid)
+    boxes = {0: [(60, 200, 100, 250)], 1: [(500, 700, 0, 10)]}
+    spans = squareSpans(boxes, 2)
+    pyr, tiles = pyramid.openPyramid(source, other, spans, str(tmpdir), memory_mb)
+    assert tiles == 1
+    sums, counts, lookups = pyramid.pyramidZoneSums(pyr, spans, other)
+    expected_sums, expected_counts = directSums(values, boxes, 0, 0)
+    np.testing.assert_allclose(sums, expected_sums)
+    np.testing.assert_array_equal(counts, expected_counts)
+
+
+def testLeastRecentlyUsedPyramidsAreEvicted(tmpdir):
+    grid = zonal.RasterGrid(0.0, 300.0, 1.0, 1.0, 300, 300)
+    spans = squareSpans({0: [(0, 10, 0, 10)]}, 1)
+    old = ArrayRaster(np.ones((300, 300)))
+    old.path = "old"
+    pyr_old, tiles = pyramid.openPyramid(old, grid, spans, str(tmpdir), 0.001)
+    os.utime(os.path.join(pyr_old.path, pyramid.PYRAMID_MANIFEST), (1000000000, 1000000000))
+    used = ArrayRaster(np.ones((300, 300)))
+    used.path = "used"
+    pyr_used, tiles = pyramid.openPyramid(used, grid, spans, str(tmpdir), 0.001)
+    # both fit the limit
+    assert os.path.isdir(pyr_old.path)
+    # a size limit below one pyramid keeps only the pyramid in use
+    new = ArrayRaster(np.ones((300, 300)))
+    new.path = "new"
+    pyr_new, tiles = pyramid.openPyramid(new, grid, spans, str(tmpdir), 0.001, max_mb=0.5)
+    assert os.path.isdir(pyr_new.path)
+    assert not os.path.isdir(pyr_old.path) and not os.path.isdir(pyr_used.path)
@@ -0,0 +1,104 @@
+# Behavior tests of the batch scanline rasterizer.
+import struct
+import numpy as np
+import pytest
+
+import rasterize
+import zonal
+
+
+def box(x0, y0, x1, y1, clockwise=True):
+    """Returns a closed rectangular ring."""
+    ring = [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]
+    return np.array(ring if clockwise else ring[::-1], dtype=np.float64)
+
+
+def polygonWkb(rings, order="<", z=False):
+    """Returns the WKB of a polygon."""
+    dims = 3 if z else 2
+    data = struct.pack(order + "BII", 1 if order == "<" else 0, 1003 if z else 3, len(rings))
+    for ring in rings:
+        coords = np.hstack([ring, np.zeros((len(ring), dims - 2))])
+        data += struct.pack(order + "I", len(ring)) + coords.astype(order + "f8").tobytes()
+    return data
+
+
+def multiPolygonWkb(parts):
+    """Returns the WKB of a multipolygon."""
+    return struct.pack("<BII", 1, 6, len(parts)) + b"".join(polygonWkb(rings) for rings in parts)
+
+
+def burnedCells(zone_rings, size=20):
+    """Burns polygons into a size x size grid of unit cells and returns the number of cells of each zone."""
+    edges = rasterize.ringEdges(list(range(len(zone_rings))), zone_rings)
+    spans = rasterize.burnZones(edges, zonal.RasterGrid(0.0, float(size), 1.0, 1.0, size, size))
+    return np.bincount(spans.zones, weights=spans.ends - spans.starts, minlength=len(zone_rings)).astype(int)
+
+
+def testTwoHolesAreLeftOut():
+    rings = [box(0, 0, 10, 10), box(2, 2, 4, 4, False), box(6, 6, 8, 8, False)]
+    assert burnedCells([rings]).tolist() == [92]
+
+
+def testAllPartsOfAMultipartPolygonAreFilled():
+    parts = [box(0, 0, 3, 3), box(5, 5, 9, 9), box(12, 12, 14, 14)]
+    assert burnedCells([parts]).tolist() == [9 + 16 + 4]
+
+
+def testMultipartPolygonWithHoleNextToOtherZone():
+    first = [box(0, 0, 10, 10), box(2, 2, 4, 4, False), box(12, 0, 15, 3)]
+    second = [box(0, 12, 5, 17)]
+    assert burnedCells([first, second]).tolist() == [96 + 9, 25]
+
+
+def testWkbRingsReadsPolygonsAndMultipolygons():
+    square = box(0, 0, 10, 10)
+    hole = box(2, 2, 4, 4, False)
+    for wkb in [polygonWkb([square, hole]), polygonWkb([square, hole], ">"), polygonWkb([square, hole], z=True)]:
+        rings = rasterize.wkbRings(bytearray(wkb))
+        assert len(rings) == 2
+        assert np.array_equal(rings[0], square) and np.array_equal(rings[1], hole)
+    rings = rasterize.wkbRings(multiPolygonWkb([[square, hole], [box(12, 12, 14, 14)]]))
+    assert len(rings) == 3
+    assert np.array_equal(rings[2], box(12, 12, 14, 14))
+
+
+def testFootprintKeysFollowTheRingsAndParts():
+    square = box(0, 0, 10, 10)
+    hole = box(2, 2, 4, 4, False)
+    zone_rings = []
+    zone_parts = []
+    for wkb in [polygonWkb([square, hole]), multiPolygonWkb([[square], [hole]])]:
+        parts = []
+        zone_rings.append(rasterize.wkbRings(wkb, parts))
+        zone_parts.append(parts)
+    assert zone_parts == [[2], [1, 1]]
+    # the same vertices as one ring of both squares
+    zone_rings.append([np.vstack([square[:-1], hole[:-1]])])
+    zone_parts.append([1])
+    grid = zonal.RasterGrid(0.0, 20.0, 1.0, 1.0, 20, 20)
+    keys = rasterize.zoneKeys(rasterize.ringEdges([1, 2, 3], zone_rings, zone_parts), grid)
+    assert len(set(keys)) == 3
+    assert keys == rasterize.zoneKeys(rasterize.ringEdges([4, 5, 6], zone_rings, zone_parts), grid)
+
+
+def testWkbRingsRefusesOtherGeometries():
+    with pytest.raises(ValueError):
+        rasterize.wkbRings(struct.pack("<BIdd", 1, 1, 0.0, 0.0))
+
+
+def testCachedFootprintsAreCompleteInALargerWindow(tmpdir):
+    zone_rings = [[box(0, 0, 10, 10), box(2, 2, 4, 4, False)], [box(8, 8, 16, 14)], [box(15, 1, 19, 5)]]
+    edges = rasterize.ringEdges([1, 2, 3], zone_rings)
+    small = zonal.RasterGrid(0.0, 12.0, 1.0, 1.0, 6, 12)
+    large = zonal.RasterGrid(0.0, 20.0, 1.0, 1.0, 20, 20)
+    cache = rasterize.SpanCache(str(tmpdir))
+    try:
+        rasterize.burnZonesCached(edges, small, cache)
+        cached = rasterize.burnZonesCached(edges, large, cache)
+        assert cache.hits == 3
+    finally:
+        cache.close()
+    direct = rasterize.burnZones(edges, large)
+    for name in ["zones", "rows", "starts", "ends"]:
+        assert np.array_equal(getattr(cached, name), getattr(direct, name))
@@ -0,0 +1,45 @@
+# Behavior tests of the sampled (preview) parameter means.
+import numpy as np
+import pytest
+
+import envstack
+import sampling
+import zonal
+from test_envstack import writeStack
+from test_zonal import squareSpans
+
+
+def testSmallZonesAreExactAndLargeZonesWithinTolerance(tmpdir):
+    values = np.random.RandomState(7).normal(100.0, 5.0, (200, 200))
+    writeStack(str(tmpdir), values, chunk=64)
+    band = envstack.EnvStack(str(tmpdir)).band("BAND")
+    grid = band.window((0.0, 0.0, 200 * 30.0, 200 * 30.0))
+    spans = squareSpans({0: [(0, 10, 0, 10)], 1: [(0, 200, 0, 200)]}, 2)
+    means, half_widths, samples, exact = sampling.sampleZoneMeans(band, grid, spans, 0.01)
+    assert exact.tolist() == [True, False]
+    assert means[0] == pytest.approx(values[:10, :10].mean(), rel=1e-12)
+    assert samples[0] == 100 and samples[1] <= sampling.MAX_SAMPLES
+    assert half_widths[1] <= 0.01 * means[1]
+    assert abs(means[1] - values.mean()) <= 3 * half_widths[1]
+
+
+class ArraySource(object):
+    """Source reading cells from an in-memory array."""
+
+    def __init__(self, values):
+        self.values = values
+
+    def readCells(self, grid, rows, cols):
+        return self.values[rows, cols]
+
+
+def testElongatedZonesStayWithinTheSampleBudget():
+    values = np.random.RandomState(3).normal(100.0, 20.0, (2, 100000))
+    spans = squareSpans({0: [(0, 2, 0, 100000)]}, 1)
+    pieces, stratum, strata_zone, strata_cells = sampling.stratify(spans)
+    assert len(strata_cells) <= sampling.MAX_STRATA and strata_cells.sum() == 200000
+    # a tolerance that is never met, so the zone is sampled up to its budget
+    grid = zonal.RasterGrid(0.0, 2.0, 1.0, 1.0, 2, 100000)
+    means, half_widths, samples, exact = sampling.sampleZoneMeans(ArraySource(values), grid, spans, 1e-9)
+    assert not exact[0] and samples[0] <= sampling.MAX_SAMPLES
+    assert abs(means[0] - values.mean()) <= 3 * half_widths[0]
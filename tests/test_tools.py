@@ -0,0 +1,32 @@
+# Behavior tests of the tool modules imported by the toolbox and by each other.
+import sys
+import pytest
+
+arcpy = pytest.importorskip("arcpy")
+
+
+def testImportingAToolModuleHasNoSideEffects(monkeypatch):
+    calls = []
+    for name in ("AddMessage", "AddWarning", "AddError", "CheckOutExtension"):
+        monkeypatch.setattr(arcpy, name, lambda *args, **kwargs: calls.append(args))
+    for module in ("polystat_cond", "predict_cond", "pipeline_cond"):
+        monkeypatch.delitem(sys.modules, module, raising=False)
+    import predict_cond
+    import pipeline_cond
+    assert calls == []
+    assert len(predict_cond.polystat_cond.PARAM_LIST) == len(pipeline_cond.polystat_cond.PARAM_LIST) == 19
+
+
+def testModelThatCannotBeWrittenFallsBackToR(monkeypatch, tmpdir):
+    warnings = []
+    monkeypatch.setattr(arcpy, "AddMessage", lambda *args: None)
+    monkeypatch.setattr(arcpy, "AddWarning", lambda message: warnings.append(message))
+    import predict_cond
+    model_path = tmpdir.join("rf17bCnd9.rdata")
+    model_path.write(b"model")
+    # the folder of the compiled model cannot be created below a file
+    blocked = tmpdir.join("blocked")
+    blocked.write(b"")
+    folder = blocked.join("cache")
+    assert predict_cond.openModel(str(model_path), str(folder.join("m.forest")), str(folder.join("m.rfbin"))) is None
+    assert len(warnings) == 1
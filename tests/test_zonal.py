@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import zonal
+
+
+def squareSpans(boxes, nzones):
+    """Returns the ZoneSpans of zones made of (row0, row1, col0, col1) boxes, given as {zone: [boxes]}."""
+    zones, rows, starts, ends = [], [], [], []
+    for z in sorted(boxes):
+        for r0, r1, c0, c1 in boxes[z]:
+            for r in range(r0, r1):
+                zones.append(z)
+                rows.append(r)
+                starts.append(c0)
+                ends.append(c1)
+    return zonal.ZoneSpans(zones, rows, starts, ends, nzones)
+
+
+def testNestedZonesAccumulateToDirectSums():
+    values = np.arange(400, dtype=np.float64).reshape(20, 20)
+    values[3, 4] = np.nan
+    # outlet 0 contains 1 and 2; 1 contains 3
+    spans = squareSpans({0: [(0, 20, 0, 20)], 1: [(0, 10, 0, 10)], 2: [(12, 20, 12, 20)], 3: [(2, 6, 2, 6)]}, 4)
+    direct_sums, direct_counts = zonal.zoneSums(spans, values)
+    incremental, parent, order = zonal.nestZones(spans, 20)
+    assert parent.tolist() == [-1, 0, 0, 1]
+    sums, counts = zonal.zoneSums(incremental, values)
+    np.testing.assert_allclose(zonal.accumulateZones(sums, parent, order), direct_sums)
+    assert zonal.accumulateZones(counts, parent, order).tolist() == direct_counts.tolist()
+
+
+def testPartlyOverlappingZonesAreRefused():
+    # zone 1 sticks out of zone 0, which contains its first cell
+    spans = squareSpans({0: [(0, 10, 0, 10)], 1: [(5, 12, 5, 12)]}, 2)
+    with pytest.raises(ValueError):
+        zonal.nestZones(spans, 20)
+
+
+def testOverlappingSiblingsAreRefused():
+    spans = squareSpans({0: [(0, 20, 0, 20)], 1: [(0, 10, 0, 10)], 2: [(5, 12, 5, 12)]}, 3)
+    with pytest.raises(ValueError):
+        zonal.nestZones(spans, 20)
+
+
+def testTilesShrinkWithTheZonesAndStatistics():
+    full = zonal.tileSize(64, "PREFIX_SUM")
+    assert zonal.tileSize(64, "PREFIX_SUM", stats=True) < full
+    spans = squareSpans({0: [(0, 100000, 0, 5)]}, 1)
+    zone_mb = zonal.zoneMemoryMB(spans)
+    assert zonal.tileSize(64 - zone_mb, "PREFIX_SUM") < full
+    assert zonal.tileSize(zone_mb - 64, "PREFIX_SUM") == 64
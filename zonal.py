@@ -0,0 +1,820 @@
+# file name:	zonal.py
+# description:	Array-based zonal statistics for the Conductivity model.  Catchment polygons are burned into row spans
+#               of raster cells using the CELL_CENTER rule, and the mean of an environmental parameter raster is
+#               calculated for every catchment in a single vectorized pass (numpy bincount over the zone labels of
+#               the covered cells).  Overlapping (nested) catchments are supported, because each zone keeps its own
+#               list of cells rather than sharing a single zone raster.  arcpy is only imported where raster
+#               datasets are read, so the numpy engines run without ArcGIS.
+# dependencies: numpy, ESRI arcpy module (raster datasets)
+
+import sys
+import math
+import numpy as np
+
+# constants
+CHUNK_CELLS = 20000000 # maximum number of cells gathered into memory at once when reducing zones
+MEMORY_MB = 1024 # default memory budget for streaming raster tiles, in megabytes
+CELL_BYTES = {"VECTORIZED": 40, # approximate working memory per raster cell of a tile, by engine
+              "PREFIX_SUM": 40,
+              "SPARSE": 24,
+              "PYRAMID": 40}
+STATS_CELL_BYTES = 80 # additional working memory per raster cell of a tile when cell statistics are calculated
+ZONE_BYTES = 120 # working memory per zone span or weight held while streaming: the zones, their row order and copies
+
+
+class RasterGrid(object):
+    """Cell alignment of a window of a raster dataset.
+
+    Args:
+        x_min: x coordinate of the left edge of the window
+        y_max: y coordinate of the top edge of the window
+        cell_w: cell width
+        cell_h: cell height
+        nrows: number of rows in the window
+        ncols: number of columns in the window
+        sr: spatial reference of the raster dataset
+        row_off: row of the first cell of the window in the dataset
+        col_off: column of the first cell of the window in the dataset
+    """
+
+    def __init__(self, x_min, y_max, cell_w, cell_h, nrows, ncols, sr=None, row_off=0, col_off=0):
+        self.x_min = x_min
+        self.y_max = y_max
+        self.cell_w = cell_w
+        self.cell_h = cell_h
+        self.nrows = nrows
+        self.ncols = ncols
+        self.sr = sr
+        self.row_off = row_off
+        self.col_off = col_off
+
+    def key(self):
+        """Returns a hashable key identifying the window and its cell alignment."""
+        return (round(self.x_min, 6), round(self.y_max, 6), round(self.cell_w, 6), round(self.cell_h, 6),
+                self.nrows, self.ncols)
+
+    def lowerLeft(self):
+        """Returns the lower left corner of the window as an arcpy Point."""
+        import arcpy
+        return arcpy.Point(self.x_min, self.y_max - self.nrows * self.cell_h)
+
+    def subGrid(self, r0, r1, c0, c1):
+        """Returns the RasterGrid of rows r0 to r1 and columns c0 to c1 (exclusive) of the window."""
+        return RasterGrid(self.x_min + c0 * self.cell_w, self.y_max - r0 * self.cell_h, self.cell_w, self.cell_h,
+                          r1 - r0, c1 - c0, self.sr, self.row_off + r0, self.col_off + c0)
+
+
+class ZoneSpans(object):
+    """Row spans of raster cells covered by a set of zones.
+
+    Span i covers columns starts[i] up to (but not including) ends[i] of row
+    rows[i] of a RasterGrid, and belongs to the zone with index zones[i].
+
+    Args:
+        zones: array of zone indices
+        rows: array of row indices
+        starts: array of first column indices
+        ends: array of end column indices (exclusive)
+        nzones: total number of zones, including zones without any spans
+    """
+
+    def __init__(self, zones, rows, starts, ends, nzones):
+        self.zones = np.asarray(zones, dtype=np.int64)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.nzones = nzones
+
+    def __len__(self):
+        return len(self.zones)
+
+    def subset(self, sel):
+        """Returns the spans selected by an index array, slice or boolean mask."""
+        return ZoneSpans(self.zones[sel], self.rows[sel], self.starts[sel], self.ends[sel], self.nzones)
+
+    def lengths(self):
+        """Returns the number of cells in each span."""
+        return self.ends - self.starts
+
+    def cellCounts(self):
+        """Returns the number of cells covered by each zone."""
+        return np.bincount(self.zones, weights=self.lengths(), minlength=self.nzones).astype(np.int64)
+
+    def zoneOffsets(self):
+        """Returns the span offsets of each zone, for spans sorted by zone.
+
+        The spans of zone i (its compact cell mask) are spans.subset(slice(offsets[i], offsets[i + 1])).
+        """
+        return np.searchsorted(self.zones, np.arange(self.nzones + 1), side="left")
+
+    def cellIndex(self, ncols):
+        """Expands the spans into flat cell indices.
+
+        Args:
+            ncols: number of columns of the grid the spans were burned into
+
+        Returns:
+            flat: array of flat (row-major) cell indices
+            zone: array with the zone index of each cell
+        """
+        lengths = self.lengths()
+        span_id = np.repeat(np.arange(len(lengths)), lengths)
+        offsets = np.arange(len(span_id)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        flat = self.rows[span_id] * ncols + self.starts[span_id] + offsets
+        return flat, self.zones[span_id]
+
+
+class RasterSource(object):
+    """Environmental parameter raster dataset, read directly with arcpy.
+
+    Args:
+        ras_path: path to the raster dataset
+    """
+
+    def __init__(self, ras_path):
+        self.path = ras_path
+
+    def spatialReference(self):
+        """Returns the spatial reference of the raster."""
+        import arcpy
+        return arcpy.Describe(self.path).spatialReference
+
+    def window(self, bounds, cell_size=None):
+        """Returns the RasterGrid window covering a bounding box (see rasterWindow)."""
+        return rasterWindow(self.path, bounds, cell_size)
+
+    def read(self, grid, zones=None):
+        """Reads a window of the raster (see readWindow). The zones argument is not used."""
+        return readWindow(self.path, grid)
+
+
+def rasterWindow(ras_path, bounds, cell_size=None):
+    """Snaps a bounding box to the cell grid origin of a raster dataset.
+
+    Args:
+        ras_path: path to the raster dataset
+        bounds: (x_min, y_min, x_max, y_max) tuple in the raster's coordinate system
+        cell_size: cell size of the returned grid. Defaults to the raster's own cell
+        size; other cell sizes keep the raster's grid origin.
+
+    Returns:
+        RasterGrid of the cells intersecting the bounding box, with row_off and
+        col_off giving its position in the raster (in cells of the returned grid).
+    """
+    import arcpy
+    ras = arcpy.Raster(ras_path)
+    cw = cell_size or ras.meanCellWidth
+    ch = cell_size or ras.meanCellHeight
+    rx0 = ras.extent.XMin
+    ry1 = ras.extent.YMax
+    c0 = max(int(math.floor((bounds[0] - rx0) / cw)), 0)
+    c1 = min(int(math.ceil((bounds[2] - rx0) / cw)), int(math.ceil((ras.extent.XMax - rx0) / cw - 1e-6)))
+    r0 = max(int(math.floor((ry1 - bounds[3]) / ch)), 0)
+    r1 = min(int(math.ceil((ry1 - bounds[1]) / ch)), int(math.ceil((ry1 - ras.extent.YMin) / ch - 1e-6)))
+    return RasterGrid(rx0 + c0 * cw, ry1 - r0 * ch, cw, ch, max(r1 - r0, 0), max(c1 - c0, 0),
+                      ras.spatialReference, r0, c0)
+
+
+def readWindow(ras_path, grid):
+    """Reads a window of a raster dataset into memory.
+
+    Args:
+        ras_path: path to the raster dataset
+        grid: RasterGrid window to read
+
+    Returns:
+        2D float64 numpy array, with NoData cells set to NaN.
+    """
+    import arcpy
+    ras = arcpy.Raster(ras_path)
+    arr = arcpy.RasterToNumPyArray(ras, grid.lowerLeft(), grid.ncols, grid.nrows).astype(np.float64)
+    if ras.noDataValue is not None:
+        arr[arr == ras.noDataValue] = np.nan
+    return arr
+
+
+def chunkSpans(spans, max_cells=CHUNK_CELLS):
+    """Splits spans sorted by zone into groups covering about max_cells cells each.
+
+    The cells of each zone are split into rounds of max_cells cells counted from
+    the zone's own first span, and each round is split into groups at zone
+    boundaries only. The partial sums of a zone therefore do not depend on which
+    other zones are reduced along with it, which keeps results identical between
+    serial and parallel runs.
+
+    Args:
+        spans: ZoneSpans sorted by zone
+        max_cells: approximate maximum number of cells per group
+
+    Returns:
+        List of ZoneSpans.
+    """
+    lengths = spans.lengths()
+    if lengths.sum() <= max_cells:
+        return [spans]
+    span_start = np.cumsum(lengths) - lengths
+    zone_start = np.ones(len(spans), dtype=bool)
+    zone_start[1:] = spans.zones[1:] != spans.zones[:-1]
+    first = np.maximum.accumulate(np.where(zone_start, np.arange(len(spans)), 0))
+    rounds = (span_start - span_start[first]) // max_cells
+    chunks = []
+    for r in np.unique(rounds):
+        part = spans.subset(np.nonzero(rounds == r)[0])
+        part_lengths = part.lengths()
+        part_start = np.cumsum(part_lengths) - part_lengths
+        new_zone = np.ones(len(part), dtype=bool)
+        new_zone[1:] = part.zones[1:] != part.zones[:-1]
+        zone_first = np.maximum.accumulate(np.where(new_zone, np.arange(len(part)), 0))
+        groups = part_start[zone_first] // max_cells
+        for g in np.unique(groups):
+            chunks.append(part.subset(groups == g))
+    return chunks
+
+
+def zoneSums(spans, values, max_cells=CHUNK_CELLS):
+    """Sums the valid (non-NoData) cells of a raster array per zone.
+
+    Args:
+        spans: ZoneSpans burned into the grid of the values array
+        values: 2D float array, with NoData cells set to NaN
+        max_cells: maximum number of cells gathered into memory at once
+
+    Returns:
+        sums: array with the sum of valid cell values per zone
+        counts: array with the number of valid cells per zone
+    """
+    sums = np.zeros(spans.nzones)
+    counts = np.zeros(spans.nzones, dtype=np.int64)
+    flat_values = values.ravel()
+    for chunk in chunkSpans(spans, max_cells):
+        flat, zone = chunk.cellIndex(values.shape[1])
+        v = flat_values[flat]
+        ok = ~np.isnan(v)
+        sums += np.bincount(zone[ok], weights=v[ok], minlength=spans.nzones)
+        counts += np.bincount(zone[ok], minlength=spans.nzones)
+    return sums, counts
+
+
+def zoneMeans(sums, counts):
+    """Returns the mean per zone, with NaN for zones without valid cells."""
+    means = np.empty(len(sums))
+    means.fill(np.nan)
+    ok = counts > 0
+    means[ok] = sums[ok] / counts[ok]
+    return means
+
+
+def spanDifference(a, b):
+    """Removes the cells covered by one set of spans from another, zone by zone.
+
+    Args:
+        a: ZoneSpans to subtract from
+        b: ZoneSpans to subtract, burned into the same grid with the same zone indices
+
+    Returns:
+        ZoneSpans with the cells of each zone in a that are not covered by the same zone in b.
+    """
+    zones = np.concatenate([a.zones, a.zones, b.zones, b.zones])
+    rows = np.concatenate([a.rows, a.rows, b.rows, b.rows])
+    cols = np.concatenate([a.starts, a.ends, b.starts, b.ends])
+    n_a = len(a)
+    n_b = len(b)
+    delta_a = np.concatenate([np.ones(n_a, np.int64), -np.ones(n_a, np.int64), np.zeros(2 * n_b, np.int64)])
+    delta_b = np.concatenate([np.zeros(2 * n_a, np.int64), np.ones(n_b, np.int64), -np.ones(n_b, np.int64)])
+    order = np.lexsort((cols, rows, zones))
+    zones = zones[order]
+    rows = rows[order]
+    cols = cols[order]
+    # coverage of a and b between consecutive event positions of the same zone and row
+    cover_a = np.cumsum(delta_a[order])
+    cover_b = np.cumsum(delta_b[order])
+    same = (zones[:-1] == zones[1:]) & (rows[:-1] == rows[1:]) & (cols[:-1] < cols[1:])
+    keep = same & (cover_a[:-1] > 0) & (cover_b[:-1] <= 0)
+    return ZoneSpans(zones[:-1][keep], rows[:-1][keep], cols[:-1][keep], cols[1:][keep], a.nzones)
+
+
+def nestZones(spans, ncols, max_pairs=CHUNK_CELLS):
+    """Decomposes nested zones (upstream catchment areas) into non-overlapping incremental areas.
+
+    The parent of a zone is the smallest other zone covering its first cell. The
+    incremental area of a zone is its own cells minus the cells of its children,
+    so every cell of a nested catchment network belongs to exactly one
+    incremental area.
+
+    The zones must be nested: the incremental areas of a zone and of all zones
+    upstream of it must add up to the zone itself. Zones that only partly overlap
+    their parent or a sibling would have cells counted twice, so they are refused.
+
+    Args:
+        spans: ZoneSpans of the nested zones
+        ncols: number of columns of the grid the spans were burned into
+        max_pairs: maximum number of candidate (zone, ancestor) pairs held in memory at once
+
+    Returns:
+        incremental: ZoneSpans of the incremental area of each zone
+        parent: array with the parent zone index of each zone (-1 for outlet zones)
+        order: zone indices ordered so that children always come before their parents
+
+    Raises:
+        ValueError: some zones are not nested
+    """
+    nzones = spans.nzones
+    area = spans.cellCounts()
+    rank = np.empty(nzones, dtype=np.int64)
+    order = np.lexsort((np.arange(nzones), area))
+    rank[order] = np.arange(nzones)
+
+    # representative cell of each zone: the first cell of its first span
+    first = np.ones(len(spans), dtype=bool)
+    first[1:] = spans.zones[1:] != spans.zones[:-1]
+    rep_zone = spans.zones[first]
+    rep_flat = spans.rows[first] * ncols + spans.starts[first]
+    rep_order = np.argsort(rep_flat, kind="mergesort")
+    rep_zone = rep_zone[rep_order]
+    rep_flat = rep_flat[rep_order]
+
+    # find the lowest ranked zone (other than itself) that covers each representative cell
+    best = np.empty(nzones, dtype=np.int64)
+    best.fill(nzones)
+    lo = np.searchsorted(rep_flat, spans.rows * ncols + spans.starts, side="left")
+    hi = np.searchsorted(rep_flat, spans.rows * ncols + spans.ends, side="left")
+    n = hi - lo
+    cum = np.cumsum(n)
+    i = 0
+    while i < len(n):
+        base = cum[i - 1] if i > 0 else 0
+        j = max(int(np.searchsorted(cum, base + max_pairs, side="right")), i + 1)
+        cnt = n[i:j]
+        span_id = np.repeat(np.arange(i, j), cnt)
+        pos = lo[span_id] + np.arange(len(span_id)) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        child = rep_zone[pos]
+        ancestor_rank = rank[spans.zones[span_id]]
+        ok = ancestor_rank > rank[child]
+        np.minimum.at(best, child[ok], ancestor_rank[ok])
+        i = j
+    parent = np.where(best < nzones, order[np.minimum(best, nzones - 1)], -1)
+
+    # subtract the cells of each child from its parent
+    has_parent = parent[spans.zones] >= 0
+    child_spans = spans.subset(has_parent)
+    child_spans.zones = parent[child_spans.zones]
+    incremental = spanDifference(spans, child_spans)
+
+    # cells of a child outside its parent, or shared by two children, add up to more than the parent's cells
+    covered = accumulateZones(incremental.cellCounts(), parent, order)
+    bad = np.nonzero(covered != area)[0]
+    if len(bad):
+        raise ValueError("{0} catchments are not nested within the catchment containing them, so their cells "
+                         "would be counted twice. Run the tool without nested catchment accumulation.".format(len(bad)))
+    return incremental, parent, order
+
+
+def accumulateZones(values, parent, order):
+    """Accumulates per-zone values (sums or counts) from incremental areas down the drainage topology.
+
+    Args:
+        values: array of values per incremental area
+        parent: array with the parent zone index of each zone (-1 for outlet zones)
+        order: zone indices ordered so that children always come before their parents
+
+    Returns:
+        Array with the accumulated value of each zone's whole upstream area.
+    """
+    totals = np.array(values, copy=True)
+    for z in order:
+        p = parent[z]
+        if p >= 0:
+            totals[p] += totals[z]
+    return totals
+
+
+def rowPrefixSums(values):
+    """Precomputes per-row cumulative sums and valid cell counts of a raster array.
+
+    Args:
+        values: 2D float array, with NoData cells set to NaN
+
+    Returns:
+        csum: array of shape (nrows, ncols + 1), csum[r, c] is the sum of the valid cells in row r before column c
+        ccount: array of the same shape with the number of valid cells in row r before column c
+    """
+    nrows, ncols = values.shape
+    ok = ~np.isnan(values)
+    csum = np.zeros((nrows, ncols + 1))
+    np.cumsum(np.where(ok, values, 0.0), axis=1, out=csum[:, 1:])
+    ccount = np.zeros((nrows, ncols + 1), dtype=np.int32)
+    np.cumsum(ok, axis=1, out=ccount[:, 1:])
+    return csum, ccount
+
+
+def zoneSumsPrefix(spans, prefix):
+    """Sums the valid (non-NoData) cells of a raster array per zone, using row prefix sums.
+
+    Each span is evaluated with two lookups, so the cost of a zone is proportional
+    to the number of rows it crosses rather than the number of cells it covers.
+
+    Args:
+        spans: ZoneSpans burned into the grid of the raster array
+        prefix: (csum, ccount) tuple returned by rowPrefixSums
+
+    Returns:
+        sums: array with the sum of valid cell values per zone
+        counts: array with the number of valid cells per zone
+    """
+    csum, ccount = prefix
+    span_sums = csum[spans.rows, spans.ends] - csum[spans.rows, spans.starts]
+    span_counts = ccount[spans.rows, spans.ends] - ccount[spans.rows, spans.starts]
+    sums = np.bincount(spans.zones, weights=span_sums, minlength=spans.nzones)
+    counts = np.bincount(spans.zones, weights=span_counts, minlength=spans.nzones).astype(np.int64)
+    return sums, counts
+
+
+class ZoneWeights(object):
+    """Sparse matrix of zone weights on the cells of a raster grid.
+
+    Entry i gives zone zones[i] the weight weights[i] on the flat cell index
+    cells[i] of the grid, where the weight is the number of fine zone cells
+    whose centers fall in that raster cell. Entries are sorted by zone.
+
+    Args:
+        zones: array of zone indices
+        cells: array of flat (row-major) cell indices
+        weights: array of weights
+        nzones: total number of zones, including zones without any cells
+    """
+
+    def __init__(self, zones, cells, weights, nzones):
+        self.zones = np.asarray(zones, dtype=np.int64)
+        self.cells = np.asarray(cells, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.nzones = nzones
+
+    def __len__(self):
+        return len(self.zones)
+
+    def subset(self, sel):
+        """Returns the entries selected by an index array, slice or boolean mask."""
+        return ZoneWeights(self.zones[sel], self.cells[sel], self.weights[sel], self.nzones)
+
+    def save(self, path, parent=None, order=None):
+        """Saves the matrix (and the nested zone topology, if any) to a .npz file."""
+        extra = {}
+        if parent is not None:
+            extra = {"parent": parent, "order": order}
+        np.savez_compressed(path, zones=self.zones, cells=self.cells, weights=self.weights,
+                            nzones=np.array([self.nzones]), **extra)
+
+    @staticmethod
+    def load(path):
+        """Loads a matrix saved by ZoneWeights.save.
+
+        Returns:
+            weights: ZoneWeights
+            parent: array of parent zone indices, or None
+            order: array of zone indices with children before parents, or None
+        """
+        data = np.load(path)
+        weights = ZoneWeights(data["zones"], data["cells"], data["weights"], int(data["nzones"][0]))
+        if "parent" in data.files:
+            return weights, data["parent"], data["order"]
+        return weights, None, None
+
+
+def zoneWeights(spans, fine, grid):
+    """Builds the sparse weights of zones burned into a fine grid on the cells of a coarser raster grid.
+
+    Each fine cell is assigned to the raster cell containing its center, so the
+    weight of a raster cell is the number of fine zone cells inside it. The cost
+    is proportional to the number of raster cells crossed by each span rather
+    than the number of fine cells.
+
+    Args:
+        spans: ZoneSpans burned into the fine grid
+        fine: RasterGrid the spans were burned into
+        grid: RasterGrid of the raster dataset
+
+    Returns:
+        ZoneWeights on the cells of grid.
+    """
+    x_off = fine.x_min - grid.x_min
+    y_off = grid.y_max - fine.y_max
+    rows = np.floor((y_off + (spans.rows + 0.5) * fine.cell_h) / grid.cell_h).astype(np.int64)
+    first = np.floor((x_off + (spans.starts + 0.5) * fine.cell_w) / grid.cell_w).astype(np.int64)
+    last = np.floor((x_off + (spans.ends - 0.5) * fine.cell_w) / grid.cell_w).astype(np.int64)
+    n = np.maximum(last - first + 1, 0)
+    span_id = np.repeat(np.arange(len(n)), n)
+    cols = first[span_id] + np.arange(len(span_id)) - np.repeat(np.cumsum(n) - n, n)
+    # fine columns of the span whose centers fall in each raster column
+    lo = np.ceil((cols * grid.cell_w - x_off) / fine.cell_w - 0.5).astype(np.int64)
+    hi = np.ceil(((cols + 1) * grid.cell_w - x_off) / fine.cell_w - 0.5).astype(np.int64)
+    count = np.minimum(spans.ends[span_id], hi) - np.maximum(spans.starts[span_id], lo)
+    rows = rows[span_id]
+    ok = (count > 0) & (rows >= 0) & (rows < grid.nrows) & (cols >= 0) & (cols < grid.ncols)
+    ncells = grid.nrows * grid.ncols
+    keys = spans.zones[span_id][ok] * ncells + rows[ok] * grid.ncols + cols[ok]
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    weights = np.bincount(inverse, weights=count[ok])
+    return ZoneWeights(unique_keys // ncells, unique_keys % ncells, weights, spans.nzones)
+
+
+def zoneSumsWeighted(weights, values):
+    """Weighted sums of the valid (non-NoData) cells of a raster array per zone.
+
+    Equivalent to one sparse matrix-vector product of the zone weights with the
+    raster values, and one with the valid-cell indicator.
+
+    Args:
+        weights: ZoneWeights on the grid of the values array
+        values: 2D float array, with NoData cells set to NaN
+
+    Returns:
+        sums: array with the weighted sum of valid cell values per zone
+        counts: array with the total weight of valid cells per zone
+    """
+    v = values.ravel()[weights.cells]
+    ok = ~np.isnan(v)
+    sums = np.bincount(weights.zones[ok], weights=weights.weights[ok] * v[ok], minlength=weights.nzones)
+    counts = np.bincount(weights.zones[ok], weights=weights.weights[ok], minlength=weights.nzones)
+    return sums, counts
+
+
+def reduceZones(zones, values, engine, max_cells=CHUNK_CELLS):
+    """Sums the valid cells of a raster array per zone with an array-based engine.
+
+    Args:
+        zones: ZoneSpans, or ZoneWeights for the SPARSE engine
+        values: 2D float array, with NoData cells set to NaN
+        engine: VECTORIZED, PREFIX_SUM or SPARSE
+        max_cells: maximum number of cells gathered into memory at once
+
+    Returns:
+        sums: array with the sum of valid cell values per zone
+        counts: array with the number (or weight) of valid cells per zone
+    """
+    if engine == "SPARSE":
+        return zoneSumsWeighted(zones, values)
+    if engine == "PREFIX_SUM":
+        return zoneSumsPrefix(zones, rowPrefixSums(values))
+    return zoneSums(zones, values, max_cells)
+
+
+class ZoneStats(object):
+    """Streaming statistics of the cells of each zone.
+
+    Tiles of a raster are added one at a time: each tile's valid-cell count, mean
+    and sum of squared deviations are calculated in two passes over its cells, and
+    merged into the running values with the parallel (Chan et al.) form of
+    Welford's update, together with the minimum, maximum and total number of
+    cells. For ZoneWeights, cells are counted with their weights.
+
+    Args:
+        nzones: number of zones
+    """
+
+    FIELDS = ("cells", "n", "mean", "m2", "vmin", "vmax")
+
+    def __init__(self, nzones):
+        self.nzones = nzones
+        self.cells = np.zeros(nzones)
+        self.n = np.zeros(nzones)
+        self.mean = np.zeros(nzones)
+        self.m2 = np.zeros(nzones)
+        self.vmin = np.empty(nzones)
+        self.vmin.fill(np.inf)
+        self.vmax = np.empty(nzones)
+        self.vmax.fill(-np.inf)
+
+    def update(self, zones, values, max_cells=CHUNK_CELLS):
+        """Adds the cells of a raster array.
+
+        Args:
+            zones: ZoneSpans or ZoneWeights on the grid of the values array
+            values: 2D float array, with NoData cells set to NaN
+            max_cells: maximum number of cells gathered into memory at once
+        """
+        flat_values = values.ravel()
+        if isinstance(zones, ZoneWeights):
+            chunks = [(zones.cells, zones.zones, zones.weights)]
+        else:
+            chunks = (chunk.cellIndex(values.shape[1]) + (None,) for chunk in chunkSpans(zones, max_cells))
+        for flat, zone, w in chunks:
+            if w is None:
+                w = np.ones(len(flat))
+            v = flat_values[flat]
+            ok = ~np.isnan(v)
+            ids = np.unique(zone)
+            cells = np.bincount(zone, w, minlength=self.nzones)[ids]
+            zone, v, w = zone[ok], v[ok], w[ok]
+            n = np.bincount(zone, w, minlength=self.nzones)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = np.bincount(zone, w * v, minlength=self.nzones) / n
+            m2 = np.bincount(zone, w * (v - mean[zone]) ** 2, minlength=self.nzones)
+            vmin = np.empty(self.nzones)
+            vmin.fill(np.inf)
+            vmax = np.empty(self.nzones)
+            vmax.fill(-np.inf)
+            if len(v):
+                order = np.argsort(zone, kind="mergesort")
+                zone, v = zone[order], v[order]
+                first = np.nonzero(np.r_[True, zone[1:] != zone[:-1]])[0]
+                vmin[zone[first]] = np.minimum.reduceat(v, first)
+                vmax[zone[first]] = np.maximum.reduceat(v, first)
+            self.merge(ids, cells, n[ids], mean[ids], m2[ids], vmin[ids], vmax[ids])
+
+    def merge(self, ids, cells, n, mean, m2, vmin, vmax):
+        """Merges the statistics of other cells of the zones ids into the running values."""
+        n_a = self.n[ids]
+        total = n_a + n
+        share = np.zeros(len(ids))
+        np.divide(n, total, out=share, where=total > 0)
+        delta = np.zeros(len(ids))
+        np.subtract(mean, self.mean[ids], out=delta, where=n > 0)
+        self.mean[ids] += delta * share
+        self.m2[ids] += m2 + delta ** 2 * n_a * share
+        self.n[ids] = total
+        self.cells[ids] += cells
+        self.vmin[ids] = np.minimum(self.vmin[ids], vmin)
+        self.vmax[ids] = np.maximum(self.vmax[ids], vmax)
+
+    def subset(self, ids):
+        """Returns a dictionary of field: array of the running values of the zones ids."""
+        return dict((f, getattr(self, f)[ids]) for f in self.FIELDS)
+
+    def assign(self, ids, part):
+        """Sets the running values of the zones ids from a dictionary returned by subset."""
+        for f in self.FIELDS:
+            getattr(self, f)[ids] = part[f]
+
+    def accumulate(self, parent, order):
+        """Merges the statistics of incremental areas down the drainage topology (see accumulateZones)."""
+        for z in order:
+            p = parent[z]
+            if p >= 0:
+                self.merge(np.array([p]), self.cells[[z]], self.n[[z]], self.mean[[z]], self.m2[[z]],
+                           self.vmin[[z]], self.vmax[[z]])
+
+    def values(self, stat_names):
+        """Returns the final statistics of every zone.
+
+        Args:
+            stat_names: list of statistics: COUNT (number or weight of valid cells),
+            NODATA_FRACTION, MIN, MAX and STD (population standard deviation)
+
+        Returns:
+            Dictionary of statistic name: array of values per zone (NaN where undefined).
+        """
+        valid = self.n > 0
+        result = {}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for name in stat_names:
+                if name == "COUNT":
+                    result[name] = self.n.copy()
+                elif name == "NODATA_FRACTION":
+                    result[name] = np.where(self.cells > 0, 1.0 - self.n / self.cells, np.nan)
+                elif name == "MIN":
+                    result[name] = np.where(valid, self.vmin, np.nan)
+                elif name == "MAX":
+                    result[name] = np.where(valid, self.vmax, np.nan)
+                elif name == "STD":
+                    result[name] = np.where(valid, np.sqrt(self.m2 / self.n), np.nan)
+        return result
+
+
+def tileSize(memory_mb, engine, stats=False):
+    """Returns the number of rows and columns of a square raster tile that fits a memory budget.
+
+    Args:
+        memory_mb: memory budget for a tile, in megabytes
+        engine: array-based zonal statistics engine
+        stats: whether cell statistics (ZoneStats) are calculated from the tile as well
+    """
+    cell_bytes = CELL_BYTES.get(engine, 40) + (STATS_CELL_BYTES if stats else 0)
+    cells = max(memory_mb, 0) * 1024.0 * 1024.0 / cell_bytes
+    return max(int(math.sqrt(cells)), 64)
+
+
+def zoneMemoryMB(zones):
+    """Returns the working memory of a set of zones while they are streamed, in megabytes (see ZONE_BYTES)."""
+    return len(zones) * ZONE_BYTES / (1024.0 * 1024.0)
+
+
+def clipZones(zones, ncols, r0, r1, c0, c1):
+    """Clips zones to a tile of their grid.
+
+    Args:
+        zones: ZoneSpans or ZoneWeights
+        ncols: number of columns of the grid of the zones
+        r0, r1: first and end (exclusive) rows of the tile
+        c0, c1: first and end (exclusive) columns of the tile
+
+    Returns:
+        ZoneSpans or ZoneWeights in the grid of the tile.
+    """
+    if isinstance(zones, ZoneWeights):
+        rows = zones.cells // ncols
+        cols = zones.cells % ncols
+        sel = (rows >= r0) & (rows < r1) & (cols >= c0) & (cols < c1)
+        return ZoneWeights(zones.zones[sel], (rows[sel] - r0) * (c1 - c0) + cols[sel] - c0, zones.weights[sel],
+                           zones.nzones)
+    sel = (zones.rows >= r0) & (zones.rows < r1) & (zones.ends > c0) & (zones.starts < c1)
+    return ZoneSpans(zones.zones[sel], zones.rows[sel] - r0, np.maximum(zones.starts[sel], c0) - c0,
+                     np.minimum(zones.ends[sel], c1) - c0, zones.nzones)
+
+
+def streamZoneSums(source, grid, zones, engine, memory_mb=MEMORY_MB, tile_keys=None, stats=None):
+    """Sums the valid cells of a raster per zone, streaming the raster in tiles.
+
+    The window is split into square tiles, and only tiles intersected by at
+    least one zone are read, so peak memory does not depend on the size of the
+    raster. The zones themselves are held in memory whole, and take about
+    ZONE_BYTES per span (or weight) while they are streamed; tiles are sized to
+    the part of the memory budget left after the zones, down to a minimum tile
+    size, so zone sets larger than the budget exceed it. In nested mode the zones
+    are the incremental areas, whose spans number at most twice the spans of the
+    upstream catchments they are made from. Tile boundaries are anchored to the
+    window, so the result does not depend on which other zones are processed
+    along with a zone. For the same reason, PREFIX_SUM reads whole tiles: its
+    row prefix sums run through every cell of a row, so cells left out of a
+    read (see envstack.EnvStack.read) would change the rounding of the sums.
+
+    Args:
+        source: zonal.RasterSource or envstack.StackBand to read
+        grid: RasterGrid window of the zones
+        zones: ZoneSpans, or ZoneWeights for the SPARSE engine
+        engine: VECTORIZED, PREFIX_SUM or SPARSE
+        memory_mb: memory budget for the tile and the zones, in megabytes
+        tile_keys: optional set; the (row, column) of the first cell of every tile
+        read is added to it
+        stats: optional ZoneStats, updated from the same tile reads
+
+    Returns:
+        sums: array with the sum of valid cell values per zone
+        counts: array with the number (or weight) of valid cells per zone
+        tiles: number of tiles read
+    """
+    size = tileSize(memory_mb - zoneMemoryMB(zones), engine, stats is not None)
+    sums = np.zeros(zones.nzones)
+    counts = np.zeros(zones.nzones, dtype=np.float64 if engine == "SPARSE" else np.int64)
+    tiles = 0
+    if isinstance(zones, ZoneWeights):
+        zone_rows = zones.cells // grid.ncols
+    else:
+        zone_rows = zones.rows
+    order = np.argsort(zone_rows, kind="mergesort")
+    sorted_rows = zone_rows[order]
+    for r0 in range(0, grid.nrows, size):
+        r1 = min(r0 + size, grid.nrows)
+        band = order[np.searchsorted(sorted_rows, r0):np.searchsorted(sorted_rows, r1)]
+        if len(band) == 0:
+            continue
+        band_zones = zones.subset(np.sort(band))
+        for c0 in range(0, grid.ncols, size):
+            c1 = min(c0 + size, grid.ncols)
+            tile_zones = clipZones(band_zones, grid.ncols, r0, r1, c0, c1)
+            if len(tile_zones) == 0:
+                continue
+            values = source.read(grid.subGrid(r0, r1, c0, c1), None if engine == "PREFIX_SUM" else tile_zones)
+            tile_sums, tile_counts = reduceZones(tile_zones, values, engine, size * size)
+            sums += tile_sums
+            counts += tile_counts
+            if stats is not None:
+                stats.update(tile_zones, values, size * size)
+            tiles += 1
+            if tile_keys is not None:
+                tile_keys.add((r0, c0))
+            del values
+    return sums, counts, tiles
+
+
+def peakMemoryMB():
+    """Returns the peak memory use of the current process in megabytes, or None if it is not available."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1048576.0 if sys.platform == "darwin" else 1024.0)
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize / 1048576.0
+    except (ImportError, AttributeError, OSError):
+        pass
+    return None